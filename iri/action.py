@@ -5,6 +5,7 @@
 import sys
 
 from air.air_common import *
+from field_handle import field_handle
 
 class PrimitiveAction(object):
     pass
@@ -19,6 +20,7 @@ class IriPrimitiveModifyField(PrimitiveAction):
             self.mask = args[2]
         else:
             self.mask = None
+        self.destination_handle = field_handle(self.destination)
         logging.debug("Prim action %s. Dst %s. Src %s. Mask %s" %
                       (self.name, self.destination, self.source,
                        str(self.mask)))
@@ -45,7 +47,8 @@ class IriPrimitiveModifyField(PrimitiveAction):
                        value_map[self.source] & self.mask)
         else:
             new_val = value_map[self.source]
-        parsed_packet.set_field(self.destination, new_val)
+        if self.destination_handle is not None:
+            parsed_packet.set(self.destination_handle, new_val)
 
 class IriPrimitiveAddHeader(PrimitiveAction):
     def __init__(self, args):
@@ -90,6 +93,7 @@ class IriPrimitiveAddToField(PrimitiveAction):
         self.name = "AddToField"
         air_assert(len(args) == 2, "Bad param list for add_to_field")
         self.field_name = args[0]
+        self.field_handle = field_handle(self.field_name)
         self.value = args[1]
         # @todo Error checking
         if isinstance(self.value, str):
@@ -107,10 +111,10 @@ class IriPrimitiveAddToField(PrimitiveAction):
         """
         logging.debug("Applying %s to pkt %d. Values %s" %
                       (self.name, parsed_packet.id, str(value_map)))
-        value = parsed_packet.get_field(self.field_name)
+        value = parsed_packet.get(self.field_handle)
         logging.debug("Old value: %d" % value)
         value += self.value
-        value = parsed_packet.set_field(self.field_name, value)
+        value = parsed_packet.set(self.field_handle, value)
 
 class IriPrimitiveNoOp(PrimitiveAction):
     def __init__(self, args):
@@ -163,6 +167,13 @@ class Action(object):
             for param in params:
                 self.param_refs.add(param)
 
+        # Parameters that may be field references, resolved to handles
+        self.param_handles = []
+        for ref in self.param_refs:
+            handle = field_handle(ref)
+            if handle is not None:
+                self.param_handles.append((ref, handle))
+
     def eval(self, parsed_packet, action_params):
         """
         Apply this action to a parsed packet instance
@@ -173,10 +184,10 @@ class Action(object):
                    (self.name, str(self.param_list), str(action_params)))
         # Create a dict with the values to use (parallel semantics)
         values = action_params.copy()
-        for ref in self.param_refs:
-            if ref in values.keys():
+        for ref, handle in self.param_handles:
+            if ref in values:
                 continue
-            value = parsed_packet.get_field(ref)
+            value = parsed_packet.get(handle)
             if value is not None:
                 # May not be a field ref at all
                 values[ref] = value
@@ -4,42 +4,234 @@
 
 import struct
 import array
+import binascii
 import sys
 
 from air.air_common import *
 from iri_exception import *
 
+# Builtins a width expression may call, e.g. "max(ihl * 32 - 160, 0)"
+WIDTH_BUILTINS = {"abs" : abs, "max" : max, "min" : min, "int" : int,
+                  "pow" : pow}
+
+class FieldWidthExpr(object):
+    """
+    @brief A variable field width expression compiled at load time
+
+    @param field_name The name of the field (for debug messages only)
+    @param expr The width expression string, e.g. "(ihl * 32) - 160"
+    @param known_fields If not None, the names of the fields the expression
+    may refer to (normally the fields preceding this one in the header)
+
+    The expression is compiled once into a function taking the values of
+    the fields it depends on, in the order given by deps. Other names
+    must be WIDTH_BUILTINS (a field of the same name takes precedence).
+    A syntax error or a reference to an unknown field raises
+    IriReferenceError here rather than when a packet is parsed.
+    """
+    def __init__(self, field_name, expr, known_fields=None):
+        self.field_name = field_name
+        self.expr = expr
+        try:
+            code = compile(expr, "<width of %s>" % field_name, "eval")
+        except SyntaxError:
+            raise IriReferenceError("Bad width expression for %s: %s" %
+                                    (field_name, expr))
+        names = code.co_names
+        if known_fields is None:
+            self.deps = tuple([name for name in names
+                               if name not in WIDTH_BUILTINS])
+        else:
+            self.deps = tuple([name for name in names
+                               if name in known_fields or
+                               name not in WIDTH_BUILTINS])
+            for name in self.deps:
+                if name not in known_fields:
+                    raise IriReferenceError(
+                        "Width expression for %s refers to unknown field %s" %
+                        (field_name, name))
+        self.function = eval(compile("lambda %s: (%s)" %
+                                     (", ".join(self.deps), expr),
+                                     "<width of %s>" % field_name, "eval"),
+                             {"__builtins__" : WIDTH_BUILTINS})
+
+    def width(self, *dep_values):
+        """
+        @brief Evaluate the expression
+        @param dep_values The values of the fields listed in deps, in order
+
+        If the calculation is negative, 0 is returned.
+        """
+        try:
+            width = self.function(*dep_values)
+        except Exception:
+            raise IriReferenceError("Could not evaluate width of %s: %s" %
+                                    (self.field_name, self.expr))
+        if width < 0:
+            return 0
+        return width
+
 def field_width_get(field_name, attrs, field_values, remaining_bits=None):
     """
     @brief Get the width of a field based on current values
 
     @param field_name The name of the field (for debug messages only)
-    @param attrs The attributes from the top level desc
-    @param field_values A dict used in eval if width is an expression
+    @param attrs The attributes from the top level desc or a FieldWidthExpr
+    @param field_values A dict of field values if width is an expression
     @param remaining_bits Number of bits remaining in header, if known
 
     @todo Consider changing semantics to return an error (None)
     and do not do the assert here
 
     If the width calculation is negative, 0 is returned.
+
+    String expressions are compiled on each call; the packet path uses
+    the FieldWidthExpr objects precompiled in the header layout instead.
     """
     if isinstance(attrs, int):
         return attrs
     if isinstance(attrs, dict):
         air_assert("width" in attrs.keys(), "Bad field attrs; no width")
         return field_width_get(field_name, attrs["width"], field_values)
-    # Attempt to evaluate a string expression
-    air_assert(isinstance(attrs, str), 
-               "Bad field attrs; not int, dict, string")
+    if not isinstance(attrs, FieldWidthExpr):
+        air_assert(isinstance(attrs, str), 
+                   "Bad field attrs; not int, dict, string")
+        attrs = FieldWidthExpr(field_name, attrs)
     try:
-        width = eval(attrs, {"__builtins__":None}, field_values)
-    except:  # @todo NameError?
-        raise IriReferenceError("Bad width expression for %s" + field_name)
+        dep_values = [field_values[name] for name in attrs.deps]
+    except KeyError:
+        raise IriReferenceError("Bad width expression for %s" % field_name)
+    return attrs.width(*dep_values)
+
+################################################################
+#
+# Bit extraction/insertion engine
+#
+# A run of bytes (normally a whole header) is converted to a single
+# integer once. Every field is then read or written with a shift and
+# a mask, regardless of its alignment. Bit offsets are counted from
+# the most significant bit of the first byte.
+#
+################################################################
+
+# Structs for byte aligned fields that can be unpacked directly
+ALIGNED_STRUCTS = {
+    8  : struct.Struct("!B"),
+    16 : struct.Struct("!H"),
+    32 : struct.Struct("!L"),
+    64 : struct.Struct("!Q"),
+}
 
-    # If calculation is negative, return 0
-    if width < 0:
+def bits_from_bytes(buf, low, high):
+    """
+    @brief Convert a run of bytes to an integer (big endian)
+    @param buf A bytearray (or other buffer)
+    @param low The first byte to convert
+    @param high One past the last byte to convert
+    """
+    if high <= low:
         return 0
-    return width
+    return int(binascii.hexlify(buf[low:high]), 16)
+
+def bits_to_bytes(bits, length):
+    """
+    @brief Convert an integer to a bytearray of the given length (big endian)
+    @param bits The integer value; must fit in length bytes
+    @param length The number of bytes to produce
+    """
+    if length == 0:
+        return bytearray()
+    return bytearray(binascii.unhexlify("%0*x" % (2 * length, bits)))
+
+def bits_get(bits, total_bits, bit_offset, width):
+    """
+    @brief Get a field from an integer representing a run of bytes
+    @param bits The integer from bits_from_bytes
+    @param total_bits The number of bits represented by bits
+    @param bit_offset The offset of the field from the most significant bit
+    @param width The width of the field in bits
+    """
+    return (bits >> (total_bits - bit_offset - width)) & ((1 << width) - 1)
+
+def bits_set(bits, total_bits, bit_offset, width, value):
+    """
+    @brief Set a field in an integer representing a run of bytes
+    @param bits The integer from bits_from_bytes
+    @param total_bits The number of bits represented by bits
+    @param bit_offset The offset of the field from the most significant bit
+    @param width The width of the field in bits
+    @param value The value of the field; truncated to width bits
+    @returns The updated integer
+    """
+    shift = total_bits - bit_offset - width
+    mask = ((1 << width) - 1) << shift
+    return (bits & ~mask) | ((value << shift) & mask)
+
+def field_extract(buf, header_offset, bit_offset, width, field_name=""):
+    """
+    @brief Extract a field value from a buffer
+
+    @param buf A byte array holding the header data
+    @param header_offset Start of the header instance in the buf
+    @param bit_offset The bit offset into the header where the field starts
+    @param width The width of the field in bits
+    @param field_name The name of the field (for debug messages only)
+    @returns The value of the field
+
+    Byte aligned fields wider than 64 bits whose width is a multiple of
+    8 are returned as bytearrays; all other fields are returned as
+    integers.
+
+    @todo Assumes the field does not extend beyond the packet boundary
+    """
+    byte_offset = header_offset + (bit_offset / 8)
+    bit_offset = bit_offset % 8
+
+    # Easy cases:
+    if bit_offset == 0:
+        if width in ALIGNED_STRUCTS:
+            return ALIGNED_STRUCTS[width].unpack_from(buf, byte_offset)[0]
+        elif width > 64 and width % 8 == 0:
+            return bytearray(buf[byte_offset: byte_offset + width/8])
+
+    # Convert the bytes covering the field and shift/mask the value out
+    bytes_needed = (width + bit_offset + 7) / 8
+    bits = bits_from_bytes(buf, byte_offset, byte_offset + bytes_needed)
+    return bits_get(bits, bytes_needed * 8, bit_offset, width)
+
+def field_update(byte_list, bit_offset, width, value, field_name=""):
+    """
+    @brief Update a header (a list of bytes) with a field value
+
+    @param byte_list A bytearray representing the entire header
+    @param bit_offset The bit offset of the field from the start 
+    of the header
+    @param width The width of the field in bits
+    @param value The value to write (integer or bytearray)
+    @param field_name The name of the field (for debug messages only)
+    """
+    byte_offset = (bit_offset / 8)
+    bit_offset = bit_offset % 8
+
+    # Easy cases:
+    if width == 0:
+        return
+
+    # Value is an array of bytes: copy them in 
+    if isinstance(value, bytearray):
+        byte_list[byte_offset:byte_offset + len(value)] = value
+        return
+
+    # Convert the bytes covering the field, insert the value, convert back
+    # @todo Assumes big endian in the packet
+    bytes_needed = (width + bit_offset + 7) / 8
+    high = byte_offset + bytes_needed
+    if bit_offset == 0 and width % 8 == 0:
+        bits = 0 # Field covers all the bytes
+    else:
+        bits = bits_from_bytes(byte_list, byte_offset, high)
+    bits = bits_set(bits, bytes_needed * 8, bit_offset, width, value)
+    byte_list[byte_offset:high] = bits_to_bytes(bits, bytes_needed)
 
 class field_instance(object):
     """
@@ -54,9 +246,7 @@ class field_instance(object):
     Fields of greater width are stored as "B" arrays. width must be 
     divisible by 8.
     """
-
-    # Masks for bit widths <= 8
-    BYTE_MASK = [0, 1, 3, 7, 0xf, 0x1f, 0x3f, 0x7f, 0xff]
+    __slots__ = ["name", "attrs", "width", "value"]
 
     def __init__(self, name, attrs, width, value=None):
         self.name = name
@@ -74,66 +264,12 @@ class field_instance(object):
 
         NOTE that bit_offset is the offset from the start of the header, so
         it may be greater than 8.
-
-        @todo Assumes the field does not extend beyond the packet boundary
         """
-            
         air_assert(self.width >= 0,
                    "Unknown width when extracting field %s" % self.name)
-        byte_offset = header_offset + (bit_offset / 8)
-        bit_offset = bit_offset % 8
-        width = self.width
-
-        # Easy cases:
-        if bit_offset == 0:
-            base = byte_offset
-            if width == 8:
-                self.value = struct.unpack("!B", buf[base:base+1])[0]
-                return self.value
-            elif width == 16:
-                self.value = struct.unpack("!H", buf[base:base+2])[0]
-                return self.value
-            elif width == 32:
-                self.value = struct.unpack("!L", buf[base:base+4])[0]
-                return self.value
-            elif width == 64:
-                self.value = struct.unpack("!Q", buf[base:base+8])[0]
-                return self.value
-            elif width > 64:
-                self.value = bytearray(buf[base: base+width/8])
-                return self.value
-
-        air_assert(width < 64, "Bad field width/offset %d, %d for %s" %
-                   (width, bit_offset, self.name))
-        # Extract bytes into an array
-        # Iterate thru the array accumulating value
-        # Note that bit offsets are from high order of byte
-        bytes_needed = (width + bit_offset + 7) / 8
-        low = header_offset + byte_offset
-        high = low + bytes_needed
-        bytes = bytearray(buf[low:high])
-        value = 0
-        while width > 0:
-            if width + bit_offset <= 8:
-                high_bit = 7 - bit_offset
-                low_bit = high_bit - width + 1
-                val_from_byte = (bytes[0] >> low_bit) & self.BYTE_MASK[width]
-                shift = ((width < 8) and width) or 8
-                value = (value << shift) + val_from_byte
-                break
-            else:
-                if bit_offset == 0:
-                    value = (value << 8) + bytes.pop(0)
-                    width -= 8
-                else:
-                    high_bit = 7 - bit_offset
-                    val_from_byte = bytes.pop(0) & self.BYTE_MASK[high_bit + 1]
-                    width -= (high_bit + 1)
-                    bit_offset = 0
-                    shift = ((width < 8) and width) or 8
-                    value = (value << shift) + val_from_byte
-        self.value = value
-        return value
+        self.value = field_extract(buf, header_offset, bit_offset,
+                                   self.width, self.name)
+        return self.value
 
     def update_header_bytes(self, byte_list, bit_offset):
         """
@@ -143,67 +279,11 @@ class field_instance(object):
         @param bit_offset The bit offset of the field from the start 
         of the header
         """
-
         air_assert(self.width >= 0,
                    "Unknown field width for %s when updating header"
                    % self.name)
+        field_update(byte_list, bit_offset, self.width, self.value, self.name)
 
-        byte_offset = (bit_offset / 8)
-        bit_offset = bit_offset % 8
-        width = self.width
-
-        # Easy cases:
-        if width == 0:
-            return
-
-        # Value is an array of bytes: copy them in 
-        if isinstance(self.value, bytearray):
-            for idx in range(len(self.value)):
-                byte_list[byte_offset + idx] = self.value[idx]
-            return
-
-        # Byte boundary and just bytes
-        # @todo Assumes big endian in the packet
-        value = self.value
-        if bit_offset == 0 and width % 8 == 0:
-            for idx in reversed(range(width / 8)):
-                byte_list[byte_offset + idx] = value & 0xff
-                value >>= 8
-            return
-
-        # Hard cases: Shift value appropriately and convert to bytes
-        # @todo This will have a problem if value << shift overflows
-        bytes_needed = (width + bit_offset + 7) / 8
-
-        shift = 8 - ((bit_offset + width) % 8)
-        if shift == 8: shift = 0
-
-        value <<= shift
-
-        for idx in range(bytes_needed):
-            value_byte = (value >> (8 * (bytes_needed - 1 - idx))) & 0xFF
-            #print "  VAL", value_byte, width, bit_offset
-            if width + bit_offset <= 8: # Fits in this byte and done
-                shift = 8 - (bit_offset + width)
-                mask = self.BYTE_MASK[width] << shift
-                #print "  MASK", mask, byte_offset
-                byte_list[byte_offset + idx] &= ~mask
-                byte_list[byte_offset + idx] |= value_byte
-                # Should be last entry
-                width = 0
-            else: # Goes to end of byte
-                if bit_offset == 0:  # Covers whole byte
-                    # width > 8 by above
-                    byte_list[byte_offset + idx] = value_byte
-                    width -= 8
-                else: # Covers lower bits of byte
-                    # width + bit_offset > 8, so goes to end of byte
-                    mask = self.BYTE_MASK[8 - bit_offset]
-                    byte_list[byte_offset + idx] &= ~mask
-                    byte_list[byte_offset + idx] |= value_byte
-                    width -= (8 - bit_offset)
-                    bit_offset = 0
-        
 ################################################################
 #
 # Test code
@@ -238,6 +318,33 @@ if __name__ == "__main__":
     except IriReferenceError:
         pass
 
+    # Compiled expressions
+    expr = FieldWidthExpr("options", "(ihl * 32) - 160", ["version", "ihl"])
+    air_assert(expr.deps == ("ihl",), "Failed width expr deps")
+    air_assert(expr.width(6) == 32, "Failed width expr eval")
+    air_assert(expr.width(4) == 0, "Failed width expr negative")
+    air_assert(field_width_get("fld", expr, {"ihl" : 7}) == 64,
+               "Failed field_width_get with compiled expr")
+    try:
+        FieldWidthExpr("options", "(len * 32)", ["version", "ihl"])
+        air_assert(False, "Width expr with unknown field should fail")
+    except IriReferenceError:
+        pass
+    expr = FieldWidthExpr("options", "max(ihl * 32 - 160, min(ihl, 8))",
+                          ["version", "ihl"])
+    air_assert(expr.deps == ("ihl",) and expr.width(5) == 5 and
+               expr.width(6) == 32, "Failed width expr with builtins")
+    air_assert(field_width_get("fld", "abs(x) + max(x, 3)", {"x" : -2}) == 5,
+               "Failed width string with builtins")
+    expr = FieldWidthExpr("options", "max * 8", ["max"])
+    air_assert(expr.deps == ("max",) and expr.width(2) == 16,
+               "A field named like a builtin should be a dependency")
+    try:
+        FieldWidthExpr("options", "open('x')", ["version", "ihl"])
+        air_assert(False, "Width expr calling open should fail")
+    except IriReferenceError:
+        pass
+
     # Two VLAN tags w/ IDs 356 and 200; the first has priority 5
     data = struct.pack("BBBBBBBB", 0x81, 0, 0xa1, 0x64, 0x81, 0, 0, 0xc8)
 
@@ -257,7 +364,21 @@ if __name__ == "__main__":
     field.extract(data, 0, 16)
     air_assert(field.value == 5,  "Failed field test 9")
 
-    # @todo Write test cases for fields that are longer byte streams
+    # Unaligned field in a header that does not start the buffer
+    field = field_instance("vid", {}, 12)
+    field.extract(data, 4, 20)
+    air_assert(field.value == 200,  "Failed field test 10")
+
+    # Fields wider than 64 bits
+    field = field_instance("addr", {}, 128)
+    field.extract(bytearray(range(20)), 2, 0)
+    air_assert(field.value == bytearray(range(2, 18)), "Failed wide extract")
+    field = field_instance("unaligned", {}, 70)
+    field.value = (1 << 69) | 5
+    byte_list = bytearray(12)
+    field.update_header_bytes(byte_list, 3)
+    field.extract(byte_list, 0, 3)
+    air_assert(field.value == (1 << 69) | 5, "Failed wide unaligned field")
 
     values = range(16)
     values.extend([0xaaaaaaaa, 0x55555555, 0xffffffff])
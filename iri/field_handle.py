@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+#
+# @file
+# @brief Field handles: field references resolved once to integer slots
+#
+
+import os
+import re
+import sys
+import threading
+
+from air.air_common import *
+from iri_exception import *
+
+_field_ref_re = re.compile(r"^(\w+)(?:\[(\d+|last)\])?(?:\.(\w+))?$")
+_lookahead_re = re.compile(r"^lookahead\(\s*(\d+)\s*,\s*(\d+)\s*\)$")
+
+def field_ref_parse(field_ref):
+    """
+    @brief Split a field reference into its parts
+    @param field_ref A reference of the form hdr, hdr.fld, hdr[index].fld
+    or hdr[index] where index is an integer or "last"
+    @returns A triple (header_name, index, field_name) or None if
+    field_ref is not well formed. index is None if not given, -1 for
+    "last"; field_name is None for a header reference.
+    """
+    match = _field_ref_re.match(field_ref)
+    if match is None:
+        return None
+    (hdr, index, fld) = match.groups()
+    if index == "last":
+        index = -1
+    elif index is not None:
+        index = int(index)
+    return (hdr, index, fld)
+
+class FieldHandle(object):
+    """
+    @brief A field reference resolved to integer positions
+
+    @param ref The field reference string, e.g. "ipv4.ttl"
+    @param header The header (or metadata) name
+    @param slot The header slot assigned by the FieldHandleMap or None
+    if the header name is not known (yet)
+    @param index The header stack index, -1 for last, or None
+    @param field The field name or None for a header reference
+
+    The position of the field in its header is looked up from the
+    header's layout the first time the handle is used and cached with
+    that layout, so each access is a list index rather than a string
+    split and dict lookups. Get handles from FieldHandleMap.handle.
+    """
+    __slots__ = ["ref", "header", "slot", "index", "field", "resolved"]
+
+    def __init__(self, ref, header, slot, index, field):
+        self.ref = ref
+        self.header = header
+        self.slot = slot
+        self.index = index
+        self.field = field
+        self.resolved = (None, None) # (layout, field index in layout)
+
+    def field_index(self, layout):
+        """
+        @brief Return the position of the field in the given layout
+        @param layout The HeaderLayout of the header being accessed
+        @returns The index or None if the field is not in the layout
+        """
+        (cached_layout, idx) = self.resolved
+        if layout is cached_layout:
+            return idx
+        idx = None
+        if layout is not None:
+            idx = layout.field_index.get(self.field, None)
+        # Single assignment so concurrent users see a consistent pair
+        self.resolved = (layout, idx)
+        return idx
+
+    def __repr__(self):
+        return "FieldHandle(%s, slot %s)" % (self.ref, str(self.slot))
+
+class Lookahead(object):
+    """
+    @brief A select source reading bits past the current payload offset
+
+    @param ref The select_value entry, "lookahead(bit_offset, width)"
+    @param bit_offset The offset in bits from the start of the payload
+    (after the headers extracted so far)
+    @param width The number of bits to read (at most 64)
+
+    The bits are read directly from the packet, so selecting on the
+    start of the next header does not create a HeaderInstance.
+    """
+    __slots__ = ["ref", "bit_offset", "width"]
+
+    def __init__(self, ref, bit_offset, width):
+        air_check(0 < width <= 64, IriParamError)
+        self.ref = ref
+        self.bit_offset = bit_offset
+        self.width = width
+
+    def __repr__(self):
+        return "Lookahead(%d, %d)" % (self.bit_offset, self.width)
+
+def lookahead_parse(select_ref):
+    """
+    @brief Return a Lookahead for a select_value entry or None
+    @param select_ref A select_value entry such as "lookahead(0, 4)"
+    """
+    if not isinstance(select_ref, basestring):
+        return None
+    match = _lookahead_re.match(select_ref.strip())
+    if match is None:
+        return None
+    return Lookahead(select_ref, int(match.group(1)), int(match.group(2)))
+
+class FieldHandleMap(object):
+    """
+    @brief Assign header slots and cache field handles
+
+    Each header or metadata name is given a small integer slot; parsed
+    packets keep their headers in a list indexed by slot. Names are
+    normally registered when an IRI instance is loaded; a name seen for
+    the first time later (a dynamically added header) is given the next
+    free slot, so existing handles stay valid.
+
+    A handle may be created for a name that is not registered; for
+    example, action parameters are looked up as possible field refs.
+    Such handles have no slot until the name is added.
+
+    Lookups of known names and handles take no lock; adding a name or
+    a handle is serialized by the map's lock so that a name seen by two
+    threads at once is given one slot.
+    """
+    def __init__(self):
+        self.lock = threading.Lock() # Serializes adding names and handles
+        self.slots = {} # Map from header name to slot
+        self.names = [] # Header name for each slot
+        self.handles = {} # Map from field reference to FieldHandle
+        self.unbound = {} # Map from header name to handles with no slot
+
+    def add_header(self, header_name):
+        """
+        @brief Return the slot for a header name, adding it if needed
+        @param header_name The header or metadata name
+        """
+        slot = self.slots.get(header_name, None)
+        if slot is not None:
+            return slot
+        with self.lock:
+            slot = self.slots.get(header_name, None)
+            if slot is None:
+                slot = len(self.names)
+                self.names.append(header_name)
+                for handle in self.unbound.pop(header_name, []):
+                    handle.slot = slot
+                self.slots[header_name] = slot
+        return slot
+
+    def add_layout(self, layout):
+        """
+        @brief Register the slot for a header layout
+        @param layout A HeaderLayout
+        @returns The slot for the header
+        """
+        return self.add_header(layout.name)
+
+    def handle(self, field_ref):
+        """
+        @brief Return the handle for a field reference
+        @param field_ref A reference as accepted by field_ref_parse
+        @returns A FieldHandle or None if field_ref is not well formed
+
+        Handles are created once per distinct reference and cached.
+        """
+        handle = self.handles.get(field_ref, None)
+        if handle is not None or field_ref in self.handles:
+            return handle
+        with self.lock:
+            if field_ref in self.handles:
+                return self.handles[field_ref]
+            parts = field_ref_parse(field_ref)
+            if parts is not None:
+                (hdr, index, fld) = parts
+                handle = FieldHandle(field_ref, hdr,
+                                     self.slots.get(hdr, None), index, fld)
+                if handle.slot is None:
+                    self.unbound.setdefault(hdr, []).append(handle)
+            self.handles[field_ref] = handle
+        return handle
+
+# @brief The handle map shared by all parsed packets
+#
+# There is one map per process, shared by every IriInstance: a header
+# name has the same slot in all instances, and parsed packets of any
+# instance can be read with any handle. The map is append only; names
+# and handles are added but never removed or renumbered, so handles
+# held by one instance stay valid when another instance is loaded.
+handle_map = FieldHandleMap()
+
+def field_handle(field_ref):
+    """
+    @brief Return the handle for field_ref from the shared handle map
+    """
+    return handle_map.handle(field_ref)
+
+################################################################
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG, filename=sys.argv[1])
+    logging.info("RUNNING MODULE: %s" % __file__)
+
+    from instance import IriInstance
+    from parsed_packet import ParsedPacket
+    # Use the shared map that parsed packets use, not this __main__ copy
+    import field_handle as shared
+
+    air_assert(field_ref_parse("ipv4.ttl") == ("ipv4", None, "ttl"),
+               "Failed parse of field ref")
+    air_assert(field_ref_parse("mpls[last].bos") == ("mpls", -1, "bos"),
+               "Failed parse of stack field ref")
+    air_assert(field_ref_parse("mpls[1]") == ("mpls", 1, None),
+               "Failed parse of stack element ref")
+    air_assert(field_ref_parse("ipv4.ttl + 1") is None,
+               "Malformed ref should not parse")
+
+    local_map = FieldHandleMap()
+    slot = local_map.add_header("ethernet")
+    handle = local_map.handle("ethernet.ethertype")
+    air_assert(handle.slot == slot, "Handle not given header slot")
+    air_assert(local_map.handle("ethernet.ethertype") is handle,
+               "Handle not cached")
+    handle = local_map.handle("ipv4.ttl")
+    air_assert(handle.slot is None, "Unknown header given a slot")
+    air_assert(local_map.add_header("ipv4") == slot + 1,
+               "New header not given next slot")
+    air_assert(handle.slot == slot + 1, "Handle not bound to new slot")
+    air_assert(local_map.handle("ipv4.ttl +") is None, "Bad ref has handle")
+
+    def transmit_packet(out_port, packet):
+        pass
+
+    local_dir = os.path.dirname(os.path.abspath(__file__))
+    iri = IriInstance("instance", local_dir + "/../unit_test.yml",
+                      transmit_packet)
+    ethernet = iri.header_layout["ethernet"]
+    handle = shared.field_handle("ethernet.ethertype")
+    air_assert(handle.field_index(ethernet) ==
+               ethernet.field_index["ethertype"], "Bad field index")
+    handle = shared.field_handle("ethernet.foo")
+    air_assert(handle.field_index(ethernet) is None,
+               "Unknown field has an index")
+
+    byte_buf = bytearray(range(64))
+    byte_buf[12:14] = bytearray([0x08, 0x00])
+    byte_buf[14] = 0x45
+    ppkt = ParsedPacket(byte_buf, iri.metadata_layout)
+    ppkt.parse_header("ethernet", ethernet)
+    ppkt.parse_header("ipv4", iri.header_layout["ipv4"])
+    ttl = shared.field_handle("ipv4.ttl")
+    air_assert(ppkt.get(ttl) == ppkt.get_field("ipv4.ttl") == byte_buf[22],
+               "Handle and string get differ")
+    ppkt.set(ttl, 7)
+    air_assert(ppkt.get_field("ipv4.ttl") == 7, "Failed set by handle")
+    air_assert(ppkt.get(shared.field_handle("ipv4")) is True,
+               "Header not valid")
+    air_assert(ppkt.get(shared.field_handle("vlan_tag_outer.vid")) is None,
+               "Invalid header has value")
+
+    air_assert(ppkt.get(shared.field_handle("not_yet_seen.fld")) is None,
+               "Unknown header has value")
+    # Header added after packets exist gets a slot beyond the packet's list
+    shared.handle_map.add_header("not_yet_seen")
+    air_assert(ppkt.get(shared.field_handle("not_yet_seen.fld")) is None,
+               "Unknown header has value")
+
+    # Handles are shared by instances: a second instance reuses the slots
+    IriInstance("other", local_dir + "/../unit_test.yml", transmit_packet)
+    air_assert(shared.handle_map.slots["ipv4"] == ttl.slot and
+               ppkt.get(ttl) == 7, "Second instance changed a slot")
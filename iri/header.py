@@ -1,22 +1,169 @@
 #!/usr/bin/env python
 #
-# Field class implementation
+# Header layout and instance implementation
 
 import logging
 import sys
 
 from air.air_common import *
 from iri_exception import *
-from field import field_instance, field_width_get
+from field import *
+
+class HeaderLayout(object):
+    """
+    @brief Precompiled layout of a header (or metadata) type
+
+    @param name The name of the header type
+    @param air_header_attrs The header attributes from the IR instance
+
+    A layout is built once per header type when the IRI instance is
+    loaded and is shared by every HeaderInstance of that type. It
+    holds everything about the header that does not depend on packet
+    data so that creating a header instance only needs to read the
+    field values.
+
+    Attributes:
+      * field_names: List of field names in header order
+      * field_index: Map from field name to position in field_names
+      * field_attrs: The AIR attributes for each field
+      * widths: Width in bits of each field; None if given by an expression
+      * width_exprs: The compiled FieldWidthExpr for fields whose width
+        is an expression, otherwise None
+      * width_deps: For expression widths, the positions of the fields the
+        expression depends on (in argument order), otherwise None
+      * bit_offsets: Offset of each field from the start of the header;
+        None for fields that follow a variable width field
+      * structs: A struct.Struct for byte aligned 8/16/32/64 bit fields
+        at fixed offsets, otherwise None
+      * fixed: True if all field widths are constant
+      * bit_length, length: Length of the header if fixed, else None
+      * template: A zeroed bytearray of length bytes if fixed, else None
+      * zero_values: Field values list for an all zeros header
+      * max_depth: The max_depth attribute of the header (default 1)
+      * is_stack: True if max_depth > 1; instances are HeaderStacks
+    """
+    def __init__(self, name, air_header_attrs):
+        self.name = name
+        self.air_header_attrs = air_header_attrs
+        self.type = air_header_attrs["type"]
+        self.max_depth = deref_or_none(air_header_attrs, "max_depth") or 1
+        self.is_stack = self.max_depth > 1
+
+        self.field_names = []
+        self.field_index = {}
+        self.field_attrs = []
+        self.widths = []
+        self.width_exprs = []
+        self.width_deps = []
+        self.bit_offsets = []
+        self.structs = []
+
+        fields = deref_or_none(air_header_attrs, "fields")
+        if not fields:
+            logging.warn("Header %s has no fields" % name)
+            fields = []
+
+        bit_offset = 0
+        for field_map in fields:
+            for field_name, attrs in field_map.items(): # Just one instance
+                self.field_index[field_name] = len(self.field_names)
+                self.field_names.append(field_name)
+                self.field_attrs.append(attrs)
+
+                if isinstance(attrs, dict):
+                    air_assert("width" in attrs.keys(),
+                               "Bad field attrs for %s; no width" % field_name)
+                    width = attrs["width"]
+                else:
+                    width = attrs
+                if isinstance(width, int):
+                    self.width_exprs.append(None)
+                    self.width_deps.append(None)
+                else: # Determined per packet
+                    air_assert(isinstance(width, str),
+                               "Bad width for field %s" % field_name)
+                    expr = FieldWidthExpr(field_name, width,
+                                          self.field_names[:-1])
+                    self.width_exprs.append(expr)
+                    self.width_deps.append(
+                        [self.field_index[dep] for dep in expr.deps])
+                    width = None
+
+                self.widths.append(width)
+                self.bit_offsets.append(bit_offset)
+                if (bit_offset is not None and bit_offset % 8 == 0 and
+                        width in ALIGNED_STRUCTS):
+                    self.structs.append(ALIGNED_STRUCTS[width])
+                else:
+                    self.structs.append(None)
+
+                if bit_offset is not None and width is not None:
+                    bit_offset += width
+                else:
+                    bit_offset = None
+
+        self.fixed = bit_offset is not None
+        if self.fixed:
+            self.bit_length = bit_offset
+            self.length = (bit_offset + 7) / 8
+            self.template = bytearray(self.length)
+        else:
+            self.bit_length = None
+            self.length = None
+            self.template = None
+        self.zero_values = [0] * len(self.field_names)
+
+        logging.debug("Header layout %s: %d fields, %s" %
+                      (name, len(self.field_names),
+                       self.fixed and ("%d bytes" % self.length) or
+                       "variable length"))
+
+def header_layout_get(name, air_header_attrs):
+    """
+    @brief Return a layout for a header
+    @param name The name of the header type
+    @param air_header_attrs Either a HeaderLayout or the AIR header attributes
+
+    If air_header_attrs is already a layout, it is returned. Otherwise
+    a new layout is compiled; callers on the packet path should pass
+    the precompiled layouts held by the IRI instance.
+    """
+    if isinstance(air_header_attrs, HeaderLayout):
+        return air_header_attrs
+    return HeaderLayout(name, air_header_attrs)
 
 class HeaderInstance(object):
     """
     @brief Represent a header or header stack instance for a packet
 
-    @todo Support header stacks
+    The structure of the header is given by a HeaderLayout shared by
+    all instances of the header type. The instance holds the field
+    values (in layout order) and, for variable length headers, the
+    widths and offsets computed for this packet.
+
+    Byte aligned 8/16/32/64 bit fields are unpacked with structs. Other
+    fields are read from the header converted once to an integer
+    (see bits_from_bytes) with a shift and a mask.
+
+    Each field set since the header was created is marked in the dirty
+    bitmask (bit N for field N). Serializing copies the original header
+    bytes once and patches only the dirty fields, so the cost depends on
+    the number of changed fields rather than the size of the header.
+
+    Instances are created for every header of every packet, so the
+    class uses __slots__ and keeps its field values in a list indexed by
+    field position in the layout.
+
+    Header stacks are represented by HeaderStack, each element of which
+    is a HeaderInstance.
 
-    @todo Consider making mutable and immutable versions
+    A header may be shared by replicas of a packet (see
+    ParsedPacket.replicate); shared is then True and the packet
+    modifying the header must first make its own copy with clone().
     """
+    __slots__ = ["name", "byte_buffer", "offset", "length", "bit_length",
+                 "dirty", "resized", "layout", "values", "widths",
+                 "bit_offsets", "original_bits", "shared"]
 
     # Constant null header used for uninitialized headers
     # Assume header is at most max packet size of 12K
@@ -24,28 +171,39 @@ class HeaderInstance(object):
     empty_byte_array = bytearray(MAX_PACKET_BYTES)
 
     def __init__(self, name, air_header_attrs, byte_buffer=None, 
-                 offset=0, length=None):
+                 offset=0, length=None, lazy=False, shape=None):
         """
         @param name The name of the instance
-        @param air_header_attrs The header attributes from the IR instance. If None,
-        indicates this is an opaque block of bytes with no field structure
+        @param air_header_attrs The HeaderLayout for the header or the
+        header attributes from the IR instance. If None, indicates this is
+        an opaque block of bytes with no field structure
         @param byte_buffer A bytearray from a packet 
         @param offset The byte offset in byte_buffer where the header starts
         @param length Force the length when air_header_attrs is None or when length
         is determined externally.
+        @param lazy If True, field values are only read from byte_buffer
+        when first accessed. Otherwise all fields are read on creation.
+        @param shape For a variable length header, the shape of another
+        instance with the same values in the fields its widths depend
+        on; the widths are then not computed (see shape)
         """
 
         logging.debug("Adding hdr %s" % name)
         self.name = name
-        self.air_header_attrs = air_header_attrs
 
         self.byte_buffer = byte_buffer
         self.offset = offset # The offset in the buffer where the header starts
         self.length = 0
         self.bit_length = 0
 
-        self.modified = False # Have field values changed?
-        self.fields = ListDict()
+        self.dirty = 0 # Bitmask of fields whose values have been set
+        self.resized = False # Has the width of some field changed?
+        self.layout = None
+        self.values = [] # None for fields not yet read from byte_buffer
+        self.widths = []
+        self.bit_offsets = []
+        self.original_bits = None # Original header bytes as an integer
+        self.shared = False # Referenced by more than one packet
 
         # Resolve initial value
         if byte_buffer:
@@ -53,60 +211,223 @@ class HeaderInstance(object):
         else: # Use all zeros for initial parsing
             self.byte_buffer = HeaderInstance.empty_byte_array
 
-        # Iterate thru fields, getting bit-width of each
         if not air_header_attrs: # Opaque block header
             air_check(length is not None, IriParamError)
             self.length = length
             return
 
-        # @FIXME: 
-        # self.is_stack = ("max_depth" in air_header_attrs.keys() and
-        #                  air_header_attrs["max_depth"] > 1)
+        self.layout = header_layout_get(name, air_header_attrs)
 
-        # Parse header from data
-        field_values = {} # Holds integer values for fields for width calc
-        bit_offset = 0 # Offset of "current" field in the header
+        if self.layout.fixed:
+            self._extract_fixed(lazy)
+        elif shape is not None:
+            self._extract_shaped(shape, lazy)
+        else:
+            self._extract_variable(lazy)
 
-        # Keep track of remaining length of header if already known
+        if length and length != self.length:
+            logging.warn("Header %s length %d != passed length %d" %
+                         (name, self.length, length))
 
-        if length:
-            remaining_bits = length * 8
-        else:
-            remaining_bits = None
+        if self.length != self.bit_length / 8:
+            logging.info("Added padding to header %s; bit length was %d" %
+                         (self.name, self.bit_length))
 
-        # Parse the header according to its IR description
-        for field_map in self.air_header_attrs["fields"]:
-            for field_name, attrs in field_map.items(): # Just one instance
-                # First, get the width in case it depends on the values
-                # of other fields already parsed.
-                width = field_width_get(field_name, attrs, field_values, 
-                                        remaining_bits)
-                field = field_instance(field_name, attrs, width)
-                field.extract(self.byte_buffer, self.offset, bit_offset)
+    def clone(self):
+        """
+        @brief Return a copy of the header that can be modified separately
 
-                bit_offset += width
-                if remaining_bits:
-                    remaining_bits -= width
+        The byte buffer, layout and width/offset lists are shared (the
+        lists are replaced, not changed, when a field is resized); only
+        the list of field values is copied.
+        """
+        header = HeaderInstance.__new__(HeaderInstance)
+        for attr in HeaderInstance.__slots__:
+            setattr(header, attr, getattr(self, attr))
+        header.values = list(self.values)
+        header.shared = False
+        return header
+
+    @property
+    def modified(self):
+        """
+        @brief True if any field value has been set
+        """
+        return self.dirty != 0 or self.resized
 
-                self.fields[field_name] = field
-                if isinstance(field.value, int):
-                    field_values[field_name] = field.value
+    @property
+    def air_header_attrs(self):
+        """
+        @brief The AIR attributes of the header; None for an opaque block
+        """
+        if self.layout is None:
+            return None
+        return self.layout.air_header_attrs
+
+    def memory_size(self):
+        """
+        @brief Approximate number of bytes used by this header instance
+
+        Counts the instance and the containers it owns. The byte buffer
+        and the layout (including widths and offsets shared with the
+        layout) are not counted.
+        """
+        size = sys.getsizeof(self) + sys.getsizeof(self.values)
+        if self.layout is not None:
+            if self.widths is not self.layout.widths:
+                size += sys.getsizeof(self.widths)
+            if self.bit_offsets is not self.layout.bit_offsets:
+                size += sys.getsizeof(self.bit_offsets)
+        if self.original_bits is not None:
+            size += sys.getsizeof(self.original_bits)
+        for value in self.values:
+            if isinstance(value, (long, bytearray)):
+                size += sys.getsizeof(value)
+        return size
+
+    def _header_bits(self):
+        """
+        @brief Return the original bytes of the header as an integer
+
+        The conversion is done at most once per header instance.
+        """
+        if self.original_bits is None:
+            self.original_bits = bits_from_bytes(self.byte_buffer, self.offset,
+                                                 self.offset + self.length)
+        return self.original_bits
+
+    def _decode(self, idx):
+        """
+        @brief Read the value of a field from the byte buffer
+        @param idx The position of the field in the layout
+        @returns The value of the field
+        """
+        st = self.layout.structs[idx]
+        width = self.widths[idx]
+        if st is not None:
+            value = st.unpack_from(self.byte_buffer,
+                                   self.offset + self.bit_offsets[idx] / 8)[0]
+        elif self.bit_length and width <= 64:
+            value = bits_get(self._header_bits(), self.length * 8,
+                             self.bit_offsets[idx], width)
+        else: # Header length not yet known or wide field
+            value = field_extract(self.byte_buffer, self.offset,
+                                  self.bit_offsets[idx], width,
+                                  self.layout.field_names[idx])
+        self.values[idx] = value
+        return value
+
+    def _decode_all(self):
+        """
+        @brief Read any fields whose values have not been read yet
+        """
+        for idx, value in enumerate(self.values):
+            if value is None:
+                self._decode(idx)
+
+    def _extract_fixed(self, lazy):
+        """
+        @brief Set up the field values for a header with constant widths
+        @param lazy If True, do not read any field values yet
+        """
+        layout = self.layout
+        self.widths = layout.widths
+        self.bit_offsets = layout.bit_offsets
+        self.bit_length = layout.bit_length
+        self.length = layout.length
+        if lazy:
+            self.values = [None] * len(layout.field_names)
+            return
+
+        buf = self.byte_buffer
+        offset = self.offset
+        total_bits = self.length * 8
+        bits = None
+        values = []
+        for idx, st in enumerate(layout.structs):
+            if st is not None:
+                values.append(
+                    st.unpack_from(buf, offset + layout.bit_offsets[idx] / 8)[0])
+            elif layout.widths[idx] <= 64:
+                if bits is None:
+                    bits = self._header_bits()
+                values.append(bits_get(bits, total_bits,
+                                       layout.bit_offsets[idx],
+                                       layout.widths[idx]))
+            else:
+                values.append(field_extract(buf, offset,
+                                            layout.bit_offsets[idx],
+                                            layout.widths[idx],
+                                            layout.field_names[idx]))
+        self.values = values
+
+    def _extract_variable(self, lazy):
+        """
+        @brief Set up the field values for a header with expression widths
+        @param lazy If True, only read the fields needed to compute widths
+        """
+        layout = self.layout
+        bit_offset = 0 # Offset of "current" field in the header
+
+        self.values = [None] * len(layout.field_names)
+        self.widths = []
+        self.bit_offsets = []
+        for idx, field_name in enumerate(layout.field_names):
+            # First, get the width in case it depends on the values
+            # of other fields already parsed.
+            width = layout.widths[idx]
+            if width is None:
+                dep_values = []
+                for dep_idx in layout.width_deps[idx]:
+                    value = self.values[dep_idx]
+                    if value is None:
+                        value = self._decode(dep_idx)
+                    dep_values.append(value)
+                width = layout.width_exprs[idx].width(*dep_values)
+            self.widths.append(width)
+            self.bit_offsets.append(bit_offset)
+            bit_offset += width
 
         self.bit_length = bit_offset
         self.length = (bit_offset + 7) / 8
-        if length and length != self.length:
-            logging.warn("Header %s length %d != passed length %d" %
-                         (name, self.length, length))
+        if not lazy:
+            self._decode_all()
 
-        if self.length != bit_offset / 8:
-            logging.info("Added padding to header %s; bit length was %d" %
-                         (self.name, bit_offset))
+    @property
+    def shape(self):
+        """
+        @brief The field widths and offsets of a variable length header
+        @returns (widths, bit_offsets, bit_length) or None if the header
+        has constant widths (or no layout)
+
+        The lists are shared, not copied; they are replaced rather than
+        changed when a field is resized.
+        """
+        if self.layout is None or self.layout.fixed:
+            return None
+        return (self.widths, self.bit_offsets, self.bit_length)
 
-    def length(self):
+    def _extract_shaped(self, shape, lazy):
         """
-        Return the length of the header instance in bytes
+        @brief Set up a variable length header whose widths are known
+        @param shape The shape of a header with the same width fields
+        @param lazy If True, do not read any field values yet
         """
-        return self.length
+        (self.widths, self.bit_offsets, self.bit_length) = shape
+        self.length = (self.bit_length + 7) / 8
+        self.values = [None] * len(self.layout.field_names)
+        if not lazy:
+            self._decode_all()
+
+    def get_value(self, idx):
+        """
+        @brief Get the value of a field by its position in the layout
+        @param idx The index of the field in layout.field_names
+        """
+        value = self.values[idx]
+        if value is None:
+            value = self._decode(idx)
+        return value
 
     def get_field(self, field_name):
         """
@@ -117,10 +438,9 @@ class HeaderInstance(object):
 
         Does no error checking; returns 0 if field is not valid
         """
-        if not self.fields or field_name not in self.fields.keys():
+        if not self.layout or field_name not in self.layout.field_index:
             return 0
-
-        return self.fields[field_name].value
+        return self.get_value(self.layout.field_index[field_name])
 
     def set_field(self, field_name, value, width=None):
         """
@@ -132,37 +452,240 @@ class HeaderInstance(object):
         @returns The new value of the field
         The value may be an integer or a byte array
         """
-        if field_name not in self.fields.keys():
+        if not self.layout or field_name not in self.layout.field_index:
             return None
-        if type(value) not in [int, bytearray]:
+        return self.set_value(self.layout.field_index[field_name], value,
+                              width)
+
+    def set_value(self, idx, value, width=None):
+        """
+        @brief Set the value of a field by its position in the layout
+        @param idx The index of the field in layout.field_names
+        @param value The value to use; an integer or a byte array
+        @param width (Optional) New width of the field
+
+        @returns The new value of the field or None if value is not valid
+        """
+        if type(value) not in [int, long, bytearray]:
             return None
 
-        if width:
-            if width != field.width:
-                logging.debug("Changing header width for %s, fld %s" %
-                              (self.name, field_name))
-                diff = width - field.width
-                self.bit_length += diff
-                self.length = (self.bit_offset + 7) / 8
-                field.resize(width)
-                
-        self.fields[field_name].value = value
-        self.modified = True
+        if width and width != self.widths[idx]:
+            logging.debug("Changing header width for %s, fld %s" %
+                          (self.name, self.layout.field_names[idx]))
+            # Field positions no longer match the byte buffer
+            self._decode_all()
+            self.resized = True
+            # Widths and offsets are now specific to this instance
+            self.widths = list(self.widths)
+            self.widths[idx] = width
+            self.bit_offsets = list(self.bit_offsets)
+            bit_offset = self.bit_offsets[idx]
+            for fld_idx in range(idx, len(self.widths)):
+                self.bit_offsets[fld_idx] = bit_offset
+                bit_offset += self.widths[fld_idx]
+            self.bit_length = bit_offset
+            self.length = (bit_offset + 7) / 8
+
+        self.values[idx] = value
+        self.dirty |= 1 << idx
         return value
 
     def serialize(self):
         """
         @brief Generate a byte array representing the header
+
+        Only fields that have been set are written; all other bits are
+        copied from the byte buffer unchanged. If a field width changed,
+        the whole header is rebuilt from the field values.
         """
-        if not self.modified:
-            return self.byte_buffer[self.offset:self.offset + self.length]
+        if self.resized:
+            return self._serialize_all()
+        byte_list = self.byte_buffer[self.offset:self.offset + self.length]
+        dirty = self.dirty
+        structs = self.layout and self.layout.structs
+        while dirty:
+            low_bit = dirty & -dirty
+            dirty ^= low_bit
+            idx = low_bit.bit_length() - 1
+            width = self.widths[idx]
+            value = self.values[idx]
+            if structs[idx] is not None:
+                structs[idx].pack_into(byte_list, self.bit_offsets[idx] / 8,
+                                       value & ((1 << width) - 1))
+            else:
+                field_update(byte_list, self.bit_offsets[idx], width, value,
+                             self.layout.field_names[idx])
+        return byte_list
 
-        # Otherwise, create a byte array with current field values
-        byte_list = bytearray(self.length)
-        bit_offset = 0
-        for field_name, field in self.fields.items():
-            field.update_header_bytes(byte_list, bit_offset)
-            bit_offset += field.width
+    def _serialize_all(self):
+        """
+        @brief Rebuild the header bytes from all field values
+        """
+        total_bits = self.length * 8
+        bits = 0
+        for idx, value in enumerate(self.values):
+            if isinstance(value, bytearray):
+                value = bits_from_bytes(value, 0, len(value))
+            bits = bits_set(bits, total_bits, self.bit_offsets[idx],
+                            self.widths[idx], value)
+        return bits_to_bytes(bits, self.length)
+
+class HeaderStack(object):
+    """
+    @brief Represent a header stack instance for a packet
+
+    @param name The name of the header stack
+    @param layout The HeaderLayout for the elements of the stack
+
+    A stack has max_depth preallocated slots used as a ring buffer, so
+    elements can be pushed or popped at either end in constant time
+    without moving the other elements. Each element is a HeaderInstance.
+
+    Element 0 is the front of the stack (first in the packet); index -1
+    refers to the last element. Unindexed field accesses refer to the
+    last element, which is the one most recently extracted by the parser.
+
+    Attributes:
+      * current_count: The number of elements in the stack
+      * length: The total length in bytes of all elements
+    """
+    __slots__ = ["name", "layout", "max_depth", "slots", "first",
+                 "current_count", "length", "shared"]
+
+    def __init__(self, name, layout):
+        self.name = name
+        self.layout = layout
+        self.max_depth = layout.max_depth
+        self.slots = [None] * self.max_depth
+        self.first = 0 # Slot of element 0
+        self.current_count = 0
+        self.length = 0
+        self.shared = False # Referenced by more than one packet
+
+    def clone(self):
+        """
+        @brief Return a copy of the stack that can be modified separately
+
+        The elements are not copied; they are marked shared in both
+        stacks and copied when written (see set_element).
+        """
+        stack = HeaderStack.__new__(HeaderStack)
+        for attr in HeaderStack.__slots__:
+            setattr(stack, attr, getattr(self, attr))
+        stack.slots = list(self.slots)
+        stack.shared = False
+        for header in stack.elements():
+            header.shared = True
+        return stack
+
+    def element(self, index):
+        """
+        @brief Return an element of the stack
+        @param index The element index; -1 for the last element
+        @returns The HeaderInstance or None if index is out of range
+        """
+        if index < 0:
+            index += self.current_count
+        if index < 0 or index >= self.current_count:
+            return None
+        return self.slots[(self.first + index) % self.max_depth]
+
+    def set_element(self, index, header):
+        """
+        @brief Replace an existing element of the stack
+        @param index The element index; -1 for the last element
+        @param header The HeaderInstance to store; must have the same
+        length as the element it replaces
+        @returns header
+        """
+        if index < 0:
+            index += self.current_count
+        air_check(0 <= index < self.current_count, IriPacketModError)
+        self.slots[(self.first + index) % self.max_depth] = header
+        return header
+
+    def elements(self):
+        """
+        @brief Return the list of elements, front to back
+        """
+        return [self.slots[(self.first + idx) % self.max_depth]
+                for idx in range(self.current_count)]
+
+    def push(self, header, back=True):
+        """
+        @brief Add an element to the stack
+        @param header The HeaderInstance to add
+        @param back If True, add to the back of the stack; otherwise
+        to the front
+
+        Raises IriPacketModError if the stack is full
+        """
+        if self.current_count >= self.max_depth:
+            raise IriPacketModError("Header stack %s overflow" % self.name)
+        if back:
+            slot = (self.first + self.current_count) % self.max_depth
+        else:
+            self.first = (self.first - 1) % self.max_depth
+            slot = self.first
+        self.slots[slot] = header
+        self.current_count += 1
+        self.length += header.length
+
+    def pop(self, back=True):
+        """
+        @brief Remove an element from the stack
+        @param back If True, remove the last element; otherwise the first
+        @returns The HeaderInstance removed
+
+        Raises IriPacketModError if the stack is empty
+        """
+        if self.current_count == 0:
+            raise IriPacketModError("Header stack %s underflow" % self.name)
+        if back:
+            slot = (self.first + self.current_count - 1) % self.max_depth
+        else:
+            slot = self.first
+            self.first = (self.first + 1) % self.max_depth
+        header = self.slots[slot]
+        self.slots[slot] = None
+        self.current_count -= 1
+        self.length -= header.length
+        return header
+
+    def get_field(self, field_name):
+        """
+        @brief Get a field from the last element of the stack
+        """
+        header = self.element(-1)
+        if header is None:
+            return None
+        return header.get_field(field_name)
+
+    def set_field(self, field_name, value, width=None):
+        """
+        @brief Set a field in the last element of the stack
+        """
+        header = self.element(-1)
+        if header is None:
+            return None
+        return header.set_field(field_name, value, width)
+
+    def memory_size(self):
+        """
+        @brief Approximate number of bytes used by the stack and elements
+        """
+        size = sys.getsizeof(self) + sys.getsizeof(self.slots)
+        for header in self.elements():
+            size += header.memory_size()
+        return size
+
+    def serialize(self):
+        """
+        @brief Generate a byte array for all elements, front to back
+        """
+        byte_list = bytearray()
+        for header in self.elements():
+            byte_list += header.serialize()
         return byte_list
 
 if __name__ == "__main__":
@@ -192,3 +715,137 @@ if __name__ == "__main__":
     expected[12] = 0xff
     expected[13] = 0xff
     air_assert(bytes == expected, "Failed serialize bytes after modify")
+
+    # Instances created from a shared layout
+    layout = HeaderLayout("hdr", hdr_dict)
+    air_assert(layout.fixed and layout.length == 14, "Bad layout length")
+    air_assert(layout.structs[2] is not None, "Ethertype should use a struct")
+    buf = bytearray(range(100))
+    hdr_a = HeaderInstance("hdr", layout, buf)
+    hdr_b = HeaderInstance("hdr", layout, buf, offset=14)
+    air_assert(hdr_a.layout is hdr_b.layout, "Layout should be shared")
+    air_assert(hdr_a.get_field("ethertype") == 0x0c0d, "Failed layout get")
+    air_assert(hdr_b.get_field("ethertype") == 0x1a1b, "Failed offset get")
+    air_assert(hdr_b.serialize() == buf[14:28], "Failed offset serialize")
+
+    # Unaligned and variable width fields at a non-zero offset
+    ip_dict = {
+        "type" : "header",
+        "fields" :
+        [
+            {"version" : 4},
+            {"ihl" : 4},
+            {"tos" : 8},
+            {"options" : "(ihl * 32) - 32"},
+        ]
+    }
+    ip_layout = HeaderLayout("ip", ip_dict)
+    air_assert(not ip_layout.fixed, "Options should make layout variable")
+    buf = bytearray(40)
+    buf[10] = 0x42 # version 4, ihl 2
+    buf[11] = 0x17
+    buf[12:16] = bytearray([1, 2, 3, 4])
+    hdr = HeaderInstance("ip", ip_layout, buf, offset=10)
+    air_assert(hdr.get_field("version") == 4, "Failed unaligned get")
+    air_assert(hdr.get_field("ihl") == 2, "Failed unaligned get")
+    air_assert(hdr.length == 6, "Failed variable length")
+    air_assert(hdr.get_field("options") == 0x01020304, "Failed options get")
+    hdr.set_field("tos", 0x18)
+    air_assert(hdr.serialize() == bytearray([0x42, 0x18, 1, 2, 3, 4]),
+               "Failed variable header serialize")
+
+    # Lazy mode only reads fields on access
+    buf = bytearray(range(100))
+    hdr = HeaderInstance("hdr", layout, buf, offset=14, lazy=True)
+    air_assert(hdr.values == [None, None, None], "Lazy header read fields")
+    air_assert(hdr.get_field("ethertype") == 0x1a1b, "Failed lazy get")
+    air_assert(hdr.values[0] is None, "Lazy header read unaccessed field")
+    hdr.set_field("src_mac", 0x0102)
+    expected = bytearray(buf[14:28])
+    expected[6:12] = bytearray([0, 0, 0, 0, 1, 2])
+    air_assert(hdr.serialize() == expected, "Failed lazy serialize")
+
+    buf = bytearray(40)
+    buf[10:16] = bytearray([0x42, 0x17, 1, 2, 3, 4])
+    hdr = HeaderInstance("ip", ip_layout, buf, offset=10, lazy=True)
+    air_assert(hdr.length == 6, "Failed lazy variable length")
+    air_assert(hdr.values[3] is None, "Lazy header read options")
+    air_assert(hdr.get_field("options") == 0x01020304, "Failed lazy options")
+    air_assert(hdr.values[0] is None, "Lazy header read unneeded version")
+
+    # A variable length header given the shape of one with the same ihl
+    # reads no fields to find its widths
+    buf[20:26] = bytearray([0x42, 0x18, 5, 6, 7, 8])
+    shaped = HeaderInstance("ip", ip_layout, buf, offset=20, lazy=True,
+                            shape=hdr.shape)
+    air_assert(shaped.length == 6 and shaped.values == [None] * 4,
+               "Shaped header read fields")
+    air_assert(shaped.get_field("options") == 0x05060708,
+               "Failed shaped options")
+    air_assert(HeaderInstance("hdr", layout).shape is None,
+               "Fixed header has a shape")
+
+    # Bad width expressions are rejected when the layout is compiled
+    for bad_width in ["(ihl * 32", "(len * 32) - 32", "(options * 8)"]:
+        bad_dict = {"type" : "header",
+                    "fields" : [{"ihl" : 4}, {"options" : bad_width}]}
+        try:
+            HeaderLayout("bad", bad_dict)
+            air_assert(False, "Bad width %s should fail" % bad_width)
+        except IriReferenceError:
+            pass
+
+    # Only dirty fields are written on serialize
+    buf = bytearray(range(100))
+    hdr = HeaderInstance("hdr", layout, buf, offset=14)
+    air_assert(not hdr.modified and hdr.dirty == 0, "New header is dirty")
+    hdr.values[0] = 0 # Not set via set_field; must not be written
+    hdr.set_field("ethertype", 0x10000 - 1)
+    air_assert(hdr.dirty == 1 << 2, "Bad dirty mask after set")
+    expected = bytearray(buf[14:28])
+    expected[12:14] = bytearray([0xff, 0xff])
+    air_assert(hdr.serialize() == expected, "Failed dirty serialize")
+
+    # Unaligned dirty field
+    buf = bytearray(40)
+    buf[10:16] = bytearray([0x42, 0x17, 1, 2, 3, 4])
+    hdr = HeaderInstance("ip", ip_layout, buf, offset=10)
+    hdr.set_field("ihl", 5)
+    air_assert(hdr.serialize() == bytearray([0x45, 0x17, 1, 2, 3, 4]),
+               "Failed unaligned dirty serialize")
+
+    # Header stacks
+    mpls_dict = {
+        "type" : "header",
+        "max_depth" : 3,
+        "fields" : [{"label" : 20}, {"tc" : 3}, {"bos" : 1}, {"ttl" : 8}]
+    }
+    mpls_layout = HeaderLayout("mpls", mpls_dict)
+    air_assert(mpls_layout.is_stack, "max_depth 3 should be a stack")
+    buf = bytearray([0, 0x01, 0x00, 0x40, 0, 0x02, 0x01, 0x40])
+    stack = HeaderStack("mpls", mpls_layout)
+    stack.push(HeaderInstance("mpls", mpls_layout, buf, 0))
+    stack.push(HeaderInstance("mpls", mpls_layout, buf, 4))
+    air_assert(stack.current_count == 2 and stack.length == 8,
+               "Bad stack count/length")
+    air_assert(stack.element(0).get_field("label") == 0x10,
+               "Failed stack element 0 label")
+    air_assert(stack.get_field("bos") == 1, "Failed last element bos")
+    stack.push(HeaderInstance("mpls", mpls_layout), back=False)
+    air_assert(stack.element(0).get_field("label") == 0,
+               "Failed push front")
+    try:
+        stack.push(HeaderInstance("mpls", mpls_layout))
+        air_assert(False, "Push on full stack should fail")
+    except IriPacketModError:
+        pass
+    air_assert(stack.pop(back=False).get_field("label") == 0,
+               "Failed pop front")
+    air_assert(stack.serialize() == buf, "Failed stack serialize")
+    stack.pop()
+    stack.pop()
+    try:
+        stack.pop()
+        air_assert(False, "Pop on empty stack should fail")
+    except IriPacketModError:
+        pass
@@ -16,19 +16,35 @@ import logging
 
 from air.air_instance import AirInstance
 from parser import Parser
+from parser_codegen import parser_codegen
+from liveness import Liveness
 from air.air_common import *
 from pipeline import Pipeline
 from parser import Parser
 from processor import Processor
 from table import Table
 from action import Action
-from parsed_packet import ParsedPacket
+from parsed_packet import ParsedPacket, ParsedPacketPool, metadata_template
+from header import HeaderLayout
+from field_handle import handle_map, field_handle
 from simple_queue import SimpleQueueManager
+from value_set import ValueSet
 import table_entry
 
 def hexify(buf, length):
     return ":".join(["%02x" % c for c in buf])
 
+def log_packet_bytes(buf):
+    """
+    @brief Log a hex dump of a packet buffer if debug logging is enabled
+    @param buf A bytearray (or memoryview) with the packet data
+    """
+    if not logging.getLogger().isEnabledFor(logging.DEBUG):
+        return
+    buf = bytearray(buf)
+    for idx in range((len(buf) + 19)/20):
+        logging.debug(hexify(buf[20*idx : 20*(idx+1)], 20))
+
 class IriInstance(AirInstance):
     """
     @brief An Intermediate Representation configuration instance
@@ -39,11 +55,36 @@ class IriInstance(AirInstance):
     @param iri_pipeline A map from control flow name to a pipeline object. 
     This combines control flow with tables and actions
     @param iri_traffic_manager A map from TM name to TM object
+    @param header_layout A map from header and metadata name to the
+    precompiled HeaderLayout shared by all instances of the header
+    @param metadata_layout The subset of header_layout for metadata
+    @param metadata_template Zeroed metadata headers cloned into each
+    packet (see parsed_packet.metadata_template)
+    @param packet_pool If not None, the ParsedPacketPool from which
+    packets are allocated
     @param disabled Is the switch instance forwarding packets
     @param processors Map from processor name to processor object; these
     include parsers, pipelines and traffic managers.
     @param table_initialization The set of table entries to add during
     initialization 
+    @param parse_mode How header fields are decoded when packets are
+    parsed: "eager" reads every field, "lazy" reads fields on first access,
+    "minimal" reads every field of the headers that processing can read
+    and keeps other headers as opaque bytes (see liveness.py)
+    @param liveness The Liveness analysis of the instance
+    @param transmit_segments If True, the transmit handler is passed a
+    list of buffer segments (see ParsedPacket.serialize_segments) for a
+    gather write instead of a single bytearray
+    @param pool_size If non-zero, allocate packets from a ParsedPacketPool
+    keeping up to this many released packets for reuse
+    @param generate_parsers If True, each parser runs Python code generated
+    from its parse graph (see parser_codegen.py) instead of interpreting
+    its parse states
+    @param parse_cache_size If non-zero, each parser caches the results
+    of parsing up to this many flows (see parse_cache.py)
+    @param table_index Map from table name to the name of the index the
+    table uses in place of the one chosen from its match types (see
+    table_index.py)
     
 
     An IR instance extends the AIR instance and additionally instantiates
@@ -64,13 +105,27 @@ class IriInstance(AirInstance):
     method should be called. Then the enable method can be called.
     """
 
-    def __init__(self, name, input, transmit_handler):
+    # Supported values for parse_mode
+    parse_modes = ["eager", "lazy", "minimal"]
+
+    def __init__(self, name, input, transmit_handler, parse_mode="eager",
+                 transmit_segments=False, pool_size=0,
+                 generate_parsers=False, parse_cache_size=0,
+                 table_index=None):
         """
         @brief IriInstance constructor
 
         @param name The name of the instance
         @param input An object with the YAML description of the IR instance
         @param transmit_handler A function to be called to transmit pkts
+        @param parse_mode One of parse_modes; see class description
+        @param transmit_segments Pass segment lists to transmit_handler
+        @param pool_size Maximum number of released packets kept for reuse;
+        0 disables the packet pool
+        @param generate_parsers Use generated code for parsers
+        @param parse_cache_size Maximum number of cached parse results per
+        parser; 0 disables the parse cache
+        @param table_index Map from table name to index type
 
         @todo Add support to allow the specification of the AIR instance
         """
@@ -78,6 +133,9 @@ class IriInstance(AirInstance):
 
         self.transmit_handler = transmit_handler
         self.name = name
+        air_assert(parse_mode in IriInstance.parse_modes,
+                   "Unknown parse mode %s" % str(parse_mode))
+        self.parse_mode = parse_mode
 
         self.tm_started = False
         self.disabled = True
@@ -95,22 +153,51 @@ class IriInstance(AirInstance):
         self.iri_pipeline = {}
         self.iri_traffic_manager = {}
         self.processors = {}
-        self.transmit_processor = TransmitProcessor(transmit_handler)
+        self.transmit_processor = TransmitProcessor(transmit_handler,
+                                                    transmit_segments)
+
+        # Compile header layouts once; they are shared by all packets
+        self.header_layout = {}
+        self.metadata_layout = {}
+        for name, val in self.header.items():
+            self.header_layout[name] = HeaderLayout(name, val)
+        for name, val in self.metadata.items():
+            self.metadata_layout[name] = HeaderLayout(name, val)
+            self.header_layout[name] = self.metadata_layout[name]
+        self.metadata_template = metadata_template(self.metadata_layout)
+        self.packet_pool = None
+        if pool_size:
+            self.packet_pool = ParsedPacketPool(self.metadata_template,
+                                                pool_size)
+        # Assign header slots up front so packets size their slot lists once
+        for layout in self.header_layout.values():
+            handle_map.add_layout(layout)
 
         for name, val in self.value_set.items():
-            self.iri_value_set[name] = [] # Just use a list
+            self.iri_value_set[name] = ValueSet(name, val)
 
         for name, val in self.value_map.items():
             self.iri_value_map[name] = {} # Just use a dict
 
         for name, val in self.parser.items():
             self.iri_parser[name] = Parser(name, val, self.parse_state,
-                                           self.header, self.value_set)
+                                           self.header_layout,
+                                           self.iri_value_set)
             self.processors[name] = self.iri_parser[name]
         for name, val in self.action.items():
             self.iri_action[name] = Action(name, val)
         for name, val in self.table.items():
-            self.iri_table[name] = Table(name, val, self.iri_action)
+            self.iri_table[name] = Table(name, val, self.iri_action,
+                                         self.header_layout,
+                                         (table_index or {}).get(name, None))
+
+        self.liveness = Liveness(self)
+        for name, parser in self.iri_parser.items():
+            if parse_mode == "minimal":
+                parser.set_opaque_headers(self.liveness.dead_headers)
+            if generate_parsers:
+                parser_codegen(parser)
+            parser.enable_parse_cache(parse_cache_size)
         for name, val in self.control_flow.items():
             self.iri_pipeline[name] = Pipeline(name, val, self.iri_table,
                                                self.iri_action)
@@ -205,17 +292,25 @@ class IriInstance(AirInstance):
         """
         @param in_port The ingress port number on which packet arrived
         @param packet A bytearray with the packet data
+
+        If packet is a bytearray it is used in place and not copied;
+        otherwise (e.g. a string from the dataplane) it is converted once.
         """
-            
-        buf = bytearray(packet)
-        for idx in range((len(packet) + 19)/20):
-            logging.debug(hexify(buf[20*idx : 20*(idx+1)], 20))
+        if isinstance(packet, bytearray):
+            buf = packet
+        else:
+            buf = bytearray(packet)
+        log_packet_bytes(buf)
 
         if self.disabled:
             logging.debug("Switch is disabled; discarding packet")
             return
 
-        parsed_packet = ParsedPacket(buf, self.metadata)
+        lazy = (self.parse_mode == "lazy")
+        if self.packet_pool is not None:
+            parsed_packet = self.packet_pool.get(buf, lazy)
+        else:
+            parsed_packet = ParsedPacket(buf, self.metadata_template, lazy)
         logging.debug("Processing packet %d from port %d with %s" % 
                       (parsed_packet.id, in_port,
                        self.first_processor.name))
@@ -225,17 +320,24 @@ class IriInstance(AirInstance):
         """
         @brief Transmit handler template for documentation
         @param out_port The port number to which the packet is to be sent
-        @param packet A bytearray object holding the packet to transmit
+        @param packet A bytearray object holding the packet to transmit,
+        or a list of buffers if the instance uses transmit_segments
         """
         pass
 
+egress_port_handle = field_handle("intrinsic_metadata.egress_port")
+
 class TransmitProcessor(Processor):
     """
     @brief Wrapper class to connect processing with transmitting packets
     @param transmit_handler A function that knows how to send a packet to a port
+    @param segments If True, pass the handler the list of buffer segments
+    from ParsedPacket.serialize_segments so it can do a gather write;
+    otherwise pass one bytearray (the segments joined once)
     """
-    def __init__(self, transmit_handler):
+    def __init__(self, transmit_handler, segments=False):
         self.transmit_handler = transmit_handler
+        self.segments = segments
         self.name = "transmit_processor"
 
     def process(self, parsed_packet):
@@ -243,14 +345,19 @@ class TransmitProcessor(Processor):
         @brief Process interface that sends a packet
         @param parsed_packet The packet instance to transmit
         """
-        byte_buf = parsed_packet.serialize()
-        out_port= parsed_packet.get_field("intrinsic_metadata.egress_port")
+        segments = parsed_packet.serialize_segments()
+        out_port = parsed_packet.get(egress_port_handle)
         logging.debug("Transmit pkt id %d to %d" % (parsed_packet.id, out_port))
-        buf = bytearray(byte_buf)
-        for idx in range((len(buf) + 19)/20):
-            logging.debug(hexify(buf[20*idx : 20*(idx+1)], 20))
 
-        self.transmit_handler(out_port, byte_buf)
+        if self.segments:
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                log_packet_bytes(parsed_packet.serialize(segments))
+            self.transmit_handler(out_port, segments)
+        else:
+            byte_buf = parsed_packet.serialize(segments)
+            log_packet_bytes(byte_buf)
+            self.transmit_handler(out_port, byte_buf)
+        parsed_packet.release()
 
 ################################################################
 
@@ -264,3 +371,52 @@ if __name__ == "__main__":
     local_dir = os.path.dirname(os.path.abspath(__file__))
     obj = IriInstance("instance", local_dir + "/../unit_test.yml",
                       transmit_packet)
+
+    # Transmit as a single buffer and as gather segments
+    sent = []
+    def record_packet(out_port, packet):
+        sent.append((out_port, packet))
+
+    byte_buf = bytearray(range(64))
+    for segments in [False, True]:
+        ppkt = ParsedPacket(byte_buf, obj.metadata_layout)
+        ppkt.parse_header("ethernet", obj.header_layout["ethernet"])
+        ppkt.set_field("intrinsic_metadata.egress_port", 3)
+        TransmitProcessor(record_packet, segments).process(ppkt)
+    air_assert(sent[0] == (3, byte_buf), "Bad transmitted packet")
+    air_assert(isinstance(sent[1][1], list), "Expected segment list")
+    air_assert(bytearray().join([seg.tobytes() for seg in sent[1][1]]) ==
+               byte_buf, "Bad transmitted segments")
+
+    # Transmitted packets are returned to the instance's packet pool
+    pooled = IriInstance("pooled", local_dir + "/../unit_test.yml",
+                         record_packet, pool_size=4)
+    ppkt = pooled.packet_pool.get(bytearray(byte_buf))
+    ppkt.parse_header("ethernet", pooled.header_layout["ethernet"])
+    pooled.transmit_processor.process(ppkt)
+    air_assert(len(pooled.packet_pool.free) == 1, "Packet not released")
+    air_assert(pooled.packet_pool.get(bytearray(64)) is ppkt,
+               "Released packet not reused")
+
+    # Parsers may run generated code
+    generated = IriInstance("generated", local_dir + "/../unit_test.yml",
+                            transmit_packet, generate_parsers=True)
+    parser = generated.iri_parser["parser"]
+    air_assert(parser.source is not None and
+               parser.parse_states != parser.interpret,
+               "Parser code not generated")
+
+    # Parsers may cache parse results per flow
+    cached = IriInstance("cached", local_dir + "/../unit_test.yml",
+                         transmit_packet, parse_cache_size=16)
+    parser = cached.iri_parser["parser"]
+    air_assert(parser.parse_cache is not None and
+               parser.parse_cache.max_entries == 16, "Parse cache not enabled")
+    air_assert(obj.iri_parser["parser"].parse_cache is None,
+               "Parse cache enabled by default")
+
+    # Tables may use an index other than the one for their match types
+    indexed = IriInstance("indexed", local_dir + "/../unit_test.yml",
+                          transmit_packet, table_index={"l3" : "linear"})
+    air_assert(type(indexed.iri_table["l3"].index).__name__ == "LinearIndex",
+               "Table index type not applied")
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+#
+# @file
+# @brief Load time analysis of which headers and fields are referenced
+#
+
+import os
+import sys
+
+from air.air_common import *
+from field_handle import field_ref_parse
+
+class Liveness(object):
+    """
+    @brief Determine which header fields packet processing can read
+
+    @param iri An IriInstance whose parsers, tables and actions exist
+    @param extra_refs Field references read by other code (for example
+    an application calling get_field on transmitted packets)
+
+    A field is live if it is a parser select field, a table match field
+    or a (possible) field reference in an action. A header is live if
+    any of its fields is live. Referring to a header without a field
+    (a validity check, add_header or remove_header) does not need the
+    header's fields and so does not make it live.
+
+    Attributes:
+      * live_fields: Map from header name to the set of live field names
+      * extracted: The set of headers extracted by some parse state
+      * dead_headers: Extracted headers that are not live and can be
+        parsed as opaque byte blocks: fixed length headers that are not
+        header stacks
+    """
+    def __init__(self, iri, extra_refs=None):
+        self.live_fields = {}
+        self.extracted = set()
+
+        refs = list(extra_refs or [])
+        for parser in iri.iri_parser.values():
+            for state in parser.states:
+                for extract in state.extracts:
+                    self.extracted.add(extract[0])
+                refs.extend([handle.ref for handle in state.select_handles])
+        for table in iri.iri_table.values():
+            match_on = deref_or_none(table.air_table_attrs, "match_on")
+            refs.extend((match_on or {}).keys())
+        for action in iri.iri_action.values():
+            refs.extend(action.param_refs)
+
+        for ref in refs:
+            parts = field_ref_parse(ref)
+            if parts is None or parts[2] is None:
+                continue
+            (hdr, index, fld) = parts
+            self.live_fields.setdefault(hdr, set()).add(fld)
+
+        self.dead_headers = set()
+        for hdr_name in self.extracted:
+            if hdr_name in self.live_fields:
+                continue
+            layout = iri.header_layout.get(hdr_name, None)
+            if layout is None or not layout.fixed or layout.is_stack:
+                continue
+            self.dead_headers.add(hdr_name)
+
+        logging.info("Liveness: live headers %s; dead headers %s" %
+                     (sorted(self.live_fields.keys()),
+                      sorted(self.dead_headers)))
+
+    def header_live(self, header_name):
+        """
+        @brief Return True if some field of the header is live
+        """
+        return header_name in self.live_fields
+
+################################################################
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG, filename=sys.argv[1])
+    logging.info("RUNNING MODULE: %s" % __file__)
+
+    from instance import IriInstance
+    from parsed_packet import ParsedPacket
+
+    def transmit_packet(out_port, packet):
+        pass
+
+    local_dir = os.path.dirname(os.path.abspath(__file__))
+    l3_input = [local_dir + "/../profile_0.yml", local_dir + "/../l3.yml"]
+    iri = IriInstance("instance", l3_input, transmit_packet)
+    liveness = Liveness(iri)
+    air_assert(liveness.dead_headers == set(["tcp", "udp"]),
+               "L3 should not need L4 headers: %s" %
+               str(liveness.dead_headers))
+    air_assert(liveness.header_live("ipv4") and
+               "ttl" in liveness.live_fields["ipv4"], "ipv4.ttl not live")
+    air_assert(not Liveness(iri, ["tcp.dstPort"]).header_live("udp") and
+               "tcp" not in Liveness(iri, ["tcp.dstPort"]).dead_headers,
+               "Extra reference not live")
+
+    # Minimal parsing keeps dead headers as opaque bytes
+    minimal = IriInstance("minimal", l3_input, transmit_packet,
+                          parse_mode="minimal")
+    air_assert(minimal.liveness.dead_headers == liveness.dead_headers,
+               "Instance liveness differs")
+    byte_buf = bytearray(range(100))
+    byte_buf[12:14] = bytearray([0x08, 0x00])
+    byte_buf[14] = 0x45
+    byte_buf[23] = 6 # Parse udp
+    generated = IriInstance("generated", l3_input, transmit_packet,
+                            parse_mode="minimal", generate_parsers=True)
+    results = []
+    for instance in [iri, minimal, generated]:
+        parser = instance.iri_parser["parser"]
+        ppkt = ParsedPacket(byte_buf, instance.metadata_template)
+        parser.parse_states(ppkt)
+        results.append(ppkt)
+    (full, opaque, gen_opaque) = results
+    air_assert(gen_opaque.header_map["udp"].layout is None,
+               "Generated parser should extract dead header as opaque")
+    air_assert(opaque.header_map.keys() == full.header_map.keys(),
+               "Minimal parse found different headers")
+    air_assert(opaque.header_map["udp"].layout is None,
+               "Dead header should be opaque")
+    air_assert(opaque.header_map["ipv4"].layout is not None,
+               "Live header should be decoded")
+    air_assert(opaque.payload_offset == full.payload_offset == 42,
+               "Bad payload offset")
+    opaque.set_field("ipv4.ttl", 9)
+    full.set_field("ipv4.ttl", 9)
+    air_assert(opaque.serialize() == full.serialize(),
+               "Opaque header not serialized verbatim")
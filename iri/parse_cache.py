@@ -0,0 +1,446 @@
+#!/usr/bin/env python
+#
+# @file
+# @brief A cache of parse results keyed on the bytes the parser selects on
+#
+
+import os
+import sys
+import time
+import threading
+
+from air.air_common import *
+from iri_exception import *
+from field_handle import Lookahead
+from table_index import CowMap
+
+class ParseCache(object):
+    """
+    @brief Cache the header sequence a parser extracts from packets
+
+    @param parser The Parser object (after its states are compiled)
+    @param max_entries The maximum number of cached parse results
+    @param max_signatures The maximum number of signatures (distinct
+    sets of select bytes) probed by a lookup
+
+    The path a packet takes through the parse graph depends only on the
+    values of the select fields read along that path. When a packet
+    misses the cache it is parsed by walking the state records, noting
+    the path's "signature":
+
+      * the byte range in the packet of each select field read from a
+        header extracted on the path;
+      * the handle of each select field read from metadata (or from a
+        header that is not valid);
+      * the byte range of each lookahead select.
+
+    The packet's bytes in those ranges and its metadata select values
+    form the key of the cache entry, whose value is the list of headers
+    extracted. Another packet with the same values under the same
+    signature follows the same path, so a hit replays the extracts
+    (which update the packet offsets) without reading select fields or
+    running transitions. A packet may follow any of the signatures seen
+    so far; each is probed in turn, so the number of signatures kept is
+    bounded by max_signatures. Signatures left with no entries when
+    entries are evicted are dropped, and a new signature beyond the
+    bound replaces the least recently used one and its entries.
+
+    For a variable length header extracted on the path, the fields its
+    widths depend on are added to the signature, since the offsets of
+    later headers depend on them. The entry keeps the header's widths
+    (see HeaderInstance.shape), so a hit on a packet parsed lazily
+    decodes no fields at all: it only sets the header offsets.
+
+    Lookups do not lock (read-copy-update, as Table does). The
+    signatures and the map of entries (a CowMap) are published together
+    as one tuple; a miss adds its entry to a copy under a lock and
+    publishes the copy. A hit marks its entry with the number of
+    entries added so far. When the cache is full, the quarter least
+    recently used in that sense are evicted together.
+
+    The cache is cleared when a value set used by the parser changes; a
+    miss walked before the change does not add its entry.
+
+    Hit counters are kept per thread, as in Table.
+
+    Attributes:
+      * hits: Number of packets parsed from the cache
+      * misses: Number of packets parsed by walking the states
+      * uncacheable: Number of misses whose path could not be cached
+      * signature_count: Number of signatures probed by a lookup
+    """
+    def __init__(self, parser, max_entries=1024, max_signatures=16):
+        air_check(max_entries > 0, IriParamError)
+        air_check(max_signatures > 0, IriParamError)
+        self.parser = parser
+        self.max_entries = max_entries
+        self.max_signatures = max_signatures
+        self.lock = threading.Lock() # Serializes changes; lookups skip it
+        self.added = 0 # Number of entries added, the clock for recency
+        self.epoch = 0 # Number of invalidations
+        self.counters = [] # Per thread [hits, misses, uncacheable] lists
+        self.thread_state = threading.local()
+        self.invalidate()
+
+        value_sets = []
+        for state in parser.states:
+            for (value_set, next_state, negate) in state.value_set_edges:
+                if value_set not in value_sets:
+                    value_sets.append(value_set)
+        for value_set in value_sets:
+            value_set.add_listener(self.invalidate)
+
+    def invalidate(self, value_set=None, change=None):
+        """
+        @brief Remove all cached parse results
+        @param value_set The value set that changed, if any
+        @param change The change made to value_set (unused; allows this
+        to be registered as a ValueSet listener)
+        """
+        with self.lock:
+            self.epoch += 1
+            # Tuple of (byte ranges, handles, minimum packet length) and
+            # CowMap from (signature index, key) to [extracts, last used]
+            self.published = ((), CowMap())
+
+    def __len__(self):
+        return len(self.published[1])
+
+    def _thread_counters(self):
+        """
+        @brief Return the [hits, misses, uncacheable] of the calling thread
+        """
+        counters = getattr(self.thread_state, "counters", None)
+        if counters is None:
+            counters = [0, 0, 0]
+            self.thread_state.counters = counters
+            self.counters.append(counters) # Atomic; no lock needed
+        return counters
+
+    @property
+    def hits(self):
+        return sum([counters[0] for counters in list(self.counters)])
+
+    @property
+    def misses(self):
+        return sum([counters[1] for counters in list(self.counters)])
+
+    @property
+    def uncacheable(self):
+        return sum([counters[2] for counters in list(self.counters)])
+
+    @property
+    def signature_count(self):
+        return len(self.published[0])
+
+    @staticmethod
+    def _key(parsed_packet, ranges, handles):
+        """
+        @brief Build the cache key for a packet under a signature
+        """
+        buf = parsed_packet.original_packet
+        return (tuple([str(buf[start:end]) for (start, end) in ranges]),
+                tuple([parsed_packet.get(handle) for handle in handles]))
+
+    def _lookup(self, parsed_packet):
+        """
+        @brief Return the cached extracts for a packet or None
+        """
+        (signatures, entries) = self.published
+        length = len(parsed_packet.original_packet)
+        for index, (ranges, handles, min_length) in enumerate(signatures):
+            if length < min_length:
+                continue
+            key = (index, ParseCache._key(parsed_packet, ranges, handles))
+            entry = entries.get(key, None)
+            if entry is not None:
+                entry[1] = self.added # Most recently used
+                return entry[0]
+        return None
+
+    @staticmethod
+    def _compact(signatures, items):
+        """
+        @brief Drop the signatures that have no entries
+        @param signatures The tuple of signatures
+        @param items The ((signature index, key), entry) pairs to keep
+        @returns (signatures, entries) with the signatures renumbered
+        """
+        used = sorted(set([index for ((index, key), entry) in items]))
+        renumber = dict([(old, new) for (new, old) in enumerate(used)])
+        entries = CowMap([((renumber[index], key), entry) for
+                          ((index, key), entry) in items])
+        return (tuple([signatures[index] for index in used]), entries)
+
+    def _insert(self, parsed_packet, ranges, handles, extracts, epoch):
+        """
+        @brief Add the parse result for a packet that missed the cache
+        @param epoch The epoch when the packet's walk started
+        """
+        signature = (tuple(ranges), tuple(handles),
+                     parsed_packet.payload_offset)
+        with self.lock:
+            if epoch != self.epoch: # Walked before an invalidation
+                return
+            (signatures, entries) = self.published
+            items = None
+            if len(entries) >= self.max_entries:
+                # Keep the most recently used three quarters
+                items = entries.items()
+                items.sort(key=lambda item: item[1][1])
+                items = items[len(items) / 4 + 1:]
+            if (signature not in signatures and
+                    len(signatures) >= self.max_signatures):
+                # Drop the least recently used signature and its entries
+                if items is None:
+                    items = entries.items()
+                last_used = [0] * len(signatures)
+                for ((index, key), entry) in items:
+                    last_used[index] = max(last_used[index], entry[1])
+                oldest = last_used.index(min(last_used))
+                items = [item for item in items if item[0][0] != oldest]
+            if items is None:
+                entries = entries.copy()
+            else:
+                (signatures, entries) = ParseCache._compact(signatures,
+                                                            items)
+            if signature in signatures:
+                index = signatures.index(signature)
+            else:
+                index = len(signatures)
+                signatures += (signature,)
+            key = (index, ParseCache._key(parsed_packet, ranges, handles))
+            self.added += 1
+            entries[key] = [tuple(extracts), self.added]
+            self.published = (signatures, entries)
+
+    @staticmethod
+    def _field_range(header, idx):
+        """
+        @brief Return the (start, end) byte range of a field in the packet
+        @param header The HeaderInstance extracted from the packet
+        @param idx The index of the field in the header's layout
+        """
+        bit_offset = header.offset * 8 + header.bit_offsets[idx]
+        return (bit_offset / 8, (bit_offset + header.widths[idx] + 7) / 8)
+
+    def _walk(self, parsed_packet):
+        """
+        @brief Parse a packet from the start state, recording its path
+        @returns (ranges, handles, extracts) or None if the path cannot
+        be cached (or the packet does not parse); each extract is
+        (header name, layout, opaque, shape)
+        """
+        buf = parsed_packet.original_packet
+        cacheable = True
+        ranges = []
+        handles = []
+        extracts = []
+        state = self.parser.first_state
+        while state is not None:
+            for (hdr_name, layout, opaque) in state.extracts:
+                if layout is None:
+                    raise IriReferenceError("Parse state %s: unknown header %s"
+                                            % (state.name, hdr_name))
+                if not parsed_packet.parse_header(hdr_name, layout, opaque):
+                    return None # Parse error
+                shape = None
+                if not layout.fixed:
+                    header = parsed_packet.header_map[hdr_name]
+                    if layout.is_stack:
+                        header = header.element(-1)
+                    shape = header.shape
+                    for deps in layout.width_deps:
+                        for idx in deps or []:
+                            ranges.append(ParseCache._field_range(header, idx))
+                extracts.append((hdr_name, layout, opaque, shape))
+
+            select_value = state.select(parsed_packet)
+            for handle in state.select_handles:
+                if isinstance(handle, Lookahead):
+                    bit_offset = parsed_packet.payload_offset * 8 + \
+                        handle.bit_offset
+                    ranges.append((bit_offset / 8,
+                                   (bit_offset + handle.width + 7) / 8))
+                    continue
+                header = parsed_packet._handle_header(handle)
+                if header is None or handle.header in parsed_packet.metadata:
+                    handles.append(handle)
+                elif (header.byte_buffer is buf and header.layout is not None
+                      and handle.field_index(header.layout) is not None):
+                    ranges.append(ParseCache._field_range(
+                            header, handle.field_index(header.layout)))
+                else:
+                    cacheable = False
+            state = state.next_state(select_value)
+
+        if not cacheable:
+            return None
+        return (ranges, handles, extracts)
+
+    def parse(self, parsed_packet):
+        """
+        @brief Parse a packet from the start state using the cache
+        @param parsed_packet The packet to parse, a parsed packet instance
+        """
+        counters = self._thread_counters()
+        extracts = self._lookup(parsed_packet)
+        if extracts is not None:
+            counters[0] += 1
+            for (hdr_name, layout, opaque, shape) in extracts:
+                parsed_packet.parse_header(hdr_name, layout, opaque, shape)
+            return
+
+        counters[1] += 1
+        epoch = self.epoch
+        path = self._walk(parsed_packet)
+        if path is None:
+            counters[2] += 1
+            return
+        (ranges, handles, extracts) = path
+        self._insert(parsed_packet, ranges, handles, extracts, epoch)
+
+################################################################
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG, filename=sys.argv[1])
+    logging.info("RUNNING MODULE: %s" % __file__)
+
+    import random
+    from instance import IriInstance
+    from parsed_packet import ParsedPacket
+    from header import HeaderStack
+
+    def transmit_packet(out_port, packet):
+        pass
+
+    if len(sys.argv) > 2:
+        input_files = sys.argv[2:]
+    else:
+        local_dir = os.path.dirname(os.path.abspath(__file__))
+        input_files = local_dir + "/../unit_test.yml"
+    iri = IriInstance("instance", input_files, transmit_packet)
+
+    # Packets that follow the edges of the parse graphs in the examples
+    random.seed(2)
+    packets = []
+    for ethertype in [0x0800, 0x8100, 0x8847, 0x86dd, 0x1234]:
+        for protocol in [6, 17, 1]:
+            for bos in [0, 1]:
+                byte_buf = bytearray([random.randint(0, 255)
+                                      for idx in range(200)])
+                byte_buf[12:14] = bytearray([ethertype >> 8, ethertype & 0xff])
+                byte_buf[16:18] = bytearray([0x08, 0x00]) # After vlan tag
+                byte_buf[16] |= bos # mpls bos
+                byte_buf[14] = 0x45
+                byte_buf[23] = protocol
+                byte_buf[36:38] = bytearray([0x12, 0xb5]) # UDP port 4789
+                packets.append(byte_buf)
+
+    def summary(ppkt):
+        return (ppkt.header_map.keys(), ppkt.header_length,
+                ppkt.payload_offset, ppkt.serialize(),
+                [ppkt.header_stack_count(hdr) for
+                 hdr in ppkt.header_map.keys()])
+
+    def parse_with(parse, byte_buf, port):
+        ppkt = ParsedPacket(bytearray(byte_buf), iri.metadata_template)
+        ppkt.set_field("intrinsic_metadata.ingress_port", port)
+        try:
+            parse(ppkt)
+        except Exception, e:
+            return type(e)
+        return summary(ppkt)
+
+    for name, parser in iri.iri_parser.items():
+        cache = ParseCache(parser, max_entries=8)
+        for vset in iri.iri_value_set.values():
+            vset.add_list([0, 3])
+        # Each packet twice so the second parse may hit
+        for byte_buf in packets + packets:
+            for port in [0, 1, 3]:
+                expected = parse_with(parser.interpret, byte_buf, port)
+                air_assert(parse_with(cache.parse, byte_buf, port) == expected,
+                           "Cached parse %s differs" % name)
+        air_assert(len(cache) <= 8, "Cache exceeds its maximum size")
+        air_assert(cache.hits + cache.misses == 2 * 3 * len(packets),
+                   "Hits and misses do not count each packet")
+
+        # A small set of flows all hit after the first packet of each
+        hits = cache.hits
+        for idx in range(10):
+            for byte_buf in packets[:4]:
+                parse_with(cache.parse, byte_buf, 0)
+        air_assert(cache.hits >= hits + 36 or cache.uncacheable,
+                   "Repeated flows should hit")
+
+        # Value set updates invalidate cached paths
+        for vset in set([edge[0] for state in parser.states for
+                         edge in state.value_set_edges]):
+            parse_with(cache.parse, packets[0], 5)
+            vset.add(5)
+            air_assert(len(cache) == 0, "Value set change not invalidated")
+            air_assert(parse_with(cache.parse, packets[0], 5) ==
+                       parse_with(parser.interpret, packets[0], 5),
+                       "Parse differs after value set change")
+            vset.remove(5)
+
+        logging.info("Parse cache %s: %d hits, %d misses, %d uncacheable" %
+                     (name, cache.hits, cache.misses, cache.uncacheable))
+
+        # A hit on a packet parsed lazily reads no header fields
+        lazy_hits = 0
+        for byte_buf in packets:
+            lazy_pkt = ParsedPacket(bytearray(byte_buf), {}, lazy=True)
+            parser.interpret(lazy_pkt)
+            hits = cache.hits
+            cached_pkt = ParsedPacket(bytearray(byte_buf), {}, lazy=True)
+            cache.parse(cached_pkt)
+            if cache.hits == hits:
+                continue
+            air_assert(summary(cached_pkt) == summary(lazy_pkt),
+                       "Lazy cached parse %s differs" % name)
+            cached_pkt = ParsedPacket(bytearray(byte_buf), {}, lazy=True)
+            cache.parse(cached_pkt)
+            for header in cached_pkt.header_map.values():
+                elements = [header]
+                if isinstance(header, HeaderStack):
+                    elements = [header.element(idx) for
+                                idx in range(header.current_count)]
+                for element in elements:
+                    air_assert(element.values == [None] * len(element.values),
+                               "Lazy cache hit read %s fields" % element.name)
+            lazy_hits += 1
+        air_assert(lazy_hits, "No lazy cache hits")
+
+        # IPv4 headers of each length give paths with different
+        # signatures; a lookup still probes at most max_signatures
+        bounded = ParseCache(parser, max_signatures=4)
+        for ihl in range(5, 16) * 2:
+            ihl_buf = bytearray(packets[0]) # Ethernet, IPv4
+            ihl_buf[14] = 0x40 | ihl
+            air_assert(parse_with(bounded.parse, ihl_buf, 0) ==
+                       parse_with(parser.interpret, ihl_buf, 0),
+                       "Cached parse %s differs for ihl %d" % (name, ihl))
+            air_assert(bounded.signature_count <= 4,
+                       "Cache keeps too many signatures")
+
+        # Lookups in other threads while misses add entries and the
+        # cache is cleared
+        expected = [parse_with(parser.interpret, byte_buf, 0) for
+                    byte_buf in packets]
+        errors = []
+        def reader():
+            for idx in range(20):
+                for byte_buf, summary_0 in zip(packets, expected):
+                    if parse_with(cache.parse, byte_buf, 0) != summary_0:
+                        errors.append(byte_buf)
+        readers = [threading.Thread(target=reader) for idx in range(2)]
+        for thread in readers:
+            thread.start()
+        for idx in range(50):
+            cache.invalidate()
+            time.sleep(0.001)
+        for thread in readers:
+            thread.join()
+        air_assert(not errors, "Cached parse %s differs during updates" % name)
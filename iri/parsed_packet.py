@@ -5,12 +5,30 @@
 #
 
 import os
-import copy
 import sys
+import collections
 
 from air.air_common import *
 from iri_exception import *
-from header import HeaderInstance
+from header import HeaderInstance, HeaderStack, header_layout_get
+from field import field_extract
+from field_handle import handle_map, field_handle
+
+def metadata_template(metadata_dict):
+    """
+    @brief Create the zeroed metadata headers copied into each packet
+    @param metadata_dict Map from metadata name to HeaderLayout (or AIR
+    attributes)
+    @returns Map from metadata name to a zeroed HeaderInstance
+
+    ParsedPacket clones the template headers (a copy of the list of
+    values) rather than extracting each metadata header from a zero
+    buffer for every packet.
+    """
+    template = {}
+    for name, md in metadata_dict.items():
+        template[name] = HeaderInstance(name, md)
+    return template
 
 class ParsedPacket(object):
     """
@@ -28,6 +46,7 @@ class ParsedPacket(object):
 
     A parsed packet may be replicated. The original packet is the "parent"
     of the replicant and the parent ID is kept for debugging purposes.
+    Replicas share header instances copy-on-write; see replicate().
 
     A parsed packet is always associated with an original packet (bytearray)
     This is treated as "read-only".
@@ -52,13 +71,29 @@ class ParsedPacket(object):
 
     Important interfaces:
       * parse_header(header_name): Add the given header to the list.
+      * set(handle, value): Set the field for a FieldHandle if it's valid
+      * get(handle): Return the value of the field for a FieldHandle
       * set_field(field_ref, value): Set the given field if it's valid
       * get_field(field_ref): Return the value of the given field if valid
+      * push_header/pop_header(header_ref): Add or remove an element at
+        either end of a header stack
       * add_header_before/after(header_ref, existing_header): Add new header
         before/after the existing header.
 
     The list of headers is a ListDict ordered dictionary (see air.common).
-    The value is a HeaderInstance object.
+    The value is a HeaderInstance object, or a HeaderStack for header
+    stacks. Stack elements are referenced as hdr_name[index].fld_name
+    where index is an integer or "last".
+
+    Headers and metadata are also kept in header_slots, a list indexed
+    by the slot of the header name in the shared FieldHandleMap (see
+    field_handle.py). Components resolve their field references to
+    FieldHandles once and use get/set on each packet; get_field and
+    set_field look up the (cached) handle for a string reference.
+
+    valid_bits is an integer with the bit for each occupied slot set:
+    whether a header (or metadata) is valid is a bit test. It is kept
+    up to date wherever header_slots changes.
 
     Other instance attributes
 
@@ -67,24 +102,61 @@ class ParsedPacket(object):
       * headers: Ordered map of headers parsed so far
       * header_length: Total length of headers in the packet
       * payload_offset: Pointer to the "rest" of the packet
-      * parse_error: None if no error, otherwise an instance of the parse_error
+      * parse_error: None if no error, otherwise a description of the
+        error that stopped parsing
+      * lazy: If True, header fields are only decoded when accessed
 
       * TBD next_processor: The next processing element to be applied to pkt
 
+    Many packets may be queued at once, so the class uses __slots__ to
+    keep the per-packet footprint small; see memory_size().
+
+    Packets may be allocated from a ParsedPacketPool; the processor that
+    finishes with a packet (transmit or drop) then calls release() to
+    return it to the pool. release() does nothing for other packets.
     """
+    __slots__ = ["original_packet", "header_map", "header_length",
+                 "payload_offset", "payload_length", "id", "parent_id",
+                 "parse_error", "lazy", "metadata", "header_slots",
+                 "valid_bits", "pool"]
+
     id_next = 0
-    def __init__(self, original_packet, metadata_dict):
+    def __init__(self, original_packet, metadata_dict, lazy=False):
         """
         @brief ParsedPacket constructor
         @param original_packet The original packet; read only
-        @param metadata_dict The metatdata instances to use when init'ing pkt
+        @param metadata_dict Map from metadata name to HeaderLayout (or AIR
+        attributes) to use when init'ing pkt, or a metadata_template
+        @param lazy If True, header fields are read from the packet only
+        when first accessed
+        """
+        self.pool = None
+
+        # @TODO Add support for metadata initializers
+        self.metadata = {}
+        for name, md in metadata_dict.items():
+            if isinstance(md, HeaderInstance):
+                self.metadata[name] = md.clone()
+            else:
+                self.metadata[name] = HeaderInstance(name, md)
+
+        self._init(original_packet, lazy)
+
+    def _init(self, original_packet, lazy):
         """
+        @brief Set up the packet state for a newly received packet
+        @param original_packet The original packet; read only
+        @param lazy If True, header fields are read on first access
 
+        The metadata headers must already be initialized.
+        """
         # TODO: Assert original_packet is proper type
         air_check(isinstance(original_packet, bytearray), IriParamError)
         self.original_packet = original_packet
 
         self.header_map = ListDict() # of HeaderInstance objects
+        self.header_slots = [None] * len(handle_map.names)
+        self.valid_bits = 0
         self.header_length = 0
 
         # The payload is the unparsed portion of the packet
@@ -98,96 +170,228 @@ class ParsedPacket(object):
         # Indicates if an error occured when parsing
         self.parse_error = None
 
-        # @TODO Add support for metadata initializers
-        self.metadata = {}
-        for name, md in metadata_dict.items():
-            self.metadata[name] = HeaderInstance(name, md)
+        # Read header fields on demand rather than when parsed
+        self.lazy = lazy
+
+        for name, header in self.metadata.items():
+            self._slot_set(name, header)
 
         logging.debug("Created packet %d", self.id)
 
-    def parse_header(self, header_name, header_attrs):
+    def parse_header(self, header_name, header_attrs, opaque=False,
+                     shape=None):
         """
         @brief Parse (identify) a header from the packet
         @param header_name The header instance (name) to identify
-        @param header_attrs The AIR attributes associated of the header
+        @param header_attrs The HeaderLayout or AIR attributes of the header
+        @param opaque If True, do not decode the header's fields; the header
+        is kept as an opaque block of its (fixed) length
+        @param shape The widths of a variable length header if known (see
+        HeaderInstance.shape)
+
+        @returns True if the header was extracted; False if the header
+        is a stack that is already full, in which case parse_error is set
+        and the packet is left as it was
 
         The header is taken from the packet payload and offsets
-        are updated.
+        are updated. If the header is a stack, the header is pushed
+        onto the back of the stack, which is created if not present.
         """
-        air_assert(header_attrs["type"] in ["header_stack", "header"],
+        layout = header_layout_get(header_name, header_attrs)
+        air_assert(layout.type in ["header_stack", "header"],
                    "Parsed packet passed bad header object for parsing")
 
+        if layout.is_stack and header_name in self.header_map:
+            stack = self.header_map[header_name]
+            if stack.current_count >= stack.max_depth:
+                self.parse_error = "Header stack %s overflow" % header_name
+                return False
+
         # @TODO check for sufficient payload bytes
-        if header_attrs["type"] == "header":
+        if opaque:
+            header = HeaderInstance(header_name, None,
+                                    byte_buffer=self.original_packet,
+                                    offset=self.payload_offset,
+                                    length=layout.length)
+        else:
             header = HeaderInstance(header_name,
-                                    header_attrs,
+                                    layout,
                                     byte_buffer=self.original_packet,
-                                    offset=self.payload_offset)
-        else: # Header stack
-            # @FIXME
-            pass
-
-        self.header_map[header_name] = header
+                                    offset=self.payload_offset,
+                                    lazy=self.lazy, shape=shape)
+        if layout.is_stack:
+            if header_name not in self.header_map:
+                self.header_map[header_name] = HeaderStack(header_name, layout)
+                self._slot_set(header_name, self.header_map[header_name])
+            self.header_map[header_name].push(header)
+        else:
+            self.header_map[header_name] = header
+            self._slot_set(header_name, header)
         self.payload_offset += header.length
         self.payload_length -= header.length
         self.header_length += header.length
+        return True
+
+    def _slot_set(self, header_name, header):
+        """
+        @brief Update the header slot for header_name
+        @param header_name The header or metadata name
+        @param header The HeaderInstance, HeaderStack or None if removed
+        """
+        slot = handle_map.add_header(header_name)
+        if slot >= len(self.header_slots):
+            self.header_slots.extend([None] *
+                                     (slot + 1 - len(self.header_slots)))
+        self.header_slots[slot] = header
+        if header is None:
+            self.valid_bits &= ~(1 << slot)
+        else:
+            self.valid_bits |= 1 << slot
+
+    def _unshare(self, header):
+        """
+        @brief Replace a header shared with replicas by a private copy
+        @param header The shared HeaderInstance or HeaderStack
+        @returns The copy now referenced by this packet
+        """
+        header = header.clone()
+        self.header_map[header.name] = header
+        self._slot_set(header.name, header)
+        return header
+
+    def _handle_header(self, handle, write=False):
+        """
+        @brief Find the header instance a field handle refers to
+        @param handle A FieldHandle
+        @param write If True, the header is about to be modified; a
+        header shared with a replica is copied first
+        @returns A HeaderInstance or None if not valid in this packet
+
+        An unindexed reference to a stack refers to its last element.
+        """
+        slot = handle.slot
+        if slot is None or slot >= len(self.header_slots):
+            return None
+        header = self.header_slots[slot]
+        if header is None:
+            return None
+        if isinstance(header, HeaderStack):
+            if write and header.shared:
+                header = self._unshare(header)
+            index = handle.index
+            if index is None:
+                index = -1
+            element = header.element(index)
+            if write and element is not None and element.shared:
+                element = header.set_element(index, element.clone())
+            return element
+        if handle.index is not None:
+            return None
+        if write and header.shared:
+            header = self._unshare(header)
+        return header
+
+    def get(self, handle):
+        """
+        @brief Get a field from this parsed packet by handle
+        @param handle A FieldHandle (see field_handle.py)
+
+        Returns None if the header is not valid, 0 if the field is not
+        in the header. If the handle refers to a header, this will return
+        the "valid" state of the header.
+        """
+        if handle.field is None and handle.index is None:
+            # Valid header reference
+            slot = handle.slot
+            if slot is not None and self.valid_bits >> slot & 1:
+                return True
+            return None
+        header = self._handle_header(handle)
+        if header is None:
+            return None
+        if handle.field is None:
+            return True # This is a valid header reference
+        idx = handle.field_index(header.layout)
+        if idx is None:
+            return 0
+        return header.get_value(idx)
+
+    def set(self, handle, field_value):
+        """
+        @brief Set a field from this parsed packet by handle
+        @param handle A FieldHandle (see field_handle.py)
+        @param field_value A value for the field
+        @returns The new value of the field or None if not valid
+        """
+        header = self._handle_header(handle, write=True)
+        if header is None:
+            return None
+        idx = handle.field_index(header.layout)
+        if idx is None:
+            return None
+        return header.set_value(idx, field_value)
 
     def get_field(self, field_ref):
         """
         @brief Get a field from this parsed packet
         @param field_ref Reference to a field of the form hdr_name.fld_name
+        or, for header stacks, hdr_name[index].fld_name. An unindexed
+        reference to a stack refers to its last element.
 
         If field_ref is the name of a header, then this will return
         the "valid" state of the header.
         """
-
-        try:
-            (hdr, fld) = field_ref.split(".")
-        except ValueError:
-            if field_ref in self.header_map.keys():
-                return True # This is a valid header reference
+        handle = field_handle(field_ref)
+        if handle is None:
             return None
-
-        if hdr in self.header_map.keys():
-            return self.header_map[hdr].get_field(fld)
-        if hdr in self.metadata.keys():
-            return self.metadata[hdr].get_field(fld)
-        logging.debug("Field %s not valid in pkt lookup" % field_ref)
-        return None
+        return self.get(handle)
 
     def set_field(self, field_ref, field_value):
         """
         @brief Set a field from this parsed packet
         @param field_ref Reference to a field of the form hdr_name.fld_name
+        or hdr_name[index].fld_name
         @param field_value A value for the field
         """
         # @FIXME Check for varible width field changing
-        logging.debug("Set fld %s to %s" % (field_ref, str(field_value)))
-        (hdr, fld) = field_ref.split(".")
-        if hdr in self.header_map.keys():
-            return self.header_map[hdr].set_field(fld, field_value)
-        if hdr in self.metadata.keys():
-            return self.metadata[hdr].set_field(fld, field_value)
-        logging.debug("Field %s not valid in pkt set_field" % field_ref)
-        return None
+        logging.debug("Set fld %s to %s", field_ref, field_value)
+        handle = field_handle(field_ref)
+        if handle is None or handle.field is None:
+            return None
+        return self.set(handle, field_value)
+
+    def _new_header(self, header_name, header_attrs):
+        """
+        @brief Create a zeroed header, or a stack with one zeroed element
+        @param header_name The name of the header to create
+        @param header_attrs The HeaderLayout or AIR attributes of the header
+        """
+        layout = header_layout_get(header_name, header_attrs)
+        header = HeaderInstance(header_name, layout, None)
+        if layout.is_stack:
+            stack = HeaderStack(header_name, layout)
+            stack.push(header)
+            return stack
+        return header
 
     def add_header_before(self, header_name, header_attrs, before_header_name):
         """
         @brief Insert the header instance before before_header_name
         @param header_name The name of the header to add
-        @param header_attrs The AIR attributes associated of the header
+        @param header_attrs The HeaderLayout or AIR attributes of the header
         @param before_header_name The name of the header before which to
         add the new header
 
         If header_name is already valid for this packet, raise an error
         If before_header_name is not valid for this packet, raise an error
         Can be used to add the first element of a new header stack; use
-        header_push to add a new element to an existing stack
+        push_header to add a new element to an existing stack
         """
-        air_check(before_header_name in self.header_map, AIRPacketModException)
-        air_check(header_name not in self.header_map, AIRPacketModException)
-        header = HeaderInstance(header_name, header_attrs, None)
+        air_check(before_header_name in self.header_map, IriPacketModError)
+        air_check(header_name not in self.header_map, IriPacketModError)
+        header = self._new_header(header_name, header_attrs)
         self.header_map.insert_before(before_header_name, (header_name, header))
+        self._slot_set(header_name, header)
         self.header_length += header.length
         return header.length
 
@@ -195,7 +399,7 @@ class ParsedPacket(object):
         """
         @brief Add the indicated header after after_header_name
         @param header_name The name of the header to add
-        @param header_attrs The AIR attributes associated of the header
+        @param header_attrs The HeaderLayout or AIR attributes of the header
         @param after_header_name The name of the header after which to
         add the new header
 
@@ -208,8 +412,9 @@ class ParsedPacket(object):
             return None
         if header_name in self.header_map:
             return None
-        header = HeaderInstance(header_name, header_attrs, None)
+        header = self._new_header(header_name, header_attrs)
         self.header_map.insert_after(after_header_name, (header_name, header))
+        self._slot_set(header_name, header)
         self.header_length += header.length
         return header.length
 
@@ -221,16 +426,28 @@ class ParsedPacket(object):
         @returns The length of the header removed of None on error.
         If header_name is a header stack, remove the entire stack.
         """
-        # @TODO support header stack
-
         if header_name not in self.header_map:
             return None
 
         hdr_len = self.header_map[header_name].length
         self.header_length -= hdr_len
         del self.header_map[header_name]
+        self._slot_set(header_name, None)
         return hdr_len
 
+    def lookahead(self, bit_offset, width):
+        """
+        @brief Read bits from the payload without extracting a header
+        @param bit_offset The offset in bits from the start of the payload
+        @param width The number of bits to read (at most 64)
+        @returns The bits as an integer or None if they extend beyond the
+        end of the packet
+        """
+        if (bit_offset + width + 7) / 8 > self.payload_length:
+            return None
+        return field_extract(self.original_packet, self.payload_offset,
+                             bit_offset, width, "lookahead")
+
     def parse_skip_byte_block(self, bytes):
         """
         @brief Add a byte block to the parsed fields from start of payload
@@ -241,23 +458,90 @@ class ParsedPacket(object):
         air_assert(bytes <= self.payload_length,
                    "Not enough bytes in payload in for parse_skip_byte_block")
         hdr = HeaderInstance("opaque_block", None, 
-                             byte_buffer=self.payload,
+                             byte_buffer=self.original_packet,
                              offset=self.payload_offset,
                              length=bytes)
         self.payload_offset += bytes
         self.payload_length -= bytes
-        self.header_map[name] = hdr
+        self.header_map["opaque_block"] = hdr
+        self._slot_set("opaque_block", hdr)
                     
-    def serialize(self):
+    def _header_instances(self):
         """
-        Generate a bytearray for the current version of the packet
+        @brief Return the list of header instances in packet order
+
+        Header stacks are expanded into their elements.
+        """
+        headers = []
+        for header in self.header_map.values():
+            if isinstance(header, HeaderStack):
+                headers.extend(header.elements())
+            else:
+                headers.append(header)
+        return headers
+
+    def serialize_segments(self):
+        """
+        @brief Generate the current version of the packet as a list of buffers
+
+        Unmodified headers and the payload are returned as memoryviews
+        into the buffers they were parsed from; nothing is copied for them.
+        Adjacent unmodified regions of the same buffer are merged into one
+        segment, so an unmodified packet is a single segment. Modified
+        headers are returned as newly serialized bytearrays.
+
+        The segments can be sent with one gather write or joined with
+        serialize().
         """
-        pkt = bytearray()
-        for hdr_name in self.header_map:
-            pkt += self.header_map[hdr_name].serialize()
+        segments = []
+        span_buf = None # Buffer and byte range of pending unmodified span
+        span_start = 0
+        span_end = 0
+        for header in self._header_instances():
+            if header.modified:
+                if span_buf is not None:
+                    segments.append(memoryview(span_buf)[span_start:span_end])
+                    span_buf = None
+                segments.append(header.serialize())
+                continue
+            start = header.offset
+            if span_buf is header.byte_buffer and start == span_end:
+                span_end += header.length
+                continue
+            if span_buf is not None:
+                segments.append(memoryview(span_buf)[span_start:span_end])
+            span_buf = header.byte_buffer
+            span_start = start
+            span_end = start + header.length
+
         payload_start = self.payload_offset
         payload_end = self.payload_offset + self.payload_length
-        pkt += self.original_packet[payload_start:payload_end]
+        if span_buf is self.original_packet and payload_start == span_end:
+            span_end = payload_end
+        else:
+            if span_buf is not None:
+                segments.append(memoryview(span_buf)[span_start:span_end])
+            span_buf = self.original_packet
+            span_start = payload_start
+            span_end = payload_end
+        if span_end > span_start:
+            segments.append(memoryview(span_buf)[span_start:span_end])
+        return segments
+
+    def serialize(self, segments=None):
+        """
+        Generate a bytearray for the current version of the packet
+        @param segments Optional result of serialize_segments() to join
+
+        Each segment is copied exactly once, into the result.
+        """
+        if segments is None:
+            segments = self.serialize_segments()
+        pkt = bytearray(sum([len(segment) for segment in segments]))
+        offset = 0
+        for segment in segments:
+            pkt[offset:offset + len(segment)] = segment
+            offset += len(segment)
         return pkt
 
     def push_header(self, header_name, back=True):
@@ -266,13 +550,23 @@ class ParsedPacket(object):
         @param header_name The name of the stack to update
         @param back If True, add to the back of the stack; 
         otherwise to the front
+        @returns The length of the element added
+
+        The new element has all fields zero.
 
-        Will raise exception X if the stack is not already present in the
-        parsed packet
+        Will raise IriPacketModError if the stack is not already present in
+        the parsed packet
 
-        Will raise exception X if the stack is already at max length
+        Will raise IriPacketModError if the stack is already at max length
         """
-        pass
+        stack = self.header_map.get(header_name, None)
+        air_check(isinstance(stack, HeaderStack), IriPacketModError)
+        if stack.shared:
+            stack = self._unshare(stack)
+        header = HeaderInstance(header_name, stack.layout, None)
+        stack.push(header, back)
+        self.header_length += header.length
+        return header.length
 
     def pop_header(self, header_name, back=True):
         """
@@ -280,23 +574,35 @@ class ParsedPacket(object):
         @param header_name The name of the stack to update
         @param back If True, remove the last instance (highest index)
         otherwise remove the first instance (lowest index).
+        @returns The length of the element removed
 
         The header stack must already be present in the parsed packet
 
         If the stack becomes empty, the name is removed from the 
         list of headers in the parsed packet.
 
-        Will raise exception X if the stack is not already present in the
-        parsed packet
+        Will raise IriPacketModError if the stack is not already present in
+        the parsed packet
         """
-        pass
+        stack = self.header_map.get(header_name, None)
+        air_check(isinstance(stack, HeaderStack), IriPacketModError)
+        if stack.shared:
+            stack = self._unshare(stack)
+        header = stack.pop(back)
+        self.header_length -= header.length
+        if stack.current_count == 0:
+            del self.header_map[header_name]
+            self._slot_set(header_name, None)
+        return header.length
 
     def header_valid(self, header_name):
         """
         @brief Return True if the header is present in the parsed packet
-        @param header_name The name of the header instance to check for
+        @param header_name The name of the header (or metadata) instance
+        to check for
         """
-        return header_name in self.header_map.keys()
+        slot = handle_map.slots.get(header_name, None)
+        return slot is not None and self.valid_bits >> slot & 1 == 1
 
     def header_stack_count(self, header_name):
         """
@@ -306,24 +612,172 @@ class ParsedPacket(object):
 
         Returns 0 if the header stack is not present in the packet instance
         """
-        if not header_name in self.header_map.keys():
+        stack = self.header_map.get(header_name, None)
+        if not isinstance(stack, HeaderStack):
             return 0
-        return self.header_map[header_name].current_count
+        return stack.current_count
+
+    def length(self):
+        """
+        @brief Return the length of the packet (headers and payload)
+        """
+        return self.header_length + self.payload_length
+
+    def memory_size(self):
+        """
+        @brief Approximate number of bytes used by this packet instance
+
+        Counts the packet object, its header and metadata containers and
+        the header instances (see HeaderInstance.memory_size). The
+        original packet buffer is not counted.
+        """
+        size = (sys.getsizeof(self) + sys.getsizeof(self.header_map) +
+                sys.getsizeof(self.metadata) +
+                sys.getsizeof(self.header_slots))
+        for header in self.header_map.values():
+            size += header.memory_size()
+        for header in self.metadata.values():
+            size += header.memory_size()
+        return size
 
     def replicate(self):
         """
-        Generate a copy of this item suitable for replication processing
+        @brief Generate a copy of this packet for replication processing
+
+        The replica gets a new id and its own header list and metadata.
+        The original packet buffer and the header instances are shared:
+        headers are marked shared and copied by whichever packet first
+        modifies them, so replicating costs a copy of the metadata plus
+        a copy of each header actually written.
+
+        A replica of a pooled packet is taken from the same pool.
         """
-        replicant = copy.copy(self)
-        # @FIXME Review these
-        replicant.headers = copy.deepcopy(self.header_map)
-        replicant.metadata = copy.deepcopy(self.metadata)
-        self.id = ParsedPacket.id_next
+        if self.pool is None:
+            replicant = ParsedPacket.__new__(ParsedPacket)
+            replicant.pool = None
+        else:
+            replicant = self.pool.take()
+        replicant.original_packet = self.original_packet
+        replicant.header_length = self.header_length
+        replicant.payload_offset = self.payload_offset
+        replicant.payload_length = self.payload_length
+        replicant.parse_error = self.parse_error
+        replicant.lazy = self.lazy
+
+        replicant.id = ParsedPacket.id_next
         ParsedPacket.id_next += 1
         replicant.parent_id = self.id
 
+        replicant.header_slots = list(self.header_slots)
+        replicant.valid_bits = self.valid_bits
+        replicant.header_map = ListDict()
+        for name, header in self.header_map.items():
+            header.shared = True
+            replicant.header_map[name] = header
+        replicant.metadata = {}
+        for name, header in self.metadata.items():
+            replicant.metadata[name] = header.clone()
+            replicant._slot_set(name, replicant.metadata[name])
+
+        logging.debug("Replicated packet %d as %d", self.id, replicant.id)
         return replicant
 
+    def release(self):
+        """
+        @brief Return this packet to the pool it was allocated from
+
+        Call when processing of the packet is complete (transmitted or
+        dropped). The packet must not be used after it is released.
+        """
+        if self.pool is not None:
+            self.pool.release(self)
+
+class ParsedPacketPool(object):
+    """
+    @brief A free list of ParsedPacket objects
+
+    @param metadata_dict Map from metadata name to HeaderLayout (or a
+    metadata_template) for the packets allocated
+    @param max_free The maximum number of released packets kept for reuse
+
+    get() reuses a released packet if one is available: the packet and
+    its metadata headers are reset in place rather than allocated. Packets
+    are normally got in the ingress thread and released in another, so
+    the free list is a deque (append and pop are atomic).
+
+    Attributes:
+      * allocated: Number of packets created by the pool
+      * reused: Number of times a released packet was reused
+    """
+    def __init__(self, metadata_dict, max_free=256):
+        self.template = {}
+        for name, md in metadata_dict.items():
+            if isinstance(md, HeaderInstance):
+                self.template[name] = md
+            else:
+                self.template[name] = HeaderInstance(name, md)
+        self.max_free = max_free
+        self.free = collections.deque()
+        self.allocated = 0
+        self.reused = 0
+
+    def get(self, original_packet, lazy=False):
+        """
+        @brief Get a packet for a newly received packet buffer
+        @param original_packet The packet data (a bytearray)
+        @param lazy If True, header fields are read on first access
+        """
+        try:
+            packet = self.free.pop()
+        except IndexError:
+            packet = ParsedPacket(original_packet, self.template, lazy)
+            packet.pool = self
+            self.allocated += 1
+            return packet
+
+        for name, template in self.template.items():
+            header = packet.metadata.get(name, None)
+            if header is None or header.resized:
+                packet.metadata[name] = template.clone()
+            else:
+                header.values[:] = template.values
+                header.dirty = 0
+        packet._init(original_packet, lazy)
+        self.reused += 1
+        return packet
+
+    def take(self):
+        """
+        @brief Take a packet object for the caller to fill in completely
+        @returns A released packet, or a new, uninitialized one
+
+        Used by ParsedPacket.replicate(), which sets every slot itself.
+        """
+        try:
+            packet = self.free.pop()
+        except IndexError:
+            packet = ParsedPacket.__new__(ParsedPacket)
+            packet.pool = self
+            self.allocated += 1
+            return packet
+        self.reused += 1
+        return packet
+
+    def release(self, packet):
+        """
+        @brief Return a packet to the free list
+        @param packet A ParsedPacket allocated (or replicated) from this pool
+
+        Releasing a packet more than once has no effect.
+        """
+        if packet.original_packet is None: # Already released
+            return
+        packet.original_packet = None
+        packet.header_map = None
+        packet.header_slots = None
+        if len(self.free) < self.max_free:
+            self.free.append(packet)
+
 ################################################################
 
 if __name__ == "__main__":
@@ -362,6 +816,14 @@ if __name__ == "__main__":
     air_assert(repl.payload_offset == 0, "Repl pkt offset check")
     air_assert(repl.header_length == 0, "Repl header len not 0 after eth add")
 
+    # Lookahead reads the payload without adding a header
+    air_assert(ppkt.lookahead(0, 8) == 14 and ppkt.lookahead(4, 8) == 0xe0,
+               "Bad lookahead value")
+    air_assert(ppkt.lookahead(8 * 85, 8) == 99, "Bad lookahead at end")
+    air_assert(ppkt.lookahead(8 * 85, 9) is None,
+               "Lookahead beyond packet end should be None")
+    air_assert(ppkt.header_length == 14, "Lookahead changed the headers")
+
     # Check set/get unparsed fields
     air_assert(ppkt.get_field("ipv4.version") == None,
                "Unparsed field get should return None")
@@ -447,4 +909,206 @@ if __name__ == "__main__":
     air_assert(ppkt.payload_length == 100 - 14, "Post remove length check")
     air_assert(ppkt.payload_offset == 14, "Post remove offset check")
     air_assert(ppkt.header_length == ip_hdr_len, "Post remove hdr len")
-    
+
+    # The validity bits follow headers as they are parsed, added and
+    # removed, and are copied to replicas
+    air_assert(not ppkt.header_valid("ethernet") and
+               ppkt.header_valid("ipv4"), "Bad header validity")
+    air_assert(ppkt.get_field("ethernet") is None and
+               ppkt.get_field("ipv4") is True, "Bad valid reference")
+    ppkt.add_header_before("ethernet", iri.header_layout["ethernet"], "ipv4")
+    air_assert(ppkt.header_valid("ethernet"), "Added header not valid")
+    replica = ppkt.replicate()
+    replica.remove_header("ipv4")
+    air_assert(ppkt.header_valid("ipv4") and not replica.header_valid("ipv4"),
+               "Replica validity not separate")
+    for packet in [ppkt, replica]:
+        expected = 0
+        for name in packet.header_map.keys() + packet.metadata.keys():
+            expected |= 1 << handle_map.slots[name]
+        air_assert(packet.valid_bits == expected,
+                   "Validity bits differ from headers")
+    ppkt.remove_header("ethernet")
+    air_assert(ParsedPacket(bytearray(64), iri.metadata_template).
+               header_valid("route_md"), "Metadata should be valid")
+
+    # Eager and lazy packets must agree on field values and serialization
+    byte_buf = bytearray(range(100))
+    byte_buf[12] = 0x08
+    byte_buf[13] = 0x00
+    eager = ParsedPacket(byte_buf, iri.metadata_layout)
+    lazy = ParsedPacket(byte_buf, iri.metadata_layout, lazy=True)
+    for pkt in [eager, lazy]:
+        pkt.parse_header("ethernet", iri.header_layout["ethernet"])
+        pkt.parse_header("ipv4", iri.header_layout["ipv4"])
+        pkt.set_field("ipv4.ttl", 3)
+    for ref in ["ethernet.ethertype", "ipv4.ihl", "ipv4.flags",
+                "ipv4.fragment_offset", "ipv4.ttl", "ipv4.dst"]:
+        air_assert(eager.get_field(ref) == lazy.get_field(ref),
+                   "Eager/lazy mismatch for %s" % ref)
+    air_assert(eager.serialize() == lazy.serialize(),
+               "Eager/lazy serialize mismatch")
+
+    # Per packet memory for a packet with ethernet/ipv4 and metadata
+    air_assert(not hasattr(eager, "__dict__"), "ParsedPacket has a __dict__")
+    air_assert(not hasattr(eager.header_map["ipv4"], "__dict__"),
+               "HeaderInstance has a __dict__")
+    mem_size = eager.memory_size()
+    logging.info("Memory per packet (eth/ipv4, %d metadata): %d bytes" %
+                 (len(eager.metadata), mem_size))
+    air_assert(mem_size < 4096, "Packet memory size %d too large" % mem_size)
+
+    # Header stacks
+    mpls_layout = iri.header_layout["mpls"]
+    byte_buf = bytearray(range(100))
+    byte_buf[14:22] = bytearray([0, 0x01, 0x00, 0x40, 0, 0x02, 0x01, 0x40])
+    ppkt = ParsedPacket(byte_buf, {})
+    ppkt.parse_header("ethernet", iri.header_layout["ethernet"])
+    ppkt.parse_header("mpls", mpls_layout)
+    ppkt.parse_header("mpls", mpls_layout)
+    air_assert(ppkt.header_stack_count("mpls") == 2, "Expected 2 mpls")
+    air_assert(ppkt.header_length == 22, "Bad length after mpls parse")
+    air_assert(ppkt.get_field("mpls[0].label") == 0x10, "Failed mpls[0]")
+    air_assert(ppkt.get_field("mpls[1].label") == 0x20, "Failed mpls[1]")
+    air_assert(ppkt.get_field("mpls[last].bos") == 1, "Failed mpls[last]")
+    air_assert(ppkt.get_field("mpls.bos") == 1, "Failed unindexed mpls")
+    air_assert(ppkt.get_field("mpls[2].label") is None, "mpls[2] is invalid")
+    air_assert(ppkt.get_field("mpls[1]"), "mpls[1] should be valid")
+    air_assert(ppkt.set_field("mpls[0].ttl", 7) == 7, "Failed mpls[0] set")
+
+    air_assert(ppkt.push_header("mpls", back=False) == 4, "Failed push")
+    air_assert(ppkt.get_field("mpls[1].ttl") == 7, "Push front moved elt")
+    air_assert(ppkt.header_length == 26, "Bad length after push")
+    serialized = ppkt.serialize()
+    air_assert(serialized[14:18] == bytearray(4), "Pushed element not zero")
+    air_assert(serialized[18:22] == bytearray([0, 0x01, 0x00, 0x07]),
+               "Failed mpls[1] serialize")
+    for idx in range(3):
+        ppkt.pop_header("mpls")
+    air_assert(not ppkt.header_valid("mpls"), "Empty stack should be removed")
+    air_assert(ppkt.header_length == 14, "Bad length after pops")
+    try:
+        ppkt.pop_header("mpls")
+        air_assert(False, "Pop of missing stack should fail")
+    except IriPacketModError:
+        pass
+
+    # Scatter-gather serialization: unmodified data is not copied
+    byte_buf = bytearray(range(100))
+    byte_buf[12:14] = bytearray([0x08, 0x00])
+    byte_buf[14] = 0x45
+    ppkt = ParsedPacket(byte_buf, {})
+    ppkt.parse_header("ethernet", iri.header_layout["ethernet"])
+    ppkt.parse_header("ipv4", iri.header_layout["ipv4"])
+    segments = ppkt.serialize_segments()
+    air_assert(len(segments) == 1, "Unmodified packet should be 1 segment")
+    air_assert(segments[0] == byte_buf, "Bad unmodified segment")
+    ppkt.set_field("ipv4.ttl", 1)
+    segments = ppkt.serialize_segments()
+    air_assert(len(segments) == 3, "Expected eth, ipv4, payload segments")
+    air_assert(isinstance(segments[0], memoryview) and
+               isinstance(segments[2], memoryview),
+               "Unmodified segments should be memoryviews")
+    expected = bytearray(byte_buf)
+    expected[22] = 1
+    air_assert(ppkt.serialize(segments) == expected, "Bad joined segments")
+    ppkt.remove_header("ethernet")
+    air_assert(ppkt.serialize() == expected[14:], "Bad serialize w/o eth")
+
+    # Copy-on-write replication
+    byte_buf = bytearray(range(100))
+    byte_buf[12:14] = bytearray([0x08, 0x00])
+    byte_buf[14] = 0x45
+    ppkt = ParsedPacket(byte_buf, iri.metadata_layout)
+    ppkt.parse_header("ethernet", iri.header_layout["ethernet"])
+    ppkt.parse_header("ipv4", iri.header_layout["ipv4"])
+    ppkt.set_field("intrinsic_metadata.egress_port", 1)
+    replicas = [ppkt.replicate() for idx in range(16)]
+    for replica in replicas:
+        air_assert(replica.id != ppkt.id and replica.parent_id == ppkt.id,
+                   "Bad replica ids")
+        air_assert(replica.header_map["ipv4"] is ppkt.header_map["ipv4"],
+                   "Replica headers should be shared until written")
+        air_assert(replica.metadata["intrinsic_metadata"] is not
+                   ppkt.metadata["intrinsic_metadata"],
+                   "Replica metadata should not be shared")
+    air_assert(len(set([replica.id for replica in replicas])) == 16,
+               "Replica ids not unique")
+    replica = replicas[0]
+    replica.set_field("ipv4.ttl", 3)
+    replica.set_field("intrinsic_metadata.egress_port", 2)
+    air_assert(replica.get_field("ipv4.ttl") == 3, "Failed replica set")
+    air_assert(ppkt.get_field("ipv4.ttl") == byte_buf[22],
+               "Replica write changed original")
+    air_assert(ppkt.get_field("intrinsic_metadata.egress_port") == 1,
+               "Replica metadata write changed original")
+    air_assert(replica.header_map["ethernet"] is ppkt.header_map["ethernet"],
+               "Unwritten header should still be shared")
+    air_assert(replica.header_map.keys() == ["ethernet", "ipv4"],
+               "Copy on write changed header order")
+    air_assert(ppkt.serialize() == byte_buf, "Original changed by replica")
+    expected = bytearray(byte_buf)
+    expected[22] = 3
+    air_assert(replica.serialize() == expected, "Bad replica serialize")
+    ppkt.set_field("ipv4.ttl", 4)
+    air_assert(replica.get_field("ipv4.ttl") == 3,
+               "Original write changed replica")
+    air_assert(replicas[1].get_field("ipv4.ttl") == byte_buf[22],
+               "Original write changed other replica")
+
+    # Header stacks are copied on write too
+    byte_buf = bytearray(range(100))
+    byte_buf[0:8] = bytearray([0, 0x01, 0x00, 0x40, 0, 0x02, 0x01, 0x40])
+    ppkt = ParsedPacket(byte_buf, {})
+    ppkt.parse_header("mpls", mpls_layout)
+    ppkt.parse_header("mpls", mpls_layout)
+    replica = ppkt.replicate()
+    replica.set_field("mpls[0].label", 0x77)
+    replica.pop_header("mpls")
+    air_assert(ppkt.header_stack_count("mpls") == 2, "Replica pop on orig")
+    air_assert(ppkt.get_field("mpls[0].label") != 0x77, "Replica set on orig")
+    air_assert(replica.get_field("mpls[0].label") == 0x77,
+               "Failed replica stack set")
+
+    # Metadata template and packet pool
+    template = metadata_template(iri.metadata_layout)
+    ppkt = ParsedPacket(bytearray(64), template)
+    for name, header in ppkt.metadata.items():
+        air_assert(header is not template[name], "Template not cloned")
+    ppkt.set_field("intrinsic_metadata.egress_port", 9)
+    air_assert(template["intrinsic_metadata"].get_field("egress_port") == 0,
+               "Packet changed metadata template")
+
+    pool = ParsedPacketPool(template, max_free=2)
+    first = pool.get(bytearray(range(64)))
+    first.parse_header("ethernet", iri.header_layout["ethernet"])
+    first.set_field("intrinsic_metadata.egress_port", 5)
+    first_id = first.id
+    first.release()
+    first.release()
+    air_assert(len(pool.free) == 1, "Double release should be ignored")
+    second = pool.get(bytearray(64))
+    air_assert(second is first and pool.reused == 1, "Packet not reused")
+    air_assert(second.id != first_id, "Reused packet needs a new id")
+    air_assert(not second.header_valid("ethernet"), "Headers not reset")
+    air_assert(second.get_field("intrinsic_metadata.egress_port") == 0,
+               "Metadata not reset")
+    air_assert(not second.metadata["intrinsic_metadata"].modified,
+               "Reset metadata marked modified")
+    replica = second.replicate()
+    air_assert(replica.pool is pool and pool.allocated == 2,
+               "Replica not from pool")
+    for packet in [second, replica, pool.get(bytearray(64))]:
+        packet.release()
+    air_assert(len(pool.free) == 2, "Pool grew beyond max_free")
+    air_assert(pool.allocated == 3, "Bad pool allocation count")
+    source = pool.get(bytearray(range(64)))
+    source.parse_header("ethernet", iri.header_layout["ethernet"])
+    reused = source.replicate()
+    air_assert(pool.free == collections.deque() and pool.allocated == 3 and
+               pool.reused == 3, "Replica did not reuse a released packet")
+    air_assert(reused.header_valid("ethernet") and
+               reused.metadata is not source.metadata,
+               "Reused replica not initialized")
+    ParsedPacket(bytearray(64), template).replicate().release()
+    air_assert(pool.free == collections.deque(), "Unpooled replica pooled")
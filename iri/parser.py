@@ -7,20 +7,76 @@
 
 import os
 import sys
+import time
 import logging
+import threading
 import pydot
 
 from air.air_common import *
 from iri_exception import *
 from parsed_packet import ParsedPacket
+from field_handle import field_handle, Lookahead, lookahead_parse
+from parse_cache import ParseCache
 from processor import Processor
 
+def _select_value_component(value_str):
+    """
+    @brief Parse one value, "value" or "value &&& mask"
+    @returns (value, mask); mask is None for an exact value
+    """
+    if "&&&" in value_str:
+        (value_str, mask_str) = value_str.split("&&&")
+        mask = int(mask_str.strip(), 0)
+        return (int(value_str.strip(), 0) & mask, mask)
+    return (int(value_str.strip(), 0), None)
+
+def select_value_parse(value_str):
+    """
+    @brief Parse the value attribute of a parse graph edge
+    @param value_str The attribute, for example "0x0800", "0x40 &&& 0xf0"
+    or, for a select on several fields, "(0x0800, 4 &&& 0xf)"
+    @returns (value, mask) where value is an integer or a tuple of
+    integers. mask is None for an exact value; otherwise it has the
+    shape of value, with None for the exact components of a tuple.
+    """
+    value_str = value_str.strip().strip("'\"").strip()
+    if not (value_str.startswith("(") and value_str.endswith(")")):
+        return _select_value_component(value_str)
+    parts = [part for part in value_str[1:-1].split(",") if part.strip()]
+    components = [_select_value_component(part) for part in parts]
+    value = tuple([component[0] for component in components])
+    mask = tuple([component[1] for component in components])
+    if mask.count(None) == len(mask):
+        mask = None
+    return (value, mask)
+
+def select_value_mask(value, mask):
+    """
+    @brief Apply a mask from select_value_parse to a select value
+    @returns The masked value or None if a masked component is None
+    (its header is not valid)
+    """
+    if not isinstance(mask, tuple):
+        if value is None:
+            return None
+        return value & mask
+    masked = []
+    for component, component_mask in zip(value, mask):
+        if component_mask is not None:
+            if component is None:
+                return None
+            component &= component_mask
+        masked.append(component)
+    return tuple(masked)
+
 class ParserStateTransition(object):
     """
     @brief Holds and manages the transition information for a parser state
 
     @param value_map Map from specific values to next parser states
-    @param all_value_sets Map from name to reference for all value sets
+    @param masked_values List of (value, mask, next state) for
+    transitions on masked values, in the order of the edges
+    @param all_value_sets Map from name to ValueSet for all value sets
     @param in_value_sets Map from value_set name to next state for
     select values in the given value set
     @param not_in_value_sets Map from value_set name to next state for
@@ -44,6 +100,7 @@ class ParserStateTransition(object):
         self.name = src_state_name
         self.default = None
         self.value_map = {}
+        self.masked_values = []
         self.all_value_sets = all_value_sets
         self.in_value_sets = {}
         self.not_in_value_sets = {}
@@ -67,16 +124,16 @@ class ParserStateTransition(object):
             return self.default
 
         # Is specific value specified in 
-        if select_value in self.value_map.keys():
+        if select_value in self.value_map:
             return self.value_map[select_value]
 
         # Not a specific value, check value sets and negations of same
-        for value_set, next_state in self.in_value_sets.items():
-            if select_value in value_set:
+        for set_name, next_state in self.in_value_sets.items():
+            if select_value in self.all_value_sets[set_name]:
                 return next_state
 
-        for value_set, next_state in self.not_in_value_sets.items():
-            if select_value not in value_set:
+        for set_name, next_state in self.not_in_value_sets.items():
+            if select_value not in self.all_value_sets[set_name]:
                 return next_state
 
         # Check for default value
@@ -94,12 +151,15 @@ class ParserStateTransition(object):
 
         # First, is an explicit value given for the transition?
         if "value" in attrs:
-            val_str = attrs["value"].strip("'\"")
-            value = int(val_str, 0)
-            self.value_map[value] = next_state
-
-            logging.debug("Parser transition: %s to %s, equal to 0x%x (%d)" %
-                          (self.name, next_state, value, value))
+            (value, mask) = select_value_parse(attrs["value"])
+            if mask is None:
+                self.value_map[value] = next_state
+                logging.debug("Parser transition: %s to %s, equal to %s" %
+                              (self.name, next_state, str(value)))
+            else:
+                self.masked_values.append((value, mask, next_state))
+                logging.debug("Parser transition: %s to %s, %s mask %s" %
+                              (self.name, next_state, str(value), str(mask)))
             return
             
         # Is a "in_value_set" given for the transition?
@@ -131,14 +191,254 @@ class ParserStateTransition(object):
                           (self.name, next_state))
             self.default = next_state
             
+class ParserState(object):
+    """
+    @brief A parse state compiled for packet processing
+
+    @param name The name of the parse state
+    @param index The position of the state in Parser.states
+    @param extracts List of (header_name, HeaderLayout, opaque) triples
+    for the headers to extract; if opaque is True, the header's bytes
+    are kept without decoding its fields (see Parser.set_opaque_headers)
+    @param select_handles Tuple of FieldHandles of the select fields (or
+    Lookahead objects); empty if the state does not select. With one
+    field the select value is the field's value, otherwise the tuple of
+    the fields' values.
+    @param value_map Map from select value to next ParserState (or None to
+    end parsing) for transitions on specific values
+    @param masked_values List of (value, mask, next ParserState) for
+    transitions on masked values (see select_value_parse), highest
+    priority first
+    @param masked_dispatch Map from select value to next ParserState for
+    masked_values expanded into all the values they match, or None if
+    they match too many values to expand
+    @param masked_groups List of (mask, map from masked value to next
+    ParserState) used to look up masked_values when not expanded
+    @param value_set_edges List of (ValueSet, next ParserState, negate)
+    for in_value_set (negate False) and not_in_value_set transitions
+    @param default The next ParserState when nothing matches, or None
+    @param compiled The triple (dispatch, miss, scan) used by next_state
+
+    Records are linked directly to their successors. Normally all
+    transitions are compiled into the dispatch dict: the specific and
+    (expanded) masked values, the exact members of the value sets and,
+    for a not_in_value_set edge, miss as the state for values in no set.
+    Processing a state is then the extracts plus one dict lookup, even
+    when the select value is a tuple of several fields.
+
+    If masked values cannot be expanded, a value set has masked or range
+    members, or there is more than one not_in_value_set edge, scan is
+    True: values not in the value_map are checked against each mask
+    group and then each value set's index in turn.
+
+    When a value set gains or loses an exact member, only that value's
+    entry changes, in a copy of the dispatch dict; other value set
+    changes recompile the state. compiled is replaced in a single
+    assignment so parsing need not be locked; changes are serialized by
+    compile_lock.
+    """
+    __slots__ = ["name", "index", "extracts", "select_handles", "value_map",
+                 "masked_values", "masked_dispatch", "masked_groups",
+                 "value_set_edges", "default", "compiled"]
+
+    # Masked values are expanded if each matches at most 2**N values
+    MAX_EXPAND_BITS = 8
+
+    compile_lock = threading.Lock()
+
+    def __init__(self, name, index):
+        self.name = name
+        self.index = index
+        self.extracts = []
+        self.select_handles = ()
+        self.value_map = {}
+        self.masked_values = []
+        self.masked_dispatch = {}
+        self.masked_groups = []
+        self.value_set_edges = []
+        self.default = None
+        self.compiled = ({}, None, False)
+
+    def select(self, parsed_packet):
+        """
+        @brief Return the select value for a packet (None if no select)
+        """
+        handles = self.select_handles
+        if len(handles) == 1:
+            handle = handles[0]
+            if handle.__class__ is Lookahead:
+                return parsed_packet.lookahead(handle.bit_offset, handle.width)
+            return parsed_packet.get(handle)
+        if not handles:
+            return None
+        values = []
+        for handle in handles:
+            if handle.__class__ is Lookahead:
+                values.append(parsed_packet.lookahead(handle.bit_offset,
+                                                      handle.width))
+            else:
+                values.append(parsed_packet.get(handle))
+        return tuple(values)
+
+    @staticmethod
+    def _expand(value, mask, widths):
+        """
+        @brief Return the list of select values matching a masked value
+        @param widths The width of each select field
+        @returns The list or None if it would be too long
+        """
+        if not isinstance(value, tuple):
+            (value, mask) = ((value,), (mask,))
+        wildcards = []
+        for component, (component_mask, width) in enumerate(zip(mask,
+                                                                 widths)):
+            if component_mask is None:
+                continue
+            if width is None:
+                return None
+            for bit in range(width):
+                if not (component_mask >> bit) & 1:
+                    wildcards.append((component, bit))
+        if len(wildcards) > ParserState.MAX_EXPAND_BITS:
+            return None
+
+        values = []
+        for combination in range(1 << len(wildcards)):
+            expanded = list(value)
+            for position, (component, bit) in enumerate(wildcards):
+                if (combination >> position) & 1:
+                    expanded[component] |= 1 << bit
+            if len(expanded) == 1:
+                values.append(expanded[0])
+            else:
+                values.append(tuple(expanded))
+        return values
+
+    def compile_masked(self, widths):
+        """
+        @brief Build the lookup structures for masked_values
+        @param widths The width of each select field (None if variable)
+
+        Called once the masked values are known; they do not change.
+        """
+        self.masked_groups = []
+        groups = {}
+        for (value, mask, next_state) in self.masked_values:
+            if mask not in groups:
+                groups[mask] = {}
+                self.masked_groups.append((mask, groups[mask]))
+            groups[mask].setdefault(value, next_state)
+
+        # Lowest priority first so higher priority entries overwrite
+        self.masked_dispatch = {}
+        for (value, mask, next_state) in reversed(self.masked_values):
+            expanded = ParserState._expand(value, mask, widths)
+            if expanded is None:
+                self.masked_dispatch = None
+                break
+            for expanded_value in expanded:
+                self.masked_dispatch[expanded_value] = next_state
+        self.compile()
+
+    def compile(self, value_set=None, change=None):
+        """
+        @brief Build the dispatch dict for the current value set members
+        @param value_set The value set that changed, if any
+        @param change The change made to value_set (see ValueSet)
+
+        Registered as a listener of the state's value sets.
+        """
+        with ParserState.compile_lock:
+            if change is None or change[0] is None:
+                self._compile_all()
+            elif not self.compiled[2]:
+                self._compile_value(change[0])
+            # Otherwise next_state checks the value sets' members
+
+    def _compile_value(self, value):
+        """
+        @brief Update the dispatch entry for one value set member value
+        """
+        (dispatch, miss, scan) = self.compiled
+        if value in self.value_map or value in self.masked_dispatch:
+            return
+        # As _compile_all: the first in_value_set edge whose set has the
+        # value wins, else the default if a not_in_value_set set has it
+        (found, next_state) = (False, None)
+        for (vset, edge_state, negate) in self.value_set_edges:
+            if value in vset.members.exact:
+                (found, next_state) = (True, self.default)
+                if not negate:
+                    next_state = edge_state
+                    break
+        dispatch = dict(dispatch)
+        if found:
+            dispatch[value] = next_state
+        else:
+            dispatch.pop(value, None)
+        self.compiled = (dispatch, miss, False)
+
+    def _compile_all(self):
+        """
+        @brief Build the compiled triple from all transitions
+        """
+        members = [(vset.members, next_state, negate) for
+                   (vset, next_state, negate) in self.value_set_edges]
+        negated = [edge for edge in members if edge[2]]
+        scan = len(negated) > 1 or self.masked_dispatch is None
+        for (vset_members, next_state, negate) in members:
+            if not vset_members.exact_only:
+                scan = True
+        if scan:
+            self.compiled = (self.value_map, self.default, True)
+            return
+
+        # Lowest priority first so higher priority entries overwrite
+        dispatch = {}
+        miss = self.default
+        if negated:
+            (vset_members, next_state, negate) = negated[0]
+            for value in vset_members.exact:
+                dispatch[value] = self.default
+            dispatch[None] = self.default
+            miss = next_state
+        for (vset_members, next_state, negate) in reversed(members):
+            if not negate:
+                for value in vset_members.exact:
+                    dispatch[value] = next_state
+        dispatch.update(self.masked_dispatch)
+        dispatch.update(self.value_map)
+        self.compiled = (dispatch, miss, False)
+
+    def next_state(self, select_value):
+        """
+        @brief Return the next ParserState given the select value
+        """
+        (dispatch, miss, scan) = self.compiled
+        if not scan:
+            return dispatch.get(select_value, miss)
+
+        if select_value is None:
+            return self.default
+        if select_value in dispatch:
+            return dispatch[select_value]
+        for (mask, masked_map) in self.masked_groups:
+            masked_value = select_value_mask(select_value, mask)
+            if masked_value in masked_map:
+                return masked_map[masked_value]
+        for (vset, next_state, negate) in self.value_set_edges:
+            if (select_value in vset) != negate:
+                return next_state
+        return self.default
+
 class Parser(Processor):
     """
     @brief A parser object
     @param name The name of the parser
     @param air_parser_attrs The attributes from the AIR description
     @param parser_states The map for all parser states
-    @param headers The map for all header instances
-    @param value_sets The map for all value sets
+    @param headers The map from header name to HeaderLayout
+    @param value_sets The map from name to ValueSet for all value sets
 
     @todo Support explicit error indications
     @todo Should we just pass the IRI instance object in for init?
@@ -167,12 +467,179 @@ class Parser(Processor):
         for state_name in all_parser_states:
             self.transitions[state_name] = ParserStateTransition(
                 state_name, all_edges, all_value_sets)
+
+        self._compile()
+
+        # Function applying the parse states to a packet; may be replaced
+        # by a generated function (see parser_codegen.py)
+        self.parse_states = self.interpret
+        self.source = None # Source of the generated function, if any
+        self.parse_cache = None # See enable_parse_cache
+
+    def _compile(self):
+        """
+        @brief Build the ParserState records from the parse graph
+
+        Sets self.states, the list of records, self.state_map, the map
+        from state name to record, and self.first_state. Extracted
+        headers and next states are resolved here. An unknown next state
+        raises IriReferenceError; an unknown header is logged and raises
+        IriReferenceError if a packet reaches the state.
+        """
+        self.states = []
+        self.state_map = {}
+        for state_name in sorted(self.parser_states.keys()):
+            state = ParserState(state_name, len(self.states))
+            self.states.append(state)
+            self.state_map[state_name] = state
+
+        def resolve(next_state_name):
+            if next_state_name is None:
+                return None
+            if next_state_name not in self.state_map:
+                raise IriReferenceError("Parser %s: unknown parse state %s" %
+                                        (self.name, next_state_name))
+            return self.state_map[next_state_name]
+
+        for state in self.states:
+            state_attrs = self.parser_states[state.name]
+            for hdr_name in state_attrs.get("extracts", None) or []:
+                if hdr_name not in self.headers:
+                    # Only an error if a packet reaches this state
+                    logging.warn("Parse state %s: unknown header %s" %
+                                 (state.name, hdr_name))
+                state.extracts.append((hdr_name,
+                                       self.headers.get(hdr_name, None),
+                                       False))
+            # @todo Use eval in combination with field value subs
+            fld_refs = state_attrs.get("select_value", None) or []
+            if not isinstance(fld_refs, list):
+                fld_refs = [fld_refs]
+            handles = []
+            for fld_ref in fld_refs:
+                handle = lookahead_parse(fld_ref) or field_handle(fld_ref)
+                if handle is None:
+                    raise IriReferenceError("Parse state %s: bad select %s" %
+                                            (state.name, fld_ref))
+                handles.append(handle)
+            state.select_handles = tuple(handles)
+
+            transition = self.transitions[state.name]
+            for value, next_state_name in transition.value_map.items():
+                self._check_select_value(state, value)
+                state.value_map[value] = resolve(next_state_name)
+            for value, mask, next_state_name in transition.masked_values:
+                self._check_select_value(state, value)
+                state.masked_values.append((value, mask,
+                                            resolve(next_state_name)))
+            state.default = resolve(transition.default)
+            for negate, value_sets in [(False, transition.in_value_sets),
+                    (True, transition.not_in_value_sets)]:
+                for set_name, next_state_name in value_sets.items():
+                    value_set = self.all_value_sets[set_name]
+                    state.value_set_edges.append(
+                        (value_set, resolve(next_state_name), negate))
+                    value_set.add_listener(state.compile)
+            state.compile_masked([self._select_width(select_handle) for
+                                  select_handle in state.select_handles])
+
+        self.first_state = resolve(self.first_state_name)
                 
+    def _check_select_value(self, state, value):
+        """
+        @brief Check a transition value has one component per select field
+        """
+        count = len(state.select_handles)
+        if isinstance(value, tuple):
+            valid = count > 1 and len(value) == count
+        else:
+            valid = count == 1
+        if not valid:
+            raise IriParamError("Parse state %s: value %s does not match "
+                                "%d select fields" %
+                                (state.name, str(value), count))
+
+    def _select_width(self, handle):
+        """
+        @brief Return the width of a select field or None if not constant
+        """
+        if isinstance(handle, Lookahead):
+            return handle.width
+        layout = self.headers.get(handle.header, None)
+        if layout is None or handle.field is None:
+            return None
+        idx = handle.field_index(layout)
+        if idx is None:
+            return None
+        return layout.widths[idx]
+
+    def set_opaque_headers(self, header_names):
+        """
+        @brief Extract the given headers as opaque byte blocks
+        @param header_names The set of header names whose fields are never
+        read (see liveness.py); must be fixed length, not header stacks
+
+        Opaque headers are still valid in the packet and serialized
+        verbatim, but their fields are not decoded; reading a field of
+        one returns 0. Generated parse code must be regenerated after
+        this is called.
+        """
+        for state in self.states:
+            state.extracts = [(hdr_name, layout, hdr_name in header_names)
+                              for (hdr_name, layout, opaque) in state.extracts]
+        if self.parse_cache is not None:
+            self.parse_cache.invalidate()
+
+    def enable_parse_cache(self, max_entries=1024):
+        """
+        @brief Parse packets from the start state through a ParseCache
+        @param max_entries The maximum number of cached parse results;
+        0 disables the cache
+        @returns The ParseCache or None
+
+        Packets whose select field values match an earlier packet's
+        replay its extracts without running the transitions (or, when
+        parsed lazily, reading any header fields); see parse_cache.py.
+        """
+        self.parse_cache = None
+        if max_entries:
+            self.parse_cache = ParseCache(self, max_entries)
+        return self.parse_cache
+
+    def interpret(self, parsed_packet, state=None):
+        """
+        @brief Run the parse states on a packet using the state records
+        @param parsed_packet The packet to parse, a parsed packet instance
+        @param state The name of the parse state to start at; if None,
+        the start state of the parser
+
+        Parsing stops, with parsed_packet.parse_error set, if a header
+        cannot be extracted.
+        """
+        if state is None:
+            state = self.first_state
+        else:
+            state = self.state_map[state]
+        while state is not None:
+            for hdr_name, layout, opaque in state.extracts:
+                if layout is None:
+                    raise IriReferenceError("Parse state %s: unknown header %s"
+                                            % (state.name, hdr_name))
+                if not parsed_packet.parse_header(hdr_name, layout, opaque):
+                    return
+            select_value = state.select(parsed_packet)
+            next_state = state.next_state(select_value)
+            logging.debug("Parser trans from %s to %s on value %s",
+                          state.name, next_state and next_state.name,
+                          select_value)
+            state = next_state
+
     def process(self, parsed_packet, state=None):
         """
         @brief Apply this parser to the given packet
         @param parsed_packet The packet to parse, a parsed packet instance
-        @param state The parse state to start at
+        @param state The name of the parse state to start at; if None,
+        the start state of the parser
 
         The parsed packet object tracks the "current offest", etc.
 
@@ -181,31 +648,18 @@ class Parser(Processor):
 
         air_check(isinstance(parsed_packet, ParsedPacket), IriParamError)
 
-        drop_packet = False # @todo Not implemented yet
-
-        logging.debug("Parser: pkt id %d" % parsed_packet.id)
-        state_name = self.first_state_name
-        while state_name:
-            logging.debug("Parser: In state %s" % state_name)
-            state_attrs = self.parser_states[state_name]
-            transitions = self.transitions[state_name]
-            next_state = None
-            select_value = None
-
-            if "extracts" in state_attrs.keys():
-                for hdr_name in state_attrs["extracts"]:
-                    logging.debug("Parser: extract %s" % hdr_name)
-                    parsed_packet.parse_header(hdr_name, 
-                                               self.headers[hdr_name])
-            if "select_value" in state_attrs.keys():
-                # @todo Use eval in combination with field value subs
-                fld_ref = state_attrs["select_value"][0]
-                select_value = parsed_packet.get_field(fld_ref)
-
-            next_state = transitions.next_state(select_value)
-            logging.debug("Parser trans from %s to %s on value %s" %
-                          (state_name, str(next_state), str(select_value)))
-            state_name = next_state
+        logging.debug("Parser: pkt id %d", parsed_packet.id)
+        if state is None and self.parse_cache is not None:
+            self.parse_cache.parse(parsed_packet)
+        else:
+            self.parse_states(parsed_packet, state)
+
+        # Packets that failed to parse are dropped
+        drop_packet = parsed_packet.parse_error is not None
+        if drop_packet:
+            logging.debug("Parser %s, pkt %d: Parse error: %s" %
+                          (self.name, parsed_packet.id,
+                           parsed_packet.parse_error))
 
         if not drop_packet and self.next_processor is not None:
             logging.debug("Parser %s, pkt %d: Next processor %s" %
@@ -215,6 +669,7 @@ class Parser(Processor):
         else:
             logging.debug("Parser %s: Dropping pkt %d", self.name,
                           parsed_packet.id)
+            parsed_packet.release()
 
 ################################################################
 
@@ -263,7 +718,297 @@ if __name__ == "__main__":
         air_assert(ppkt.get_field("ethernet"),
                    "Failed ethernet header valid check")
         if "vlan_tag_outer" in iri.header.keys():
-            air_assert(ppkt.header_length == 18, "Did not parser ether+vlan hdr")
+            air_assert(ppkt.header_length == 18,
+                       "Did not parser ether+vlan hdr")
             air_assert("vlan_tag_outer" in ppkt.header_map.keys(), 
                        "Did not parser vlan hdr")
 
+
+    # MPLS label stack; parse state loops until bottom of stack
+    if "mpls" in iri.header.keys():
+        byte_buf = bytearray(range(100))
+        byte_buf[12:14] = bytearray([0x88, 0x47])
+        byte_buf[14:22] = bytearray([0, 0x01, 0x00, 0x40, 0, 0x02, 0x01, 0x40])
+        byte_buf[22] = 0x45
+        ppkt = ParsedPacket(byte_buf, {})
+        parser.process(ppkt)
+        air_assert(ppkt.header_stack_count("mpls") == 2,
+                   "Did not parse 2 mpls labels")
+        air_assert(ppkt.get_field("mpls[last].label") == 0x20,
+                   "Bad last mpls label")
+        air_assert("ipv4" in ppkt.header_map, "Did not parse ipv4 after mpls")
+
+    # Compiled transitions with value sets
+    from value_set import ValueSet
+    states = [ParserState(name, idx) for idx, name in
+              enumerate(["start", "a", "b", "c", "d"])]
+    (start, a_state, b_state, c_state, d_state) = states
+    tunnels = ValueSet("tunnels")
+    local_ports = ValueSet("local_ports")
+    start.value_map[1] = a_state
+    start.default = d_state
+    start.value_set_edges.append((tunnels, b_state, False))
+    start.value_set_edges.append((local_ports, c_state, True))
+    for vset in [tunnels, local_ports]:
+        vset.add_listener(start.compile)
+    start.compile()
+    tunnels.add_list([1, 2, 3])
+    local_ports.add_list([3, 4])
+    air_assert(not start.compiled[2], "Exact value sets should not scan")
+    expected = {1 : a_state, 2 : b_state, 3 : b_state, 4 : d_state,
+                5 : c_state, None : d_state}
+    for value, next_state in expected.items():
+        air_assert(start.next_state(value) is next_state,
+                   "Bad next state for %s" % str(value))
+    # Adding or removing an exact member changes its dispatch entry in a
+    # copy, leaving the state as a full compile would
+    published = start.compiled[0]
+    changes = [(tunnels.add, 4), (tunnels.add, 5), (local_ports.remove, 3),
+               (tunnels.remove, 2), (local_ports.add, 9)]
+    for (change, value) in changes:
+        change(value)
+    air_assert(published[2] is b_state and published[4] is d_state and
+               9 not in published,
+               "Dispatch changed in place")
+    air_assert(start.next_state(2) is c_state and
+               start.next_state(4) is b_state and
+               start.next_state(9) is d_state, "Bad incremental compile")
+    for (change, value) in reversed(changes):
+        incremental = start.compiled
+        start.compile()
+        air_assert(start.compiled == incremental,
+                   "Incremental compile differs from a full compile")
+        getattr(change.__self__, {"add" : "remove", "remove" : "add"}
+                [change.__name__])(value)
+    air_assert(start.compiled[0] == published, "Changes not undone")
+    tunnels.add_range(100, 199)
+    air_assert(start.compiled[2], "Range member should scan")
+    expected.update({150 : b_state, 200 : c_state})
+    for value, next_state in expected.items():
+        air_assert(start.next_state(value) is next_state,
+                   "Bad next state for %s with range" % str(value))
+
+    if "vxlan_ports" in iri.iri_value_set:
+        def parse_from_port(port):
+            ppkt = ParsedPacket(bytearray(100), iri.metadata_template)
+            ppkt.set_field("intrinsic_metadata.ingress_port", port)
+            parser.process(ppkt)
+            return ppkt
+        air_assert(parse_from_port(7).header_valid("inner_ethernet"),
+                   "Port not in vxlan_ports should parse inner ethernet")
+        iri.iri_value_set["vxlan_ports"].add_list(range(5, 10))
+        air_assert(parse_from_port(7).header_valid("outer_ethernet"),
+                   "Port in vxlan_ports should parse outer ethernet")
+        iri.iri_value_set["vxlan_ports"].remove(7)
+        air_assert(parse_from_port(7).header_valid("inner_ethernet"),
+                   "Removed port should parse inner ethernet")
+
+    # Transition values on several fields and masked values
+    air_assert(select_value_parse("'0x0800'") == (0x800, None),
+               "Bad parse of exact value")
+    air_assert(select_value_parse("0x45 &&& 0xf0") == (0x40, 0xf0),
+               "Bad parse of masked value")
+    air_assert(select_value_parse("(0x0800, 4 &&& 0xf)") ==
+               ((0x800, 4), (None, 0xf)), "Bad parse of tuple value")
+    air_assert(select_value_parse("(0x0800, 4)") == ((0x800, 4), None),
+               "Bad parse of exact tuple value")
+    air_assert(select_value_mask((0x800, None), (None, 0xf)) is None,
+               "Invalid field should not match masked value")
+
+    if "ipv4" in iri.header_layout and "ethernet" in iri.header_layout:
+        from parser_codegen import parser_codegen
+        compound_states = {
+            "start_p" : {"extracts" : ["ethernet"],
+                         "select_value" : ["ethernet.ethertype"]},
+            "ip_p" : {"extracts" : ["ipv4"],
+                      "select_value" : ["ipv4.version", "ipv4.protocol"]},
+            "udp_p" : {"extracts" : ["udp"]},
+            "tcp_p" : {"extracts" : ["tcp"]},
+            "other_p" : {},
+            "far_p" : {},
+        }
+        compound_attrs = {"start_state" : "start_p", "implementation" : """
+            digraph {
+              start_p -> ip_p [value="0x0800"]
+              start_p -> other_p [value="0x8800 &&& 0xfff0"]
+              start_p -> far_p [value="0x9000 &&& 0xf000"]
+              ip_p -> udp_p [value="(4, 17)"]
+              ip_p -> tcp_p [value="(4, 6)"]
+              ip_p -> other_p [value="(4, 0x80 &&& 0x80)"]
+            }"""}
+        compound = Parser("compound", compound_attrs, compound_states,
+                          iri.header_layout, iri.iri_value_set)
+        ip_p = compound.state_map["ip_p"]
+        start_p = compound.state_map["start_p"]
+        other_p = compound.state_map["other_p"]
+        air_assert(not ip_p.compiled[2] and
+                   ip_p.compiled[0][(4, 0x81)] is other_p,
+                   "Masked tuple value not expanded")
+        air_assert(start_p.masked_dispatch is None and start_p.compiled[2],
+                   "Wide mask should not be expanded")
+        expected = {(4, 17) : "udp_p", (4, 6) : "tcp_p", (4, 0xfe) : "other_p",
+                    (6, 17) : None, (4, 0x7f) : None}
+        for value, name in expected.items():
+            next_state = ip_p.next_state(value)
+            air_assert((next_state and next_state.name) == name,
+                       "Bad next state for %s" % str(value))
+        expected = {0x800 : "ip_p", 0x880f : "other_p", 0x9abc : "far_p",
+                    0x8810 : None, None : None}
+        for value, name in expected.items():
+            next_state = start_p.next_state(value)
+            air_assert((next_state and next_state.name) == name,
+                       "Bad next state for %s" % str(value))
+
+        compound.next_processor = None
+        byte_buf = bytearray(range(100))
+        byte_buf[12:14] = bytearray([0x08, 0x00])
+        byte_buf[14] = 0x45
+        results = []
+        for protocol in [6, 17, 0x85, 1]:
+            byte_buf[23] = protocol
+            interpreted = ParsedPacket(bytearray(byte_buf), {})
+            compound.interpret(interpreted)
+            results.append(interpreted.header_map.keys())
+        air_assert(results == [["ethernet", "ipv4", "tcp"],
+                               ["ethernet", "ipv4", "udp"],
+                               ["ethernet", "ipv4"], ["ethernet", "ipv4"]],
+                   "Bad compound select parse: %s" % str(results))
+        parser_codegen(compound)
+        for protocol, keys in zip([6, 17, 0x85, 1], results):
+            byte_buf[23] = protocol
+            generated = ParsedPacket(bytearray(byte_buf), {})
+            compound.parse_states(generated)
+            air_assert(generated.header_map.keys() == keys,
+                       "Generated compound select parse differs")
+        # Select on the IP version nibble before extracting the header
+        guess_states = {
+            "start_p" : {"extracts" : ["ethernet"],
+                         "select_value" : ["ethernet.ethertype",
+                                           "lookahead(0, 4)"]},
+            "ip_p" : {"extracts" : ["ipv4"]},
+        }
+        guess_attrs = {"start_state" : "start_p", "implementation" : """
+            digraph {
+              start_p -> ip_p [value="(0x0800, 4)"]
+            }"""}
+        guess = Parser("guess", guess_attrs, guess_states,
+                       iri.header_layout, iri.iri_value_set)
+        air_assert(isinstance(guess.state_map["start_p"].select_handles[1],
+                              Lookahead), "Lookahead select not parsed")
+        cache = ParseCache(guess)
+        for version, keys in [(4, ["ethernet", "ipv4"]), (6, ["ethernet"]),
+                              (4, ["ethernet", "ipv4"])]:
+            byte_buf[14] = (version << 4) | 5
+            for parse in [guess.interpret, cache.parse]:
+                ppkt = ParsedPacket(bytearray(byte_buf), {})
+                parse(ppkt)
+                air_assert(ppkt.header_map.keys() == keys,
+                           "Bad lookahead parse for version %d" % version)
+        air_assert(cache.hits == 1, "Lookahead parse not cached")
+        parser_codegen(guess)
+        ppkt = ParsedPacket(bytearray(byte_buf), {})
+        guess.parse_states(ppkt)
+        air_assert(ppkt.header_map.keys() == ["ethernet", "ipv4"],
+                   "Bad generated lookahead parse")
+        ppkt = ParsedPacket(bytearray(byte_buf[:14]), {})
+        guess.interpret(ppkt)
+        air_assert(ppkt.header_map.keys() == ["ethernet"],
+                   "Lookahead beyond packet should not match")
+
+        # A value set on a select of two fields has tuple members
+        pair_set = ValueSet("ip_pairs")
+        pair_states = {"ip_p" : compound_states["ip_p"],
+                       "udp_p" : compound_states["udp_p"]}
+        pair_attrs = {"start_state" : "ip_p", "implementation" :
+                      'digraph { ip_p -> udp_p [in_value_set="ip_pairs"] }'}
+        pairs = Parser("pairs", pair_attrs, pair_states, iri.header_layout,
+                       {"ip_pairs" : pair_set})
+        pair_p = pairs.state_map["ip_p"]
+        pair_set.add((4, 17))
+        air_assert(not pair_p.compiled[2] and
+                   pair_p.next_state((4, 17)).name == "udp_p" and
+                   pair_p.next_state((4, 6)) is None,
+                   "Bad exact tuple value set transition")
+        pair_set.add((4, 0x80), mask=(None, 0x80))
+        for value, name in [((4, 17), "udp_p"), ((4, 0x85), "udp_p"),
+                            ((6, 0x85), None), ((4, 6), None)]:
+            next_state = pair_p.next_state(value)
+            air_assert(pair_p.compiled[2] and
+                       (next_state and next_state.name) == name,
+                       "Bad masked tuple value set transition for %s" %
+                       str(value))
+        ip_buf = bytearray(byte_buf[14:])
+        ip_buf[0] = 0x45
+        ip_buf[9] = 0x85
+        ppkt = ParsedPacket(ip_buf, {})
+        pairs.interpret(ppkt)
+        air_assert(ppkt.header_map.keys() == ["ipv4", "udp"],
+                   "Bad tuple value set parse")
+
+        try:
+            Parser("bad", {"start_state" : "ip_p", "implementation" :
+                           'digraph { ip_p -> udp_p [value=17] }'},
+                   compound_states, iri.header_layout, iri.iri_value_set)
+            air_assert(False, "Single value for tuple select accepted")
+        except IriParamError:
+            pass
+
+    # Packets of a flow seen before are parsed from the parse cache
+    cache = parser.enable_parse_cache(4)
+    for idx in range(2):
+        ppkt = ParsedPacket(bytearray(range(100)), iri.metadata_template)
+        parser.process(ppkt)
+    air_assert(cache.hits == 1 and cache.misses == 1, "Parse cache not used")
+    parser.enable_parse_cache(0)
+    air_assert(parser.parse_cache is None, "Parse cache not disabled")
+
+    # A label stack deeper than the mpls stack is a parse error: the
+    # packet is dropped instead of the parser raising
+    if "mpls" in iri.header_layout:
+        max_depth = iri.header_layout["mpls"].max_depth
+        deep_buf = bytearray(200)
+        deep_buf[12:14] = bytearray([0x88, 0x47]) # Every label has bos 0
+        for parse in [parser.interpret, ParseCache(parser).parse]:
+            ppkt = ParsedPacket(bytearray(deep_buf), iri.metadata_template)
+            parse(ppkt)
+            air_assert(ppkt.parse_error is not None and
+                       ppkt.header_stack_count("mpls") == max_depth and
+                       ppkt.header_length == 14 + 4 * max_depth,
+                       "Stack overflow not a parse error")
+        try:
+            ppkt.push_header("mpls")
+            air_assert(False, "Push onto a full stack accepted")
+        except IriPacketModError:
+            pass
+
+        class NextProcessor(object):
+            name = "next"
+            def __init__(self):
+                self.packets = []
+            def process(self, parsed_packet):
+                self.packets.append(parsed_packet)
+        saved_next = parser.next_processor
+        parser.next_processor = NextProcessor()
+        parser.process(ParsedPacket(bytearray(deep_buf),
+                                    iri.metadata_template))
+        parser.process(ParsedPacket(bytearray(range(100)),
+                                    iri.metadata_template))
+        air_assert(len(parser.next_processor.packets) == 1 and
+                   parser.next_processor.packets[0].parse_error is None,
+                   "Packet with a parse error not dropped")
+        parser.next_processor = saved_next
+
+    # Throughput of parsing (only) an ethernet/IPv4 packet
+    parser.next_processor = None
+    byte_buf = bytearray(range(100))
+    byte_buf[12:14] = bytearray([0x08, 0x00])
+    byte_buf[14] = 0x45
+    count = 2000
+    logging.getLogger().setLevel(logging.INFO)
+    start = time.time()
+    for idx in range(count):
+        parser.process(ParsedPacket(byte_buf, {}))
+    elapsed = time.time() - start
+    logging.getLogger().setLevel(logging.DEBUG)
+    logging.info("Parser %s: %.1f usec per packet, %d pkts/sec" %
+                 (parser.name, 1e6 * elapsed / count, count / elapsed))
@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+#
+# @file
+# @brief Generate specialized Python source for parsers
+#
+
+import os
+import sys
+
+from air.air_common import *
+from iri_exception import *
+from field_handle import field_ref_parse, Lookahead
+
+class ParserCodeGen(object):
+    """
+    @brief Generate a parse function for a Parser from its state records
+
+    @param parser The Parser object (after its states are compiled)
+
+    One Python function is emitted per parse state. It extracts the
+    state's headers with constant layouts, reads the select field and
+    returns the function for the next state (None at the end of the
+    parse). The entry function calls the state functions in a loop, as
+    the interpreter does, so looping parse graphs such as header stacks
+    do not grow the Python stack with each header:
+
+      * A select field in a header extracted by the state, at a constant
+        offset, is unpacked directly from the packet buffer: with a
+        struct for byte aligned 8/16/32/64 bit fields, or a shift and
+        mask for fields within one byte. Other select fields, and the
+        fields of a select on several fields, are read with their
+        FieldHandles.
+      * Transitions on specific values become if statements (a dict of
+        functions for states with many values); states with value set
+        or masked value transitions call ParserState.next_state so
+        value set updates take effect without regenerating the code.
+
+    The objects used by the generated code (layouts, structs, handles,
+    state records) are passed in the namespace the source is executed
+    in, named by the kind of object and a sequence number.
+
+    Attributes:
+      * source: The generated source
+      * function: The compiled parse function, called as
+        function(parsed_packet, state=None) like Parser.interpret
+    """
+
+    # States with more specific values than this use a dict dispatch
+    MAX_IF_VALUES = 4
+
+    def __init__(self, parser):
+        self.parser = parser
+        self.namespace = {"IriReferenceError" : IriReferenceError}
+        self.lines = []
+        self.dispatches = [] # (name, state) for dict dispatch states
+        for state in parser.states:
+            self._gen_state(state)
+        self._gen_entry()
+        self.source = "\n".join(self.lines) + "\n"
+
+        code = compile(self.source, "<parser %s>" % parser.name, "exec")
+        exec code in self.namespace
+        self.function = self.namespace["parse"]
+
+    def _const(self, kind, obj):
+        """
+        @brief Add an object to the namespace of the generated code
+        @returns The name of the object in the generated code
+        """
+        name = "%s_%d" % (kind, len(self.namespace))
+        self.namespace[name] = obj
+        return name
+
+    @staticmethod
+    def _func(state):
+        """
+        @brief Name of the generated function for a state (or None)
+        """
+        if state is None:
+            return None
+        return "state_%d" % state.index
+
+    def _next(self, state):
+        """
+        @brief Code returning the function for the next state
+        """
+        return "return %s" % self._func(state)
+
+    def _inline_select(self, state):
+        """
+        @brief Find how to read the select field directly from the buffer
+        @returns (extract_position, expression) or None
+
+        The expression reads the field relative to "off", the offset of
+        the header when it was extracted; extract_position is the
+        position of that header in state.extracts.
+        """
+        if (len(state.select_handles) != 1 or
+                isinstance(state.select_handles[0], Lookahead)):
+            return None
+        parts = field_ref_parse(state.select_handles[0].ref)
+        if parts is None:
+            return None
+        (hdr, index, fld) = parts
+        if fld is None or index is not None:
+            return None
+        positions = [pos for pos, (hdr_name, layout, opaque) in
+                     enumerate(state.extracts) if hdr_name == hdr]
+        if not positions:
+            return None
+        position = positions[-1]
+        layout = state.extracts[position][1]
+        if layout is None or fld not in layout.field_index:
+            return None
+        idx = layout.field_index[fld]
+        bit_offset = layout.bit_offsets[idx]
+        width = layout.widths[idx]
+        if bit_offset is None or width is None:
+            return None
+        if layout.structs[idx] is not None:
+            name = self._const("struct", layout.structs[idx])
+            return (position, "%s.unpack_from(buf, off + %d)[0]" %
+                    (name, bit_offset / 8))
+        if bit_offset % 8 + width <= 8:
+            shift = 8 - bit_offset % 8 - width
+            return (position, "(buf[off + %d] >> %d) & 0x%x" %
+                    (bit_offset / 8, shift, (1 << width) - 1))
+        return None
+
+    def _gen_state(self, state):
+        """
+        @brief Generate the function for one parse state
+        """
+        lines = self.lines
+        lines.append("def %s(pkt):" % self._func(state))
+        lines.append("    # Parse state %s" % state.name)
+
+        inline = None
+        if state.select_handles:
+            inline = self._inline_select(state)
+            if inline is not None:
+                lines.append("    buf = pkt.original_packet")
+
+        for pos, (hdr_name, layout, opaque) in enumerate(state.extracts):
+            if layout is None:
+                lines.append("    raise IriReferenceError(%r)" %
+                             ("Parse state %s: unknown header %s" %
+                              (state.name, hdr_name)))
+                lines.append("")
+                return
+            if inline is not None and inline[0] == pos:
+                lines.append("    off = pkt.payload_offset")
+            if opaque:
+                call = "pkt.parse_header(%r, %s, True)" % \
+                    (hdr_name, self._const("layout", layout))
+            else:
+                call = "pkt.parse_header(%r, %s)" % \
+                    (hdr_name, self._const("layout", layout))
+            if layout.is_stack:
+                # Only a stack can be full; stop parsing if it is
+                lines.append("    if not %s:" % call)
+                lines.append("        return None")
+            else:
+                lines.append("    " + call)
+
+        if not state.select_handles:
+            lines.append("    " + self._next(state.default))
+            lines.append("")
+            return
+
+        if inline is not None:
+            lines.append("    value = " + inline[1])
+        else:
+            gets = []
+            for handle in state.select_handles:
+                if isinstance(handle, Lookahead):
+                    gets.append("pkt.lookahead(%d, %d)" %
+                                (handle.bit_offset, handle.width))
+                else:
+                    gets.append("pkt.get(%s)" %
+                                self._const("handle", handle))
+            if len(gets) == 1:
+                lines.append("    value = " + gets[0])
+            else: # Select on several fields
+                lines.append("    value = (%s)" % ", ".join(gets))
+
+        if state.value_set_edges or state.masked_values:
+            # Value sets may change at run time and masked values may
+            # need more than one lookup; use the state record
+            lines.append("    next_state = %s.next_state(value)" %
+                         self._const("record", state))
+            lines.append("    if next_state is None:")
+            lines.append("        return None")
+            lines.append("    return functions[next_state.index]")
+        elif len(state.value_map) > ParserCodeGen.MAX_IF_VALUES:
+            dispatch = self._const("dispatch", {})
+            lines.append("    return %s.get(value, %s)" %
+                         (dispatch, self._func(state.default)))
+            self.dispatches.append((dispatch, state))
+        else:
+            for value, next_state in sorted(state.value_map.items()):
+                lines.append("    if value == %r:" % (value,))
+                lines.append("        " + self._next(next_state))
+            lines.append("    " + self._next(state.default))
+        lines.append("")
+
+    def _gen_entry(self):
+        """
+        @brief Generate the entry function and the function tables
+        """
+        lines = self.lines
+        lines.append("functions = [%s]" %
+                     ", ".join([self._func(state) for
+                                state in self.parser.states]))
+        for dispatch, state in self.dispatches:
+            for value, next_state in state.value_map.items():
+                lines.append("%s[%r] = %s" %
+                             (dispatch, value, self._func(next_state)))
+        lines.append("state_map = %r" %
+                     dict([(state.name, state.index) for
+                           state in self.parser.states]))
+        lines.append("")
+        lines.append("def parse(pkt, state=None):")
+        lines.append("    # Parser %s" % self.parser.name)
+        lines.append("    if state is None:")
+        lines.append("        function = %s" %
+                     self._func(self.parser.first_state))
+        lines.append("    else:")
+        lines.append("        function = functions[state_map[state]]")
+        lines.append("    while function is not None:")
+        lines.append("        function = function(pkt)")
+
+def parser_codegen(parser, dump=None):
+    """
+    @brief Replace the parse state interpreter of a parser with
+    generated code
+    @param parser The Parser object
+    @param dump If not None, a file name to which the generated source
+    is written for inspection
+    @returns The generated source
+
+    The source is also kept in parser.source.
+    """
+    gen = ParserCodeGen(parser)
+    if dump is not None:
+        with open(dump, "w") as dump_file:
+            dump_file.write(gen.source)
+    parser.source = gen.source
+    parser.parse_states = gen.function
+    logging.info("Generated %d lines of code for parser %s" %
+                 (len(gen.lines), parser.name))
+    return gen.source
+
+################################################################
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG, filename=sys.argv[1])
+    logging.info("RUNNING MODULE: %s" % __file__)
+
+    import random
+    import inspect
+    from instance import IriInstance
+    from parsed_packet import ParsedPacket
+
+    def transmit_packet(out_port, packet):
+        pass
+
+    if len(sys.argv) > 2:
+        input_files = sys.argv[2:]
+    else:
+        local_dir = os.path.dirname(os.path.abspath(__file__))
+        input_files = local_dir + "/../unit_test.yml"
+    iri = IriInstance("instance", input_files, transmit_packet)
+
+    # Packets that follow the edges of the parse graphs in the examples
+    random.seed(1)
+    packets = []
+    for ethertype in [0x0800, 0x8100, 0x8847, 0x86dd, 0x1234]:
+        for protocol in [6, 17, 1]:
+            for bos in [0, 1]:
+                byte_buf = bytearray([random.randint(0, 255)
+                                      for idx in range(200)])
+                byte_buf[12:14] = bytearray([ethertype >> 8, ethertype & 0xff])
+                byte_buf[16:18] = bytearray([0x08, 0x00]) # After vlan tag
+                byte_buf[16] |= bos # mpls bos
+                byte_buf[14] = 0x45
+                byte_buf[23] = protocol
+                byte_buf[36:38] = bytearray([0x12, 0xb5]) # UDP port 4789
+                packets.append(byte_buf)
+
+    for name, parser in iri.iri_parser.items():
+        parser.next_processor = None
+        source = parser_codegen(parser, dump=sys.argv[1] + ".parser.py")
+        air_assert(parser.source == source and "def parse(" in source,
+                   "Generated source not kept")
+        air_assert(os.path.exists(sys.argv[1] + ".parser.py"),
+                   "Source not dumped")
+        os.remove(sys.argv[1] + ".parser.py")
+
+        for vset in iri.iri_value_set.values():
+            vset.add_list([0, 3])
+        for byte_buf in packets:
+            for port in [0, 1, 3]:
+                results = []
+                for parse_states in [parser.interpret, parser.parse_states]:
+                    ppkt = ParsedPacket(bytearray(byte_buf),
+                                        iri.metadata_template)
+                    ppkt.set_field("intrinsic_metadata.ingress_port", port)
+                    try:
+                        parse_states(ppkt)
+                    except Exception, e:
+                        results.append((type(e), str(e)))
+                        continue
+                    results.append((ppkt.header_map.keys(),
+                                    ppkt.header_length, ppkt.payload_offset,
+                                    ppkt.serialize(),
+                                    [ppkt.header_stack_count(hdr) for
+                                     hdr in ppkt.header_map.keys()]))
+                air_assert(results[0] == results[1],
+                           "Generated parser %s differs: %s" %
+                           (name, str(results)))
+
+        # A state loop does not nest calls: each header of an MPLS label
+        # stack is extracted at the same Python stack depth (for parse
+        # graphs with an MPLS loop)
+        class DepthPacket(ParsedPacket):
+            __slots__ = ["depths"]
+            def parse_header(self, *args):
+                self.depths.append(len(inspect.stack(0)))
+                return ParsedPacket.parse_header(self, *args)
+        byte_buf = bytearray(200)
+        byte_buf[12:14] = bytearray([0x88, 0x47])
+        for label in range(8):
+            byte_buf[16 + 4 * label] = 0x01 if label == 7 else 0x00
+        byte_buf[46] = 0x45
+        ppkt = DepthPacket(byte_buf, iri.metadata_template)
+        ppkt.depths = []
+        parser.parse_states(ppkt)
+        if "mpls" in iri.header_layout:
+            air_assert(ppkt.header_stack_count("mpls") == 8,
+                       "Expected 8 MPLS labels")
+            air_assert(len(set(ppkt.depths)) == 1,
+                       "Parse states nest calls: depths %s" %
+                       str(ppkt.depths))
+
+            # More labels than the stack holds stop the generated parser
+            # with a parse error, as they stop the interpreter
+            byte_buf[16 + 4 * 7] = 0x00
+            ppkt = ParsedPacket(byte_buf, iri.metadata_template)
+            parser.parse_states(ppkt)
+            max_depth = iri.header_layout["mpls"].max_depth
+            air_assert(ppkt.parse_error is not None and
+                       ppkt.header_stack_count("mpls") == max_depth,
+                       "Stack overflow not a parse error")
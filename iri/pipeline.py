@@ -139,7 +139,7 @@ class Pipeline(Processor):
                     current_table_name = transitions[action]
                 elif "hit" in transitions.keys():
                     current_table_name = transitions["hit"]
-                elif "default" in transition.keys():
+                elif "default" in transitions.keys():
                     current_table_name = transitions["default"]
 
         logging.debug("Pipeline %s, pkt %d: calling to %s",
@@ -1,11 +1,16 @@
 #!/usr/bin/env python
 # Simple queuing module
 
+import os
 import threading
 import sys
 
 from air.air_common import *
 from processor import ThreadedProcessor
+from field_handle import field_handle
+
+egress_spec_handle = field_handle("intrinsic_metadata.egress_specification")
+egress_port_handle = field_handle("intrinsic_metadata.egress_port")
 
 class SimpleQueueManager(ThreadedProcessor):
     """
@@ -34,8 +39,8 @@ class SimpleQueueManager(ThreadedProcessor):
         if "max_bytes" in air_traffic_manager_attrs.keys():
             self.max_bytes = air_traffic_manager_attrs["max_bytes"]
 
-        # The map from egress spec to set of ports for multicast
-        self.multicast_map = []
+        # Map from multicast index to list of (port, queue) pairs
+        self.multicast_map = {}
 
         # Threading synchronization
         self.cond_var = threading.Condition()
@@ -89,21 +94,24 @@ class SimpleQueueManager(ThreadedProcessor):
           get_unicast_spec() : If not None, a pair giving (port, queue)
           get_multicast_spec() : If not None, an array of pairs (port, queue)
         """
-        egr_spec = parsed_packet.get_field(
-            "intrinsic_metadata.egress_specification")
+        egr_spec = parsed_packet.get(egress_spec_handle)
         if egr_spec is None:
             logging.debug("Did not find egress_spec for pkt %d" %
                           parsed_packet.id)
+            parsed_packet.release()
             return
         dest_ports = self.map_egress_spec(egr_spec)
         logging.debug("Queue %s: got pkt %d; egr 0x%x. dest %s", self.name, 
                       parsed_packet.id, egr_spec, str(dest_ports))
+        if not dest_ports:
+            parsed_packet.release()
+            return
 
         for idx, (port, queue) in enumerate(dest_ports):
             if idx + 1 == len(dest_ports):
                 replicant = parsed_packet
             else:
-                replicant = parse_packet.replicate()
+                replicant = parsed_packet.replicate()
             with self.cond_var:
                 logging.debug("Enqueuing packet %d in %d.%d" %
                               (parsed_packet.id, port, queue))
@@ -136,8 +144,7 @@ class SimpleQueueManager(ThreadedProcessor):
                                 logging.debug("Dequeue from %d.%d" % 
                                               (port, queue))
                                 packet = self.queues[port][queue].pop(0)
-                                packet.set_field(
-                                    "intrinsic_metadata.egress_port", port)
+                                packet.set(egress_port_handle, port)
                                 last_port = port
                                 break
                 if packet:
@@ -193,3 +200,22 @@ if __name__ == "__main__":
     tm = SimpleQueueManager("tm", tm_attrs, 10)
     tm.next_processor = test_processor
 
+
+    # Multicast replicates the packet to each (port, queue) of the group
+    from instance import IriInstance
+    local_dir = os.path.dirname(os.path.abspath(__file__))
+    iri = IriInstance("instance", local_dir + "/../unit_test.yml",
+                      lambda port, packet: None)
+    tm.multicast_map[5] = [(1, 0), (2, 3), (4, 7)]
+    ppkt = ParsedPacket(bytearray(64), iri.metadata_layout)
+    ppkt.parse_header("ethernet", iri.header_layout["ethernet"])
+    ppkt.set_field("intrinsic_metadata.egress_specification", 0x10000005)
+    tm.process(ppkt)
+    queued = [tm.queues[1][0], tm.queues[2][3], tm.queues[4][7]]
+    air_assert([len(queue) for queue in queued] == [1, 1, 1],
+               "Multicast packet not queued to each member")
+    air_assert(queued[2][0] is ppkt, "Last member should get original")
+    for queue in queued[:2]:
+        air_assert(queue[0].parent_id == ppkt.id, "Bad replica parent")
+        air_assert(queue[0].header_map["ethernet"] is
+                   ppkt.header_map["ethernet"], "Replica header not shared")
@@ -4,40 +4,85 @@
 #
 # This is mostly just a container for table entries
 
+import os
 import sys
-from threading import Condition
+import threading
+from contextlib import contextmanager
 
 from air.air_common import *
-from table_entry import TableEntryExact, TableEntryTernary, TableEntryDefault
+from iri_exception import *
+from table_entry import TableEntryBase, TableEntryExact, TableEntryTernary
+from table_entry import TableEntryDefault
+from table_index import table_index_create
 
 
 class Table(object):
-    def __init__(self, name, air_table_attrs, action_map):
+    def __init__(self, name, air_table_attrs, action_map, header_layout=None,
+                 index_type=None):
         """
         @brief Constructor for a table object
         @param name The name of the table to instantiate
         @param air_table_attrs The table attributes from the IRI instance
         @param action_map The map of all action objects for the IRI instance
+        @param header_layout The map from header name to HeaderLayout for
+        the IRI instance; gives the field widths some indexes need
+        @param index_type If not None, the name of the index to use
+        instead of the one chosen from the match types (a key of
+        table_index.table_index_types)
 
         Object attributes (internal):
           match_on: Map from field refs to match type
+          index: The TableIndex holding the entries (see table_index.py)
           entries: List of entries in the table (run time added)
+
+        Packets are processed without locking (read-copy-update). A
+        lookup uses whatever index is current when it starts. Updates
+        are serialized by a lock; each changes a copy of the index and
+        publishes it by replacing self.index in a single assignment, so
+        a lookup sees the table before or after an update, never part
+        of one. Updates made in a batch() are published together. An
+        index changing itself later (a background rebuild) does so
+        through an update too (index.updater).
+
+        Hit counters are kept per thread and summed by hit_stats, so
+        packet processing threads do not share counters. Clearing them
+        starts new counters rather than zeroing ones in use.
         """
 
         self.name = name
         self.air_table_attrs = air_table_attrs
         self.action_map = action_map
+        self.match_on = deref_or_none(air_table_attrs, "match_on") or {}
+        self.header_layout = header_layout
+        self.index_type = index_type
 
-        # The list of table entries
-        self.entries = []
+        # Serializes updates; packet processing does not take it
+        self.lock = threading.RLock()
+        self.pending = None # The index being changed by a batch
+
+        # The table entries, indexed according to the match types
+        self.index = self._new_index()
         self.default_entry = None # Another table entry
 
-        # Other state for the table
-        self.byte_count = 0
-        self.packet_count = 0
+        # Per thread [byte_count, packet_count] lists
+        self.counters = []
+        self.thread_state = threading.local()
 
-        # For synchronizing table updates with packet processing
-        self.cond_var = Condition()
+    def _new_index(self):
+        """
+        @brief Create an empty index for the table
+        """
+        index = table_index_create(self.match_on, self.header_layout,
+                                   self.index_type)
+        index.updater = self._update
+        return index
+
+    @property
+    def entries(self):
+        """
+        @brief The list of entries in the order they were added
+        """
+        return self.index.entries
 
     def process_packet(self, parsed_packet):
         """
@@ -48,65 +93,156 @@ class Table(object):
         and params are the action parameters from the table entry
         """
 
-        # For now a very simple linear search
-        # @todo Support hash lookups for exact matches
         logging.debug("Table %s processing pkt %d" %
                       (self.name, parsed_packet.id))
         hit = False
         action_ref = None
-        with self.cond_var:
-            for entry in self.entries:
-                if entry.check_match(parsed_packet):
-                    action_ref = entry.action_ref
-                    params = entry.action_params
-                    logging.debug("Pkt %d hit" % parsed_packet.id)
-                    hit = True
-                    self.packet_count += 1
-                    self.byte_count += parsed_packet.length()
-                    break
-            if not hit:
-                if self.default_entry:
-                    action_ref = self.default_entry.action_ref
-                    params = self.default_entry.action_params
-                    logging.debug("Pkt %d miss" % parsed_packet.id)
-
-            if action_ref:
-                self.action_map[action_ref].eval(parsed_packet, params)
+        entry = self.index.lookup(parsed_packet)
+        if entry is not None:
+            action_ref = entry.action_ref
+            params = entry.action_params
+            logging.debug("Pkt %d hit" % parsed_packet.id)
+            hit = True
+            counters = self._thread_counters()
+            counters[0] += parsed_packet.length()
+            counters[1] += 1
+        else:
+            default_entry = self.default_entry
+            if default_entry:
+                action_ref = default_entry.action_ref
+                params = default_entry.action_params
+                logging.debug("Pkt %d miss" % parsed_packet.id)
+
+        if action_ref:
+            self.action_map[action_ref].eval(parsed_packet, params)
 
         return (hit, action_ref)
 
+    def _thread_counters(self):
+        """
+        @brief Return the [byte_count, packet_count] of the calling thread
+        """
+        all_counters = self.counters
+        (owner, counters) = getattr(self.thread_state, "counters",
+                                    (None, None))
+        if owner is not all_counters:
+            # First hit in this thread, or the counters were cleared
+            counters = [0, 0]
+            self.thread_state.counters = (all_counters, counters)
+            all_counters.append(counters) # Atomic; no lock needed
+        return counters
+
+    @contextmanager
+    def batch(self):
+        """
+        @brief Group updates so they are published together
+
+        Used as "with table.batch():"; the adds, removes and clears in
+        the block change one copy of the index, published when the
+        block exits (even if by an exception). Other updates wait until
+        then. Batches may be nested; the outermost publishes.
+        """
+        with self.lock:
+            if self.pending is not None:
+                yield
+                return
+            self.pending = self._writable_index()
+            try:
+                yield
+            finally:
+                (index, self.pending) = (self.pending, None)
+                self._publish(index)
+
+    def _writable_index(self):
+        """
+        @brief Return the index to change for an update
+
+        Must be called with the lock held.
+        """
+        if self.pending is not None:
+            return self.pending
+        return self.index.copy()
+
+    def _publish(self, index):
+        """
+        @brief Make an index the one used by lookups
+
+        Must be called with the lock held.
+        """
+        index.prepare()
+        self.index = index
+
+    def _update(self, update):
+        """
+        @brief Apply a change to the index and publish the result
+        @param update A function called with the index to change
+        @returns The result of update
+        """
+        with self.lock:
+            if self.pending is not None:
+                return update(self.pending)
+            index = self._writable_index()
+            result = update(index)
+            self._publish(index)
+            return result
+
     def add_entry(self, entry):
         """
         @brief Add an entry to the table
         @param entry The entry to add to the table
 
-        If entry is a TableEntryDefault object, then set the default entry
+        If entry is a TableEntryDefault object, then set the default entry.
+        Raises IriParamError if the table's index does not accept the
+        entry, for example a duplicate key in an exact match table.
         """
         logging.debug("Adding entry to %s" % self.name)
         # @FIXME: Check entry is proper type for this table
-        # @FIXME: Support entry priorities for ternary matching
 
         if isinstance(entry, TableEntryDefault):
             return self.set_default_entry(entry)
 
-        with self.cond_var:
-            self.entries.append(entry)
+        self._update(lambda index: index.add(entry))
+
+    def add_entries(self, entries):
+        """
+        @brief Add a list of entries, published as one update
+        @param entries The entries to add (see add_entry)
+        """
+        with self.batch():
+            for entry in entries:
+                self.add_entry(entry)
 
     def remove_entry(self, entry_ref):
         """
         Remove an entry to the table, by match criteria or entry reference
+        @param entry_ref The entry object or a map from match field to value
+        @returns True if an entry was removed
         """
         logging.debug("Removing entry from %s" % self.name)
-        if isinstance(entry_ref, table_entry):
-            with self.cond_var:
-                self.entries.remove(entry_ref)
+        if isinstance(entry_ref, TableEntryBase):
+            with self.lock:
+                if entry_ref not in self.current_index().entry_order:
+                    return False
+                return self._update(lambda index: index.remove(entry_ref))
         elif isinstance(entry_ref, dict):
             # This is the match criteria used by the entry
-            logging.debug("FIXME: table entry remove by match not implemented")
-            pass
+            with self.lock:
+                entry = self.current_index().find(entry_ref)
+                if entry is None:
+                    return False
+                return self._update(lambda index: index.remove(entry))
         else:
             raise IriReferenceError("Unknown entry ref type for entry remove")
 
+    def current_index(self):
+        """
+        @brief Return the index as changed by updates so far, including
+        those of a batch not yet published
+        """
+        if self.pending is not None:
+            return self.pending
+        return self.index
+
     def clear(self, clear_stats=True, clear_default=False):
         """
         Remove all entries from the table
@@ -114,14 +250,15 @@ class Table(object):
         @param clear_default If True, clear the default entry too
         """
         logging.debug("Clearing table %s" % self.name)
-        with self.cond_var:
+        with self.lock:
             if clear_stats:
-                self.packet_count = 0
-                self.byte_count = 0
-            for entry in self.entries:
-                # For now, do nothing
-                pass
-            self.entries = []
+                # Threads start new counters on their next hit
+                self.counters = []
+            index = self._new_index()
+            if self.pending is not None:
+                self.pending = index
+            else:
+                self._publish(index)
             if clear_default:
                 self.default_entry = None
 
@@ -130,13 +267,178 @@ class Table(object):
         @brief Return table counters
         @returns A pair of integers, byte count and packet count
         """
-        return (self.byte_count, self.packet_count)
+        counters = list(self.counters)
+        return (sum([byte_count for (byte_count, count) in counters]),
+                sum([count for (byte_count, count) in counters]))
 
     def set_default_entry(self, entry):
         air_assert(isinstance(entry, TableEntryDefault))
-        with self.cond_var:
-            self.default_entry = entry
+        self.default_entry = entry
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG, filename=sys.argv[1])
     logging.info("RUNNING MODULE: %s" % __file__)
+
+    import random
+    from instance import IriInstance
+    from parsed_packet import ParsedPacket
+
+    def transmit_packet(out_port, packet):
+        pass
+
+    local_dir = os.path.dirname(os.path.abspath(__file__))
+    iri = IriInstance("instance", local_dir + "/../unit_test.yml",
+                      transmit_packet)
+    table = Table("l3", {"match_on" : {"route_md.vfi" : "exact",
+                                       "ipv4.dst" : "exact"}},
+                  iri.iri_action)
+
+    byte_buf = bytearray(range(100))
+    byte_buf[14] = 0x45
+    ppkt = ParsedPacket(byte_buf, iri.metadata_template)
+    ppkt.parse_header("ethernet", iri.header_layout["ethernet"])
+    ppkt.parse_header("ipv4", iri.header_layout["ipv4"])
+    dst = ppkt.get_field("ipv4.dst")
+
+    def l3_entry(vfi, vfi_id):
+        return TableEntryTernary({"route_md.vfi" : vfi, "ipv4.dst" : dst},
+                                 None, "set_l3_vfi_a", {"vfi_id" : vfi_id}, 0)
+    def l3_result(check_table, vfi):
+        """
+        @brief Process ppkt with a vfi; return the result and the vfi
+        the action set
+        """
+        ppkt.set_field("route_md.vfi", vfi)
+        return (check_table.process_packet(ppkt),
+                ppkt.get_field("route_md.vfi"))
+    hit = (True, "set_l3_vfi_a")
+    miss = (False, "set_l2_vfi_a")
+
+    for vfi in range(10):
+        table.add_entry(l3_entry(vfi, 100 + vfi))
+    table.add_entry(TableEntryDefault("set_l2_vfi_a", {"vfi_id" : 1}))
+    air_assert(l3_result(table, 5) == (hit, 105), "Expected table hit")
+    air_assert(table.hit_stats() == (100, 1), "Bad hit stats")
+    air_assert(table.remove_entry({"route_md.vfi" : 5, "ipv4.dst" : dst}),
+               "Remove by match failed")
+    air_assert(not table.remove_entry({"route_md.vfi" : 5, "ipv4.dst" : dst}),
+               "Removed a missing match")
+    air_assert(l3_result(table, 5) == (miss, 1), "Expected table miss")
+    air_assert(table.remove_entry(table.entries[0]) and
+               len(table.entries) == 8, "Remove by entry failed")
+    table.clear()
+    air_assert(len(table.entries) == 0, "Clear failed")
+
+    # A ternary table may use a decision tree instead of tuple space search
+    acl = Table("acl", {"match_on" : {"route_md.vfi" : "exact",
+                                      "ipv4.dst" : "ternary"}},
+                iri.iri_action, index_type="decision_tree")
+    for vfi in range(100):
+        acl.add_entry(TableEntryTernary({"route_md.vfi" : vfi % 10,
+                                         "ipv4.dst" : dst},
+                                        {"ipv4.dst" : 0xffffff00 << vfi % 3},
+                                        "set_l3_vfi_a", {"vfi_id" : vfi},
+                                        vfi % 7))
+    air_assert(l3_result(acl, 5) == (hit, 55), "Expected priority 6 hit")
+    acl.clear()
+
+    # Updates in a batch are published together when it ends; until
+    # then, lookups see the table as it was
+    table.add_entries([l3_entry(vfi, 100 + vfi) for vfi in range(10)])
+    with table.batch():
+        table.clear()
+        table.add_entry(l3_entry(5, 5))
+        air_assert(l3_result(table, 5) == (hit, 105) and
+                   l3_result(table, 6) == (hit, 106),
+                   "Batch published early")
+    air_assert(l3_result(table, 5) == (hit, 5) and
+               l3_result(table, 6) == (miss, 1), "Batch not published")
+
+    # Lookups while other threads change the tables. Each lookup must
+    # find the entry for vfi 5, which is never removed
+    lpm = Table("lpm", {"match_on" : {"ipv4.dst" : "lpm"}}, iri.iri_action,
+                iri.header_layout)
+    lpm.add_entry(TableEntryTernary({"ipv4.dst" : dst},
+                                    {"ipv4.dst" : 0xffff0000},
+                                    "set_l3_vfi_a", {"vfi_id" : 5}, 0))
+    acl.add_entry(TableEntryTernary({"route_md.vfi" : 5}, None,
+                                    "set_l3_vfi_a", {"vfi_id" : 5}, 0))
+    churn_tables = [table, lpm, acl]
+    errors = []
+    def process(count):
+        reader_pkt = ParsedPacket(byte_buf, iri.metadata_template)
+        reader_pkt.parse_header("ethernet", iri.header_layout["ethernet"])
+        reader_pkt.parse_header("ipv4", iri.header_layout["ipv4"])
+        for idx in range(count):
+            for churn_table in churn_tables:
+                reader_pkt.set_field("route_md.vfi", 5)
+                result = churn_table.process_packet(reader_pkt)
+                if result != hit or reader_pkt.get_field("route_md.vfi") != 5:
+                    errors.append((churn_table.name, result))
+    def churn(stop):
+        while not stop:
+            added = []
+            for idx in range(20):
+                vfi = random.randint(10, 1000)
+                added.append(TableEntryTernary({"route_md.vfi" : vfi,
+                                                "ipv4.dst" : dst}, None,
+                                               "set_l2_vfi_a",
+                                               {"vfi_id" : 1}, 0))
+                added.append(TableEntryTernary({"ipv4.dst" : dst + vfi},
+                                               {"ipv4.dst" : 0xffffffff},
+                                               "set_l2_vfi_a",
+                                               {"vfi_id" : 1}, 0))
+            try:
+                table.add_entries(added[::2])
+            except IriParamError: # Duplicate vfi
+                pass
+            for entry in added[1::2]:
+                try:
+                    lpm.add_entry(entry)
+                except IriParamError: # Duplicate prefix
+                    pass
+                acl.add_entry(entry)
+            for entry in added:
+                for churn_table in churn_tables:
+                    churn_table.remove_entry(entry)
+            with table.batch():
+                entries = table.current_index().entries
+                table.clear(clear_stats=False)
+                table.add_entries(entries)
+
+    random.seed(8)
+    logging.getLogger().setLevel(logging.INFO)
+    stop = []
+    writers = [threading.Thread(target=churn, args=(stop,))
+               for idx in range(2)]
+    for writer in writers:
+        writer.start()
+    readers = [threading.Thread(target=process, args=(300,))
+               for idx in range(2)]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+    stop.append(True)
+    for writer in writers:
+        writer.join()
+    logging.getLogger().setLevel(logging.DEBUG)
+    air_assert(not errors, "Lookups during updates failed: %s" %
+               str(errors[:5]))
+    air_assert(table.hit_stats()[1] >= 600,
+               "Hits from all threads not counted")
+
+    # Clearing the counters starts new ones; hits counted since, in any
+    # thread, are kept
+    table.clear(clear_stats=True)
+    air_assert(table.hit_stats() == (0, 0), "Clear kept hit counts")
+    table.add_entry(l3_entry(7, 7))
+    for idx in range(2):
+        l3_result(table, 7)
+    counter_thread = threading.Thread(target=table.process_packet,
+                                      args=(ppkt,))
+    ppkt.set_field("route_md.vfi", 7)
+    counter_thread.start()
+    counter_thread.join()
+    air_assert(table.hit_stats() == (300, 3), "Hits after clear not counted")
+    table.clear()
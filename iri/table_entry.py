@@ -6,6 +6,16 @@ import os
 import sys
 
 from air.air_common import *
+from field_handle import field_handle
+
+def match_field_handle(field_name):
+    """
+    @brief Return the field handle for a match field of an entry
+    @param field_name The header or field reference to match on
+    """
+    handle = field_handle(field_name)
+    air_assert(handle is not None, "Bad match field reference %s" % field_name)
+    return handle
 
 class TableEntryBase(object):
     """
@@ -40,14 +50,16 @@ class TableEntryExact(TableEntryBase):
         """
         TableEntryBase.__init__(self, action_ref, action_params)
         self.match_values = match_values
+        self.match_handles = [(match_field_handle(field_name), value) for
+                              field_name, value in match_values.items()]
 
     def check_match(self, parsed_packet):
         """
         @brief Check if packet matches this entry
         @return (action_name, action_param_map) if match; None otherwise
         """
-        for field_name, value in self.match_values.items():
-            p_value = parsed_packet.get_field(field_name)
+        for handle, value in self.match_handles:
+            p_value = parsed_packet.get(handle)
             if p_value is None or p_value != value:
                 return None
         return (self.action_ref, self.action_params)
@@ -76,6 +88,11 @@ class TableEntryTernary(TableEntryBase):
         self.match_masks = match_masks
         self.match_values = match_values
         self.priority = priority
+        # (handle, value, mask) for each match field
+        self.match_handles = [
+            (match_field_handle(field_name), value,
+             deref_or_none(match_masks, field_name))
+            for field_name, value in match_values.items()]
 
 
     def check_match(self, parsed_packet):
@@ -83,9 +100,8 @@ class TableEntryTernary(TableEntryBase):
         @brief Check if packet matches this entry
         @return (action_name, action_param_map) if match; None otherwise
         """
-        for field_name, value in self.match_values.items():
-            mask = deref_or_none(self.match_masks, field_name)
-            p_value = parsed_packet.get_field(field_name)
+        for handle, value, mask in self.match_handles:
+            p_value = parsed_packet.get(handle)
             if p_value is None:
                 return None
             if mask is not None:
@@ -0,0 +1,1958 @@
+#!/usr/bin/env python
+#
+# @file
+# @brief Lookup structures for table entries
+#
+# A table keeps its entries in an index chosen from the match types of
+# the table's match_on attribute. Each index supports add, remove and
+# lookup of the entry matching a packet.
+
+import sys
+import copy
+import time
+import bisect
+import threading
+
+from air.air_common import *
+from iri_exception import *
+from table_entry import match_field_handle
+from field import bits_from_bytes
+
+try:
+    import numpy
+except ImportError:
+    numpy = None # ColumnarIndex is not available
+
+def entry_match_fields(entry):
+    """
+    @brief Return the match field references of an entry, sorted
+    """
+    return tuple(sorted((entry.match_values or {}).keys()))
+
+def match_value_int(value):
+    """
+    @brief Return a match value as an integer
+
+    Fields wider than 64 bits are read from packets as bytearrays (see
+    field_extract), which cannot be hashed or masked; entries may give
+    values for them either way. Indexes convert both to integers.
+    """
+    if isinstance(value, bytearray):
+        return bits_from_bytes(value, 0, len(value))
+    return value
+
+def entry_has_masks(entry):
+    """
+    @brief Return True if an entry has a mask for some match field
+    """
+    masks = getattr(entry, "match_masks", None) or {}
+    for mask in masks.values():
+        if mask is not None:
+            return True
+    return False
+
+class CowMap(object):
+    """
+    @brief A map whose copies share storage until they are changed
+
+    Keys are spread over shards (dicts) by hash, mixed (Fibonacci
+    hashing) as the low bits of hashes are often alike: objects are
+    aligned in memory, and IPv4 prefixes end in zero bits, which the
+    low bits of a tuple's hash follow.
+
+    A copy shares the shards of the original, and each copies a shared
+    shard before changing it, so a change costs one shard copy and
+    copy() one list copy rather than a copy of every key. The number of
+    shards doubles when the keys outnumber a quarter of its square,
+    keeping both near the square root of the number of keys (a shard,
+    unlike the list of shards, is slow to copy, so shards are kept
+    small); the shards are then rebuilt, at an amortized cost of O(1)
+    per key.
+
+    Lookups may run in other threads in a map while a copy of it is
+    changed, but not while the map itself is changed.
+    """
+    __slots__ = ["shards", "mask", "count", "owned"]
+
+    def __init__(self, items=()):
+        self.shards = [{}]
+        self.mask = 0 # len(shards) - 1
+        self.count = 0
+        self.owned = set([0]) # Positions of shards not shared with a copy
+        for (key, value) in items:
+            self[key] = value
+
+    def __len__(self):
+        return self.count
+
+    def _position(self, key):
+        """
+        @brief Return the position of the shard for a key
+        """
+        value = hash(key)
+        return ((value ^ value >> 32) * 0x9e3779b1 >> 16) & self.mask
+
+    def __contains__(self, key):
+        return key in self.shards[self._position(key)]
+
+    def __getitem__(self, key):
+        return self.shards[self._position(key)][key]
+
+    def get(self, key, default=None):
+        # _position inline, as lookups probe maps often
+        value = hash(key)
+        value = ((value ^ value >> 32) * 0x9e3779b1 >> 16) & self.mask
+        return self.shards[value].get(key, default)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [key for shard in self.shards for key in shard]
+
+    def values(self):
+        return [value for shard in self.shards for value in shard.values()]
+
+    def items(self):
+        return [item for shard in self.shards for item in shard.items()]
+
+    def copy(self):
+        """
+        @brief Return a copy of the map sharing its shards
+        """
+        clone = CowMap.__new__(CowMap)
+        clone.shards = list(self.shards)
+        clone.mask = self.mask
+        clone.count = self.count
+        clone.owned = set()
+        self.owned = set()
+        return clone
+
+    def _own(self, key):
+        """
+        @brief Return the shard for a key, copied first if it is shared
+        """
+        pos = self._position(key)
+        if pos not in self.owned:
+            self.shards[pos] = dict(self.shards[pos])
+            self.owned.add(pos)
+        return self.shards[pos]
+
+    def __setitem__(self, key, value):
+        shard = self._own(key)
+        if key not in shard:
+            self.count += 1
+        shard[key] = value
+        if self.count > len(self.shards) ** 2 / 4:
+            self._grow()
+
+    def pop(self, key, *default):
+        if key not in self:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        self.count -= 1
+        return self._own(key).pop(key)
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def _grow(self):
+        """
+        @brief Double the number of shards
+        """
+        items = self.items()
+        self.shards = [{} for idx in range(2 * len(self.shards))]
+        self.mask = len(self.shards) - 1
+        self.owned = set(range(len(self.shards)))
+        for (key, value) in items:
+            self.shards[self._position(key)][key] = value
+
+class TableIndex(object):
+    """
+    @brief Base class for table entry indexes
+
+    @param match_on The match_on attribute of the table: a map from field
+    references to match types
+
+    Lookups may run in other threads while a copy of an index is
+    changed, but not while the index itself is: a table changes a copy
+    of its index, calls prepare() and then replaces the index with the
+    copy (see Table). copy() shares the index's structure, and a change
+    copies only the parts it touches (CowMap shards, chunks of entries,
+    trie paths, groups), so an update costs about the same however many
+    entries the index holds.
+
+    Attributes:
+      * entry_order: CowMap from each entry to its sequence number, the
+        order in which the entries were added
+      * sequence: The sequence number of the last entry added
+      * updater: A function the index calls with a function changing an
+        index, to make a change outside add and remove (see
+        DecisionTreeIndex); None to change the index itself. Set by
+        Table to make such changes table updates
+    """
+
+    def __init__(self, match_on):
+        self.match_on = match_on or {}
+        self.entry_order = CowMap()
+        self.sequence = 0
+        self.updater = None
+
+    def __len__(self):
+        return len(self.entry_order)
+
+    @property
+    def entries(self):
+        """
+        @brief The list of entries in the order they were added
+        """
+        return sorted(self.entry_order.keys(), key=self.entry_order.get)
+
+    def _order_add(self, entry):
+        """
+        @brief Record an entry's sequence number
+        @returns The sequence number
+        """
+        self.sequence += 1
+        self.entry_order[entry] = self.sequence
+        return self.sequence
+
+    def copy(self):
+        """
+        @brief Return a copy of the index
+
+        The copy shares the entries; changing it does not affect lookups
+        in this index.
+        """
+        index = copy.copy(self)
+        index.entry_order = self.entry_order.copy()
+        return index
+
+    def prepare(self):
+        """
+        @brief Build any lookup structures put off by changes; called
+        before the index is published to lookups in other threads
+        """
+        pass
+
+    def add(self, entry):
+        """
+        @brief Add an entry to the index
+        """
+        self._order_add(entry)
+
+    def remove(self, entry):
+        """
+        @brief Remove an entry from the index
+        @returns True if the entry was present
+        """
+        return self.entry_order.pop(entry, None) is not None
+
+    def find(self, match_values):
+        """
+        @brief Find the entry with the given match values (and no masks)
+        @param match_values A map from match field to value
+        @returns The entry or None
+        """
+        for entry in self.entries:
+            if entry.match_values == match_values and \
+                    not entry_has_masks(entry):
+                return entry
+        return None
+
+    def lookup(self, parsed_packet):
+        """
+        @brief Return the entry matching a packet or None
+        """
+        raise NotImplementedError
+
+    def lookup_batch(self, parsed_packets):
+        """
+        @brief Return the list of entries (or None) matching a list of
+        packets
+        """
+        return [self.lookup(parsed_packet) for
+                parsed_packet in parsed_packets]
+
+class LinearIndex(TableIndex):
+    """
+    @brief Check each entry in turn; the first entry added wins
+
+    Lookups cost O(n) for n entries. The entries are kept in chunks, in
+    the order added, which copies share as CowMap shards are shared: a
+    change copies the list of chunks and the chunk it changes. A new
+    chunk is started when the last one holds as many entries as there
+    are chunks, keeping both near the square root of the number of
+    entries.
+    """
+    def __init__(self, match_on):
+        TableIndex.__init__(self, match_on)
+        self.chunks = [] # Lists of the entries in the order added
+        self.starts = [] # Sequence number of the first entry of each chunk
+        self.owned = set() # Ids of chunks not shared with a copy
+
+    @property
+    def entries(self):
+        return [entry for chunk in self.chunks for entry in chunk]
+
+    def copy(self):
+        index = TableIndex.copy(self)
+        index.chunks = list(self.chunks)
+        index.starts = list(self.starts)
+        index.owned = set()
+        self.owned = set()
+        return index
+
+    def _own_chunk(self, pos):
+        """
+        @brief Return a chunk, copied first if it is shared with a copy
+        """
+        chunk = self.chunks[pos]
+        if id(chunk) not in self.owned:
+            chunk = list(chunk)
+            self.chunks[pos] = chunk
+            self.owned.add(id(chunk))
+        return chunk
+
+    def add(self, entry):
+        sequence = self._order_add(entry)
+        if not self.chunks or len(self.chunks[-1]) >= len(self.chunks):
+            self.chunks.append([])
+            self.starts.append(sequence)
+            self.owned.add(id(self.chunks[-1]))
+        self._own_chunk(-1).append(entry)
+
+    def remove(self, entry):
+        sequence = self.entry_order.get(entry)
+        if not TableIndex.remove(self, entry):
+            return False
+        pos = bisect.bisect_right(self.starts, sequence) - 1
+        chunk = self._own_chunk(pos)
+        chunk.remove(entry)
+        if not chunk:
+            self.owned.discard(id(chunk))
+            del self.chunks[pos]
+            del self.starts[pos]
+        return True
+
+    def lookup(self, parsed_packet):
+        for chunk in self.chunks:
+            for entry in chunk:
+                if entry.check_match(parsed_packet):
+                    return entry
+        return None
+
+class ExactIndex(TableIndex):
+    """
+    @brief Hash lookup for tables whose fields are all exact or valid
+
+    Entries are grouped by the set of fields they give values for
+    (normally the table's match_on fields). Each group is a CowMap keyed
+    on the tuple of the entry's values in field order, so a lookup costs
+    one key build and one probe per group. If entries of several groups
+    match, the one added first wins, as in a linear search. For a valid
+    match (a header reference) the key component is whether the header
+    is valid; values of fields wider than 64 bits are converted to
+    integers (see match_value_int).
+
+    Adding an entry whose key is already present raises IriParamError.
+    """
+    def __init__(self, match_on):
+        TableIndex.__init__(self, match_on)
+        # List of (fields, [(handle, valid_match)], map from key to entry)
+        self.groups = []
+        self.group_map = {} # Map from fields to group
+
+    @staticmethod
+    def _entry_key(fields, match_values):
+        key = []
+        for field in fields:
+            value = match_values[field]
+            if match_field_handle(field).field is None:
+                value = bool(value)
+            else:
+                value = match_value_int(value)
+            key.append(value)
+        return tuple(key)
+
+    def copy(self):
+        index = TableIndex.copy(self)
+        index.groups = [(fields, handles, key_map.copy()) for
+                        (fields, handles, key_map) in self.groups]
+        index.group_map = dict([(group[0], group) for
+                                group in index.groups])
+        return index
+
+    def _group(self, fields, create=False):
+        group = self.group_map.get(fields, None)
+        if group is None and create:
+            handles = [(match_field_handle(field),
+                        match_field_handle(field).field is None)
+                       for field in fields]
+            group = (fields, handles, CowMap())
+            self.groups.append(group)
+            self.group_map[fields] = group
+        return group
+
+    def add(self, entry):
+        if entry_has_masks(entry):
+            raise IriParamError("Masked entry added to exact table")
+        fields = entry_match_fields(entry)
+        key = ExactIndex._entry_key(fields, entry.match_values)
+        group = self._group(fields, create=True)
+        if key in group[2]:
+            raise IriParamError("Duplicate table entry for %s" % str(key))
+        group[2][key] = entry
+        self._order_add(entry)
+
+    def remove(self, entry):
+        fields = entry_match_fields(entry)
+        group = self._group(fields)
+        if group is None:
+            return False
+        key = ExactIndex._entry_key(fields, entry.match_values)
+        if group[2].get(key, None) is not entry:
+            return False
+        del group[2][key]
+        del self.entry_order[entry]
+        return True
+
+    def find(self, match_values):
+        fields = tuple(sorted(match_values.keys()))
+        group = self._group(fields)
+        if group is None:
+            return None
+        return group[2].get(ExactIndex._entry_key(fields, match_values), None)
+
+    def lookup(self, parsed_packet):
+        best = None
+        for (fields, handles, key_map) in self.groups:
+            key = []
+            for (handle, valid_match) in handles:
+                value = parsed_packet.get(handle)
+                if valid_match:
+                    value = value is not None
+                elif isinstance(value, bytearray):
+                    value = bits_from_bytes(value, 0, len(value))
+                key.append(value)
+            entry = key_map.get(tuple(key), None)
+            if entry is not None and (best is None or
+                                      self.entry_order[entry] <
+                                      self.entry_order[best]):
+                best = entry
+        return best
+
+class ValidIndex(ExactIndex):
+    """
+    @brief Direct lookup for tables whose fields are all valid matches
+
+    @param match_on The table's match_on attribute; at most MAX_FIELDS
+    header references, all valid matches
+
+    The validity of the match_on headers, one bit per header from the
+    packet's valid_bits, indexes a list of 2 ** fields entries. The list
+    is rebuilt from the ExactIndex groups whenever entries change, each
+    position holding the entry ExactIndex.lookup would find.
+    """
+
+    # Largest number of match fields for which the index is used
+    MAX_FIELDS = 8
+
+    def __init__(self, match_on):
+        ExactIndex.__init__(self, match_on)
+        self.fields = sorted(self.match_on.keys())
+        air_check(len(self.fields) <= ValidIndex.MAX_FIELDS, IriParamError)
+        self.handles = [match_field_handle(field) for field in self.fields]
+        for handle in self.handles:
+            air_check(handle.field is None and handle.index is None,
+                      IriParamError)
+        self.table = [None] * (1 << len(self.fields))
+
+    def _build_table(self):
+        """
+        @brief Rebuild the list of entries by validity bits
+        """
+        table = []
+        for bits in range(1 << len(self.fields)):
+            valid = dict([(field, bool(bits >> idx & 1)) for
+                          idx, field in enumerate(self.fields)])
+            best = None
+            for (fields, handles, key_map) in self.groups:
+                entry = key_map.get(tuple([valid[field] for
+                                           field in fields]), None)
+                if entry is not None and (best is None or
+                                          self.entry_order[entry] <
+                                          self.entry_order[best]):
+                    best = entry
+            table.append(best)
+        self.table = table
+
+    def add(self, entry):
+        for field in entry_match_fields(entry):
+            if field not in self.match_on:
+                raise IriParamError("Entry field %s is not a match field" %
+                                    field)
+        ExactIndex.add(self, entry)
+        self._build_table()
+
+    def remove(self, entry):
+        if not ExactIndex.remove(self, entry):
+            return False
+        self._build_table()
+        return True
+
+    def lookup(self, parsed_packet):
+        valid_bits = parsed_packet.valid_bits
+        index = 0
+        for idx, handle in enumerate(self.handles):
+            slot = handle.slot
+            if slot is not None and valid_bits >> slot & 1:
+                index |= 1 << idx
+        return self.table[index]
+
+class LpmNode(object):
+    """
+    @brief A node of an LpmTrie, covering 8 bits of the address
+
+    @param slots Map from byte value to (entry, length) for the longest
+    prefix ending at this node that covers the byte value
+    @param children Map from byte value to the LpmNode for the next 8
+    bits of the address
+    @param prefixes Map from (masked byte value, length) to entry for the
+    prefixes ending at this node; length is 0 to 8 bits
+
+    Nodes use dicts rather than 256 element arrays so memory grows with
+    the number of prefixes rather than the number of nodes.
+    """
+    __slots__ = ["slots", "children", "prefixes"]
+
+    def __init__(self):
+        self.slots = {}
+        self.children = {}
+        self.prefixes = {}
+
+    def best(self, byte_value, max_length):
+        """
+        @brief Return (entry, length) for the longest prefix at this node
+        covering byte_value with length at most max_length, or None
+        """
+        for length in range(max_length, -1, -1):
+            key = (byte_value & (0xff << (8 - length)) & 0xff, length)
+            if key in self.prefixes:
+                return (self.prefixes[key], length)
+        return None
+
+class LpmTrie(object):
+    """
+    @brief A multibit trie for longest prefix match, 8 bits per level
+
+    @param width The width of the addresses in bits; a multiple of 8
+
+    A prefix is stored in the node at the level where it ends, expanded
+    into every byte value it covers at that level (controlled prefix
+    expansion) unless a longer prefix there covers the value. A lookup
+    follows at most width / 8 nodes, keeping the last prefix seen, so
+    its cost depends on the address width, not the number of prefixes.
+    Inserting or deleting a prefix changes only the node where it ends
+    (at most 256 slots), plus creating or pruning nodes on its path.
+
+    A copy of a trie shares its nodes. Each copies a shared node before
+    changing it (path copying), so a change costs at most a few node
+    copies and never affects lookups in the other trie.
+    """
+    def __init__(self, width):
+        air_check(width > 0 and width % 8 == 0, IriParamError)
+        self.width = width
+        self.root = LpmNode()
+        self.count = 0
+        self.owned = set([self.root]) # Nodes not shared with a copy
+
+    def copy(self):
+        """
+        @brief Return a copy of the trie sharing its nodes
+        """
+        trie = copy.copy(self)
+        trie.owned = set()
+        self.owned = set()
+        return trie
+
+    def _own(self, node):
+        """
+        @brief Return node, or a copy of it if it is shared
+        """
+        if node in self.owned:
+            return node
+        clone = LpmNode()
+        clone.slots = dict(node.slots)
+        clone.children = dict(node.children)
+        clone.prefixes = dict(node.prefixes)
+        self.owned.add(clone)
+        return clone
+
+    def _own_path(self, value, level, create):
+        """
+        @brief Make the nodes on the path to a level owned by this trie
+        @param create If True, create missing nodes; otherwise return
+        None if a node is missing
+        @returns The list of (node, byte) on the path and the node at
+        the level
+        """
+        self.root = self._own(self.root)
+        path = []
+        node = self.root
+        for idx in range(level):
+            byte = self._byte(value, idx)
+            child = node.children.get(byte, None)
+            if child is None:
+                if not create:
+                    return None
+                child = LpmNode()
+                self.owned.add(child)
+            else:
+                child = self._own(child)
+            node.children[byte] = child
+            path.append((node, byte))
+            node = child
+        return (path, node)
+
+    def _byte(self, value, level):
+        if isinstance(value, bytearray):
+            return value[level]
+        return (value >> (self.width - 8 * (level + 1))) & 0xff
+
+    def _position(self, value, length):
+        """
+        @brief Return (level, byte value, bits used at that level)
+        where a prefix ends
+        """
+        air_check(0 <= length <= self.width, IriParamError)
+        level = 0
+        if length > 0:
+            level = (length - 1) / 8
+        bits = length - 8 * level
+        byte_value = self._byte(value, level) & (0xff << (8 - bits)) & 0xff
+        return (level, byte_value, bits)
+
+    def insert(self, value, length, entry):
+        """
+        @brief Add a prefix; raises IriParamError if it is present
+        @param value The address (bits beyond the prefix are ignored)
+        @param length The prefix length in bits
+        @param entry The object returned by lookup for the prefix
+        """
+        (level, byte_value, bits) = self._position(value, length)
+        (path, node) = self._own_path(value, level, True)
+        if (byte_value, bits) in node.prefixes:
+            raise IriParamError("Duplicate prefix %s/%d" %
+                                (str(value), length))
+        node.prefixes[(byte_value, bits)] = entry
+        for slot in range(byte_value, byte_value + (1 << (8 - bits))):
+            current = node.slots.get(slot, None)
+            if current is None or current[1] <= bits:
+                node.slots[slot] = (entry, bits)
+        self.count += 1
+
+    def delete(self, value, length):
+        """
+        @brief Remove a prefix
+        @returns The entry for the prefix or None if not present
+        """
+        (level, byte_value, bits) = self._position(value, length)
+        node = self.root
+        for idx in range(level):
+            node = node.children.get(self._byte(value, idx), None)
+            if node is None:
+                return None
+        if (byte_value, bits) not in node.prefixes:
+            return None
+        (path, node) = self._own_path(value, level, False)
+        entry = node.prefixes.pop((byte_value, bits))
+        for slot in range(byte_value, byte_value + (1 << (8 - bits))):
+            current = node.slots.get(slot, None)
+            if current is not None and current[0] is entry:
+                best = node.best(slot, bits - 1)
+                if best is None:
+                    del node.slots[slot]
+                else:
+                    node.slots[slot] = best
+        # Prune nodes left with no prefixes or children
+        while path and not node.prefixes and not node.children:
+            (parent, byte) = path.pop()
+            del parent.children[byte]
+            node = parent
+        self.count -= 1
+        return entry
+
+    def lookup(self, value):
+        """
+        @brief Return the entry for the longest prefix matching value
+        """
+        best = None
+        node = self.root
+        level = 0
+        while node is not None:
+            byte = self._byte(value, level)
+            slot = node.slots.get(byte, None)
+            if slot is not None:
+                best = slot[0]
+            node = node.children.get(byte, None)
+            level += 1
+        return best
+
+def prefix_length(mask, width):
+    """
+    @brief Return the prefix length of a mask or None if not a prefix
+    @param mask The mask; None means all width bits
+    @param width The width of the field in bits
+    """
+    full = (1 << width) - 1
+    if mask is None:
+        return width
+    inverted = ~mask & full
+    if mask & ~full or inverted & (inverted + 1):
+        return None
+    return width - inverted.bit_length()
+
+class LpmIndex(TableIndex):
+    """
+    @brief Longest prefix match for a table with one lpm field
+
+    @param match_on The table's match_on attribute
+    @param width The width of the lpm field in bits (a multiple of 8)
+
+    Other match fields must be exact; entries are grouped by the tuple of
+    their values (see match_value_int), each group with an LpmTrie for
+    the lpm field. An entry
+    gives the prefix as the lpm field's value and a mask of leading one
+    bits (or no mask for a full length prefix).
+
+    A copy of the index shares its tries; each copies a shared trie (in
+    turn sharing its nodes) before changing it.
+    """
+    def __init__(self, match_on, width):
+        TableIndex.__init__(self, match_on)
+        lpm_fields = [field for field, match_type in self.match_on.items()
+                      if match_type == "lpm"]
+        air_check(len(lpm_fields) == 1, IriParamError)
+        self.lpm_field = lpm_fields[0]
+        self.lpm_handle = match_field_handle(self.lpm_field)
+        self.exact_fields = sorted([field for field in self.match_on.keys()
+                                    if field != self.lpm_field])
+        self.exact_handles = [match_field_handle(field) for
+                              field in self.exact_fields]
+        self.width = width
+        self.tries = CowMap() # Map from tuple of exact values to LpmTrie
+        self.owned = set() # Keys of tries not shared with a copy
+
+    def copy(self):
+        index = TableIndex.copy(self)
+        index.tries = self.tries.copy()
+        index.owned = set()
+        self.owned = set()
+        return index
+
+    def _own_trie(self, key):
+        """
+        @brief Return the trie for key (created if missing), copied
+        first if it is shared
+        """
+        trie = self.tries.get(key, None)
+        if trie is None:
+            trie = LpmTrie(self.width)
+        elif key in self.owned:
+            return trie
+        else:
+            trie = trie.copy()
+        self.tries[key] = trie
+        self.owned.add(key)
+        return trie
+
+    def _prefix(self, entry):
+        """
+        @brief Return (exact key, value, prefix length) for an entry
+        """
+        match_values = entry.match_values or {}
+        masks = getattr(entry, "match_masks", None) or {}
+        if sorted(match_values.keys()) != sorted(self.match_on.keys()):
+            raise IriParamError("LPM entry must give every match field")
+        for field in self.exact_fields:
+            if masks.get(field, None) is not None:
+                raise IriParamError("LPM entry has a mask for %s" % field)
+        length = prefix_length(masks.get(self.lpm_field, None), self.width)
+        if length is None:
+            raise IriParamError("LPM entry mask is not a prefix")
+        key = tuple([match_value_int(match_values[field]) for
+                     field in self.exact_fields])
+        return (key, match_values[self.lpm_field], length)
+
+    def add(self, entry):
+        (key, value, length) = self._prefix(entry)
+        trie = self._own_trie(key)
+        try:
+            trie.insert(value, length, entry)
+        finally:
+            if trie.count == 0:
+                del self.tries[key]
+        self._order_add(entry)
+
+    def remove(self, entry):
+        if entry not in self.entry_order:
+            return False
+        (key, value, length) = self._prefix(entry)
+        trie = self._own_trie(key)
+        trie.delete(value, length)
+        if trie.count == 0:
+            del self.tries[key]
+        del self.entry_order[entry]
+        return True
+
+    def lookup(self, parsed_packet):
+        key = tuple([match_value_int(parsed_packet.get(handle)) for
+                     handle in self.exact_handles])
+        trie = self.tries.get(key, None)
+        if trie is None:
+            return None
+        value = parsed_packet.get(self.lpm_handle)
+        if value is None:
+            return None
+        return trie.lookup(value)
+
+def rule_match(checks, values):
+    """
+    @brief Check the match fields of a rule against a packet's key values
+    @param checks List of (position, value, mask) for the rule's fields;
+    value is masked and mask None means exact
+    @param values The packet's key values by position (see
+    RankedIndex.key_values)
+    """
+    for (pos, value, mask) in checks:
+        p_value = values[pos]
+        if p_value is None:
+            return False
+        if mask is not None:
+            p_value &= mask
+        if p_value != value:
+            return False
+    return True
+
+class RankedIndex(TableIndex):
+    """
+    @brief Base class for indexes that choose among matching entries
+    by rank
+
+    An entry's rank is its priority (higher numbers win), then the order
+    entries were added (earlier wins), as the table's linear search
+    gave when priorities are equal. A field an entry gives no value for
+    is not matched. For a valid match (a header reference) the value
+    compared is whether the header is valid.
+
+    The fields matched by some entry are numbered as they are first
+    seen; a packet's key is the list of its values for those fields.
+    Values and masks of fields wider than 64 bits are converted to
+    integers (see match_value_int).
+    """
+    def __init__(self, match_on):
+        TableIndex.__init__(self, match_on)
+        self.field_refs = [] # Fields matched by some entry
+        self.field_pos = {} # Map from field ref to position in field_refs
+        self.handles = [] # (handle, valid_match) by position
+
+    def copy(self):
+        index = TableIndex.copy(self)
+        index.field_refs = list(self.field_refs)
+        index.field_pos = dict(self.field_pos)
+        return index
+
+    def _field_position(self, field_ref):
+        pos = self.field_pos.get(field_ref, None)
+        if pos is None:
+            pos = len(self.field_refs)
+            handle = match_field_handle(field_ref)
+            # Replaced rather than appended to, as copies share it
+            self.handles = self.handles + [(handle, handle.field is None)]
+            self.field_refs.append(field_ref)
+            self.field_pos[field_ref] = pos
+        return pos
+
+    def _entry_checks(self, entry):
+        """
+        @brief Return the list of (position, masked value, mask) for the
+        match fields of an entry
+        """
+        masks = getattr(entry, "match_masks", None) or {}
+        checks = []
+        for field_ref in entry_match_fields(entry):
+            pos = self._field_position(field_ref)
+            value = match_value_int(entry.match_values[field_ref])
+            mask = match_value_int(masks.get(field_ref, None))
+            if self.handles[pos][1]:
+                (value, mask) = (bool(value), None)
+            elif mask is not None:
+                value &= mask
+            checks.append((pos, value, mask))
+        return checks
+
+    def _rank(self, entry):
+        """
+        @brief Return the rank of an entry in the index
+        """
+        priority = getattr(entry, "priority", 0) or 0
+        return (priority, -self.entry_order[entry])
+
+    def _rank_add(self, entry):
+        """
+        @brief Record an entry being added and return its rank
+        """
+        self._order_add(entry)
+        return self._rank(entry)
+
+    def key_values(self, parsed_packet):
+        """
+        @brief Return the list of a packet's values for the match fields
+        """
+        values = []
+        for (handle, valid_match) in self.handles:
+            value = parsed_packet.get(handle)
+            if valid_match:
+                value = value is not None
+            elif isinstance(value, bytearray):
+                value = bits_from_bytes(value, 0, len(value))
+            values.append(value)
+        return values
+
+class TupleSpaceGroup(object):
+    """
+    @brief The entries of a TupleSpaceIndex with one mask tuple
+
+    @param fields Tuple of (field position, mask) for the fields the
+    entries match on; mask None means exact
+    @param buckets CowMap from the tuple of masked values to the list of
+    (rank, entry) with those values, highest rank first
+    @param best_rank The highest rank of an entry in the group
+    """
+    __slots__ = ["fields", "buckets", "best_rank"]
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.buckets = CowMap()
+        self.best_rank = None
+
+class TupleSpaceIndex(RankedIndex):
+    """
+    @brief Priority ordered ternary matching by tuple space search
+
+    Entries are grouped by their mask tuple: the fields they match on
+    and the mask of each. Within a group, entries are hashed on their
+    masked values, so a group costs one dict probe per lookup however
+    many entries it holds. Groups are searched in order of the best
+    entry they hold; once an entry is found, groups with no entry that
+    could outrank it are skipped. See RankedIndex for how entries rank.
+
+    A copy of the index shares its groups; each copies a shared group
+    (in turn sharing the group's buckets) before changing it, and the
+    list of groups before changing that. Buckets are replaced, not
+    modified, when entries are added or removed.
+    """
+    def __init__(self, match_on):
+        RankedIndex.__init__(self, match_on)
+        self.groups = [] # TupleSpaceGroups, best rank first
+        self.group_map = CowMap() # Map from group fields to group
+        self.owned = set() # Groups not shared with a copy
+        self.groups_owned = True # False if groups is shared with a copy
+
+    def copy(self):
+        index = RankedIndex.copy(self)
+        index.group_map = self.group_map.copy()
+        index.owned = set()
+        self.owned = set()
+        index.groups_owned = False
+        self.groups_owned = False
+        return index
+
+    def _own_groups(self):
+        """
+        @brief Copy the list of groups first if it is shared
+        """
+        if not self.groups_owned:
+            self.groups = list(self.groups)
+            self.groups_owned = True
+
+    def _own_group(self, group):
+        """
+        @brief Return group, or a copy of it if it is shared
+        """
+        if group in self.owned:
+            return group
+        clone = TupleSpaceGroup(group.fields)
+        clone.buckets = group.buckets.copy()
+        clone.best_rank = group.best_rank
+        self._own_groups()
+        self.groups[self.groups.index(group)] = clone
+        self.group_map[group.fields] = clone
+        self.owned.add(clone)
+        return clone
+
+    def _entry_fields(self, entry):
+        """
+        @brief Return (group fields, masked values) for an entry
+        """
+        checks = self._entry_checks(entry)
+        return (tuple([(pos, mask) for (pos, value, mask) in checks]),
+                tuple([value for (pos, value, mask) in checks]))
+
+    def _sort_groups(self):
+        self._own_groups()
+        self.groups.sort(key=lambda group: group.best_rank, reverse=True)
+
+    def add(self, entry):
+        (fields, key) = self._entry_fields(entry)
+        rank = self._rank_add(entry)
+
+        group = self.group_map.get(fields, None)
+        if group is None:
+            group = TupleSpaceGroup(fields)
+            self.group_map[fields] = group
+            self._own_groups()
+            self.groups.append(group)
+            self.owned.add(group)
+        else:
+            group = self._own_group(group)
+        bucket = group.buckets.get(key, []) + [(rank, entry)]
+        bucket.sort(reverse=True)
+        group.buckets[key] = bucket
+        if group.best_rank is None or rank > group.best_rank:
+            group.best_rank = rank
+            self._sort_groups()
+
+    def remove(self, entry):
+        if entry not in self.entry_order:
+            return False
+        (fields, key) = self._entry_fields(entry)
+        rank = self._rank(entry)
+        group = self._own_group(self.group_map[fields])
+        bucket = [item for item in group.buckets[key] if item[1] is not entry]
+        if bucket:
+            group.buckets[key] = bucket
+        else:
+            del group.buckets[key]
+        if not group.buckets:
+            del self.group_map[fields]
+            self._own_groups()
+            self.groups.remove(group)
+        elif rank == group.best_rank:
+            group.best_rank = max([items[0][0] for
+                                   items in group.buckets.values()])
+            self._sort_groups()
+        del self.entry_order[entry]
+        return True
+
+    def lookup(self, parsed_packet):
+        values = self.key_values(parsed_packet)
+        best = None
+        best_rank = None
+        for group in self.groups:
+            if best is not None and group.best_rank < best_rank:
+                break
+            key = []
+            for (pos, mask) in group.fields:
+                value = values[pos]
+                if value is None:
+                    break
+                if mask is not None:
+                    value &= mask
+                key.append(value)
+            else:
+                bucket = group.buckets.get(tuple(key), None)
+                if bucket is not None:
+                    (rank, entry) = bucket[0]
+                    if best is None or rank > best_rank:
+                        best = entry
+                        best_rank = rank
+        return best
+
+class DecisionTreeNode(object):
+    """
+    @brief A node of a DecisionTree
+
+    @param pos The position of the field the node cuts on
+    @param bit The bit of the field the node cuts on
+    @param children The (bit clear, bit set) child nodes; None for a leaf
+    @param rules List of (rank, entry, checks) to check at this node,
+    highest rank first
+    """
+    __slots__ = ["pos", "bit", "children", "rules"]
+
+    def __init__(self):
+        self.pos = None
+        self.bit = None
+        self.children = None
+        self.rules = []
+
+class DecisionTree(object):
+    """
+    @brief A decision tree classifier over ternary rules (HiCuts style)
+
+    @param rules List of (rank, entry, checks) with checks as for
+    rule_match
+    @param widths List of the widths (in bits) of the fields by position
+    @param leaf_size Stop cutting nodes with at most this many rules
+    @param max_depth Stop cutting nodes at this depth
+
+    Each internal node cuts the rules on one bit of one field: a rule
+    that cares about the bit goes to the child for its value, a rule
+    that does not goes to both. Ternary masks need not be ranges, so
+    cuts are on single bits; taking a field's bits from the most
+    significant down is HiCuts' halving of the field's range. The cut
+    is chosen, from a sample of the node's rules, among the top few
+    bits of each field that separate some of its rules, minimizing the
+    larger child.
+
+    As in HyperCuts, rules with no uncut bit left to separate them are
+    kept at the node rather than copied into every descendant.
+
+    A lookup walks one path from the root, checking the rules kept at
+    each node on the way; the cost depends on the depth and leaf size
+    rather than the number of rules or distinct masks.
+
+    Attributes:
+      * build_time: Seconds taken to build the tree
+      * node_count: Number of nodes
+      * rule_refs: Number of rules kept at nodes, counting copies
+      * max_depth_seen: Number of nodes on the longest path
+      * memory: Approximate size of the nodes and rule lists in bytes
+    """
+
+    # Number of rules sampled to choose each cut
+    SAMPLE_SIZE = 64
+
+    # Number of bits of each field considered for each cut
+    CANDIDATE_BITS = 4
+
+    def __init__(self, rules, widths, leaf_size=8, max_depth=40):
+        start = time.time()
+        self.leaf_size = leaf_size
+        self.max_depth = max_depth
+        self.node_count = 0
+        self.rule_refs = 0
+        self.max_depth_seen = 0
+        self.memory = 0
+        self.entries = [rule[1] for rule in rules]
+        # Positions of fields whose packet values may be bytearrays
+        self.wide = [pos for pos, width in enumerate(widths) if width > 64]
+
+        # (rule, care masks by position, values by position) for cutting
+        cut_rules = []
+        for rule in rules:
+            cares = [0] * len(widths)
+            values = [0] * len(widths)
+            for (pos, value, mask) in rule[2]:
+                full = (1 << widths[pos]) - 1
+                cares[pos] = full if mask is None else mask & full
+                values[pos] = match_value_int(value) & cares[pos]
+            cut_rules.append((rule, cares, values))
+        remaining = [(1 << width) - 1 for width in widths]
+        self.root = self._build(cut_rules, remaining, 1)
+        self.build_time = time.time() - start
+
+    def _node(self, rules, depth):
+        node = DecisionTreeNode()
+        node.rules = sorted([rule[0] for rule in rules], reverse=True)
+        self.node_count += 1
+        self.rule_refs += len(node.rules)
+        self.max_depth_seen = max(self.max_depth_seen, depth)
+        self.memory += sys.getsizeof(node) + sys.getsizeof(node.rules)
+        return node
+
+    def _choose_cut(self, rules, remaining):
+        """
+        @brief Return the (position, bit) to cut on or None
+        """
+        step = max(1, len(rules) / DecisionTree.SAMPLE_SIZE)
+        sample = rules[::step]
+        best = None
+        best_score = None
+        for pos in range(len(remaining)):
+            # Bits for which the sample has rules needing each value
+            ones = 0
+            zeros = 0
+            for (rule, cares, values) in sample:
+                ones |= values[pos]
+                zeros |= cares[pos] & ~values[pos]
+            useful = ones & zeros & remaining[pos]
+            for idx in range(DecisionTree.CANDIDATE_BITS):
+                if not useful:
+                    break
+                bit = useful.bit_length() - 1
+                useful &= ~(1 << bit)
+                counts = [0, 0]
+                wild = 0
+                for (rule, cares, values) in sample:
+                    if cares[pos] >> bit & 1:
+                        counts[values[pos] >> bit & 1] += 1
+                    else:
+                        wild += 1
+                score = (max(counts) + wild, wild)
+                if best_score is None or score < best_score:
+                    best = (pos, bit)
+                    best_score = score
+        return best
+
+    def _build(self, rules, remaining, depth):
+        kept = []
+        rest = []
+        for cut_rule in rules:
+            for pos in range(len(remaining)):
+                if cut_rule[1][pos] & remaining[pos]:
+                    rest.append(cut_rule)
+                    break
+            else:
+                kept.append(cut_rule)
+        cut = None
+        if len(rest) > self.leaf_size and depth < self.max_depth:
+            cut = self._choose_cut(rest, remaining)
+        if cut is None:
+            return self._node(rules, depth)
+
+        node = self._node(kept, depth)
+        (pos, bit) = cut
+        node.pos = pos
+        node.bit = bit
+        parts = ([], [])
+        for cut_rule in rest:
+            if cut_rule[1][pos] >> bit & 1:
+                parts[cut_rule[2][pos] >> bit & 1].append(cut_rule)
+            else:
+                parts[0].append(cut_rule)
+                parts[1].append(cut_rule)
+        remaining = list(remaining)
+        remaining[pos] &= ~(1 << bit)
+        node.children = (self._build(parts[0], remaining, depth + 1),
+                         self._build(parts[1], remaining, depth + 1))
+        self.memory += sys.getsizeof(node.children)
+        return node
+
+    def lookup(self, values, rules):
+        """
+        @brief Find the best rule matching a packet
+        @param values The packet's key values by position; values of
+        fields wider than 64 bits may be bytearrays
+        @param rules Map from entry to rule for the entries present;
+        rules of the tree for other entries (or not the same rule
+        object) are skipped
+        @returns (entry, rank, depth) with entry and rank None on a miss
+        and depth the number of nodes visited
+        """
+        if self.wide:
+            values = list(values)
+            for pos in self.wide:
+                values[pos] = match_value_int(values[pos])
+        best = None
+        best_rank = None
+        depth = 0
+        node = self.root
+        while node is not None:
+            depth += 1
+            for rule in node.rules:
+                if best is not None and rule[0] <= best_rank:
+                    break
+                if rules.get(rule[1], None) is rule and \
+                        rule_match(rule[2], values):
+                    (best_rank, best) = rule[:2]
+                    break
+            if node.children is None:
+                break
+            value = values[node.pos]
+            if value is None:
+                # Rules reading the field cannot match; either child
+                # holds the rules that do not read it
+                node = node.children[0]
+            else:
+                node = node.children[value >> node.bit & 1]
+        return (best, best_rank, depth)
+
+class DecisionTreeState(object):
+    """
+    @brief State shared by a DecisionTreeIndex and its copies
+
+    Attributes:
+      * lock: Serializes adopting a built tree with changes to the index
+      * builder: The thread building a tree, True while a tree is built
+        in the calling thread, or None
+      * lookups: Number of lookups
+      * depth_total: Total number of tree nodes visited by lookups
+
+    The lookup counts are kept without locking and so are approximate
+    when lookups run in several threads.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.builder = None
+        self.lookups = 0
+        self.depth_total = 0
+
+class DecisionTreeIndex(RankedIndex):
+    """
+    @brief Ternary matching with a DecisionTree rebuilt in the background
+
+    @param match_on The table's match_on attribute
+    @param rebuild_threshold Rebuild the tree when this many entries
+    have been added or removed since it was built
+    @param background If True, rebuild in a separate thread
+
+    Lookups search the tree, then linearly the rules of the entries
+    added since it was built. Entries removed since then are skipped by
+    checking the index still has the tree's rule for them. The tree and
+    the newer rules are replaced together in a single assignment, so a
+    lookup never sees a tree with the wrong rules. See RankedIndex for
+    how entries rank.
+
+    The index is copied and published like the others; the tree is
+    shared by the copies. A tree built in the background is adopted by
+    whichever copy is current when the build finishes, through the
+    updater (a table update, see TableIndex), so it is published like
+    any other change and never in the middle of a batch.
+
+    Attributes:
+      * tree: The current DecisionTree (or None)
+      * rules: CowMap from entry to its rule, (rank, entry, checks)
+      * snapshot: (tree, tuple of the rules of entries added since the
+        tree was built)
+      * state: The DecisionTreeState shared with copies
+    """
+    def __init__(self, match_on, rebuild_threshold=64, background=True):
+        RankedIndex.__init__(self, match_on)
+        self.rebuild_threshold = rebuild_threshold
+        self.background = background
+        self.state = DecisionTreeState()
+        self.rules = CowMap()
+        self.widths = [] # Width of each field by position
+        self.snapshot = (None, ())
+        self.stale = 0 # Entries removed since the tree was built
+
+    @property
+    def tree(self):
+        return self.snapshot[0]
+
+    def copy(self):
+        index = RankedIndex.copy(self)
+        index.rules = self.rules.copy()
+        index.widths = list(self.widths)
+        return index
+
+    def add(self, entry):
+        with self.state.lock:
+            checks = self._entry_checks(entry)
+            while len(self.widths) < len(self.field_refs):
+                self.widths.append(0)
+            for (pos, value, mask) in checks:
+                width = (value if mask is None else mask).bit_length()
+                self.widths[pos] = max(self.widths[pos], width)
+            rule = (self._rank_add(entry), entry, checks)
+            self.rules[entry] = rule
+            (tree, recent) = self.snapshot
+            self.snapshot = (tree, recent + (rule,))
+            self._check_rebuild()
+
+    def remove(self, entry):
+        with self.state.lock:
+            rule = self.rules.pop(entry, None)
+            if rule is None:
+                return False
+            del self.entry_order[entry]
+            (tree, recent) = self.snapshot
+            remaining = tuple([other for other in recent
+                               if other is not rule])
+            if len(remaining) < len(recent):
+                self.snapshot = (tree, remaining)
+            else:
+                self.stale += 1
+            self._check_rebuild()
+        return True
+
+    def _check_rebuild(self):
+        """
+        @brief Start a rebuild if enough entries changed
+
+        Must be called with the lock held.
+        """
+        if self.state.builder is None and \
+                len(self.snapshot[1]) + self.stale >= \
+                self.rebuild_threshold:
+            self._start_rebuild()
+
+    def _start_rebuild(self):
+        """
+        @brief Build a tree from the current rules
+
+        Must be called with the lock held. Without background, the tree
+        is built and adopted before returning.
+        """
+        args = (self.rules.values(), list(self.widths), self.sequence)
+        if self.background:
+            builder = threading.Thread(target=self._build, args=args)
+            builder.daemon = True
+            builder.start()
+            # Set after start() for wait(); the lock keeps the builder
+            # from finishing first
+            self.state.builder = builder
+        else:
+            self._adopt(DecisionTreeIndex._build_tree(*args[:2]), args[2])
+
+    def rebuild(self, wait=True):
+        """
+        @brief Rebuild the tree from the current entries
+        @param wait If True, return when the new tree is adopted
+
+        A rebuild in progress is waited for first, as it may not include
+        the latest entries. Must not be called during a table update;
+        the tree is adopted through one.
+        """
+        while True:
+            self.wait()
+            with self.state.lock:
+                if self.state.builder is None:
+                    args = (self.rules.values(), list(self.widths),
+                            self.sequence)
+                    if self.background:
+                        self._start_rebuild()
+                    else:
+                        self.state.builder = True
+                    break
+        if not self.background:
+            self._build(*args)
+        if wait:
+            self.wait()
+
+    def wait(self):
+        """
+        @brief Wait for a background rebuild to finish, its tree
+        adopted and published
+        """
+        builder = self.state.builder
+        if isinstance(builder, threading.Thread):
+            builder.join()
+
+    @staticmethod
+    def _build_tree(rules, widths):
+        tree = DecisionTree(rules, widths)
+        logging.info("Decision tree: %d rules, %d nodes, depth %d, "
+                     "%d rule copies, %d bytes, built in %.3f sec" %
+                     (len(rules), tree.node_count, tree.max_depth_seen,
+                      tree.rule_refs, tree.memory, tree.build_time))
+        return tree
+
+    def _change(self, update):
+        """
+        @brief Apply a change to the current copy of the index, through
+        the updater if there is one
+        """
+        if self.updater is None:
+            update(self)
+        else:
+            self.updater(update)
+
+    def _build(self, rules, widths, sequence):
+        """
+        @brief Build a tree and have the current copy of the index
+        adopt it
+        @param sequence The sequence number of the last entry in rules
+
+        The build is finished (for wait) once the tree is published.
+        """
+        tree = DecisionTreeIndex._build_tree(rules, widths)
+        state = self.state
+        def adopt(index):
+            # The table may have been cleared since the build started
+            if index.state is state:
+                with state.lock:
+                    index._adopt(tree, sequence)
+        def catch_up(index):
+            # Rebuild if enough changed during the build
+            if index.state is state:
+                with state.lock:
+                    index._check_rebuild()
+        try:
+            self._change(adopt)
+        finally:
+            with state.lock:
+                state.builder = None
+        self._change(catch_up)
+
+    def _adopt(self, tree, sequence):
+        """
+        @brief Use a tree built from the rules up to sequence
+
+        Must be called with the lock held. Every entry present from
+        before the build is in the tree, so the tree's other entries
+        are the ones removed since.
+        """
+        recent = tuple([rule for rule in self.snapshot[1]
+                        if -rule[0][1] > sequence])
+        self.stale = len(tree.entries) - (len(self) - len(recent))
+        self.snapshot = (tree, recent)
+
+    def lookup(self, parsed_packet):
+        (tree, recent) = self.snapshot
+        values = self.key_values(parsed_packet)
+        best = None
+        best_rank = None
+        if tree is not None:
+            (best, best_rank, depth) = tree.lookup(values, self.rules)
+            self.state.lookups += 1
+            self.state.depth_total += depth
+        for (rank, entry, checks) in recent:
+            if best is not None and rank <= best_rank:
+                continue
+            if rule_match(checks, values):
+                best = entry
+                best_rank = rank
+        return best
+
+    def stats(self):
+        """
+        @brief Return a map of statistics for the tree and its lookups
+        """
+        tree = self.tree
+        state = self.state
+        stats = {"entries" : len(self),
+                 "pending" : len(self.snapshot[1]),
+                 "lookups" : state.lookups,
+                 "mean_depth" : (float(state.depth_total) / state.lookups
+                                 if state.lookups else 0.0)}
+        if tree is not None:
+            stats.update({"build_time" : tree.build_time,
+                          "nodes" : tree.node_count,
+                          "rule_copies" : tree.rule_refs,
+                          "max_depth" : tree.max_depth_seen,
+                          "memory" : tree.memory})
+        return stats
+
+class ColumnarIndex(RankedIndex):
+    """
+    @brief Ternary matching against every entry at once with numpy
+
+    The entries are kept as numpy arrays with one row per entry, sorted
+    by rank (see RankedIndex), and for each match field a column of
+    masked values, a column of masks, a column recording whether the
+    entry matches on the field and one recording whether it matches
+    exactly. A lookup computes (key & mask) == value for every row of
+    each column, and the first row where all columns match holds the
+    best entry. lookup_batch does the same for a burst of packets at
+    once, BATCH_SIZE packets to an array operation.
+
+    Columns are uint64 unless an entry's value or mask does not fit, in
+    which case they hold Python integers (numpy object arrays). A packet
+    value too wide for a uint64 column can only match rows masking off
+    the bits beyond 64, so such rows are compared on its low 64 bits
+    and exact rows not at all.
+
+    The arrays are rebuilt by prepare() after entries change, so a
+    table builds them once for a batch of updates, before publishing
+    the index. Lookups in an index not prepared build them first.
+
+    Raises IriImplementationError if numpy is not installed.
+    """
+
+    # Largest value held in a uint64 column; also the mask for exact
+    # matches in such columns
+    UINT64_MAX = (1 << 64) - 1
+
+    # Packets evaluated together by lookup_batch; bounds the size of the
+    # intermediate arrays
+    BATCH_SIZE = 16
+
+    def __init__(self, match_on):
+        if numpy is None:
+            raise IriImplementationError("ColumnarIndex requires numpy")
+        RankedIndex.__init__(self, match_on)
+        self.rules = CowMap() # Map from entry to (rank, checks)
+        # (entries by rank, [(values, masks, matched, exact)] by
+        # position), or None if the entries have changed since the
+        # arrays were built
+        self.columns = None
+
+    def copy(self):
+        index = RankedIndex.copy(self)
+        index.rules = self.rules.copy()
+        return index
+
+    def add(self, entry):
+        checks = self._entry_checks(entry)
+        self.rules[entry] = (self._rank_add(entry), checks)
+        self.columns = None
+
+    def remove(self, entry):
+        if self.rules.pop(entry, None) is None:
+            return False
+        del self.entry_order[entry]
+        self.columns = None
+        return True
+
+    def prepare(self):
+        if self.columns is None:
+            self.columns = self._build_columns()
+
+    def _build_columns(self):
+        """
+        @brief Return the arrays for the current entries
+        """
+        rules = sorted([(rank, entry, checks) for
+                        (entry, (rank, checks)) in self.rules.items()],
+                       reverse=True)
+        field_count = len(self.field_refs)
+        values = [[0] * len(rules) for pos in range(field_count)]
+        masks = [[0] * len(rules) for pos in range(field_count)]
+        matched = [[False] * len(rules) for pos in range(field_count)]
+        exact = [[False] * len(rules) for pos in range(field_count)]
+        for row, (rank, entry, checks) in enumerate(rules):
+            for (pos, value, mask) in checks:
+                values[pos][row] = match_value_int(value)
+                masks[pos][row] = mask
+                matched[pos][row] = True
+                exact[pos][row] = mask is None
+
+        columns = []
+        for pos in range(field_count):
+            wide = False
+            for row in range(len(rules)):
+                if values[pos][row] > ColumnarIndex.UINT64_MAX or \
+                        (masks[pos][row] or 0) > ColumnarIndex.UINT64_MAX:
+                    wide = True
+                    break
+            exact_mask = -1 if wide else ColumnarIndex.UINT64_MAX
+            column_masks = [exact_mask if mask is None else mask for
+                            mask in masks[pos]]
+            dtype = object if wide else numpy.uint64
+            columns.append((numpy.array(values[pos], dtype=dtype),
+                            numpy.array(column_masks, dtype=dtype),
+                            numpy.array(matched[pos], dtype=bool),
+                            numpy.array(exact[pos], dtype=bool)))
+        return ([rule[1] for rule in rules], columns)
+
+    def _arrays(self):
+        """
+        @brief Return the arrays, building them if not prepared
+        """
+        columns = self.columns
+        if columns is None:
+            columns = self.columns = self._build_columns()
+        return columns
+
+    def lookup(self, parsed_packet):
+        (rows, arrays) = self._arrays()
+        if not rows:
+            return None
+        key = self.key_values(parsed_packet)
+        matches = numpy.ones(len(rows), dtype=bool)
+        for pos, (values, masks, matched, exact) in enumerate(arrays):
+            value = key[pos]
+            if value is None:
+                # Only entries that do not match on the field match
+                matches &= ~matched
+            elif values.dtype == object:
+                matches &= (masks & match_value_int(value)) == values
+            else:
+                value = match_value_int(value)
+                hit = (masks & numpy.uint64(value &
+                                            ColumnarIndex.UINT64_MAX)) == \
+                    values
+                if value > ColumnarIndex.UINT64_MAX:
+                    hit &= ~exact
+                matches &= hit
+        row = matches.argmax()
+        if matches[row]:
+            return rows[row]
+        return None
+
+    def lookup_batch(self, parsed_packets):
+        (rows, arrays) = self._arrays()
+        if not rows:
+            return [None] * len(parsed_packets)
+        result = []
+        batch_size = ColumnarIndex.BATCH_SIZE
+        for start in range(0, len(parsed_packets), batch_size):
+            keys = [self.key_values(parsed_packet) for parsed_packet in
+                    parsed_packets[start:start + batch_size]]
+            matches = numpy.ones((len(keys), len(rows)), dtype=bool)
+            for pos, (values, masks, matched, exact) in enumerate(arrays):
+                key_values = [match_value_int(key[pos]) for key in keys]
+                present = [value is not None for value in key_values]
+                if values.dtype == object:
+                    key_array = numpy.array([value or 0 for
+                                             value in key_values],
+                                            dtype=object)
+                    hit = (key_array[:, None] & masks) == values
+                else:
+                    key_array = numpy.array([(value or 0) &
+                                             ColumnarIndex.UINT64_MAX for
+                                             value in key_values],
+                                            dtype=numpy.uint64)
+                    hit = (key_array[:, None] & masks) == values
+                    too_wide = [value > ColumnarIndex.UINT64_MAX for
+                                value in key_values]
+                    if any(too_wide):
+                        hit &= ~(numpy.array(too_wide)[:, None] & exact)
+                if not all(present):
+                    # Packets without the field match only entries that
+                    # do not match on it
+                    hit = numpy.where(numpy.array(present)[:, None], hit,
+                                      ~matched)
+                matches &= hit
+            best_rows = matches.argmax(axis=1)
+            result.extend([rows[row] if matches[idx, row] else None for
+                           idx, row in enumerate(best_rows)])
+        return result
+
+def match_field_width(field_ref, header_layout):
+    """
+    @brief Return the width of a match field or None if not known
+    @param header_layout Map from header name to HeaderLayout
+    """
+    handle = match_field_handle(field_ref)
+    layout = (header_layout or {}).get(handle.header, None)
+    if layout is None or handle.field is None:
+        return None
+    idx = handle.field_index(layout)
+    if idx is None:
+        return None
+    return layout.widths[idx]
+
+# Index types that may be chosen for a table by name
+table_index_types = {
+    "linear" : LinearIndex,
+    "exact" : ExactIndex,
+    "valid" : ValidIndex,
+    "tuple_space" : TupleSpaceIndex,
+    "decision_tree" : DecisionTreeIndex,
+    "columnar" : ColumnarIndex,
+}
+
+def table_index_create(match_on, header_layout=None, index_type=None):
+    """
+    @brief Create the index for a table given its match_on attribute
+    @param match_on Map from field reference to match type
+    @param header_layout Map from header name to HeaderLayout, used to
+    find field widths
+    @param index_type If not None, a key of table_index_types naming
+    the index to use; otherwise the index is chosen from the match types
+    """
+    if index_type is not None:
+        if index_type not in table_index_types:
+            raise IriParamError("Unknown table index type %s" %
+                                str(index_type))
+        return table_index_types[index_type](match_on)
+    match_types = set((match_on or {}).values())
+    if match_types == set(["valid"]) and \
+            len(match_on) <= ValidIndex.MAX_FIELDS:
+        return ValidIndex(match_on)
+    if match_types and match_types <= set(["exact", "valid"]):
+        return ExactIndex(match_on)
+    if "lpm" in match_types and match_types <= set(["exact", "lpm"]):
+        lpm_fields = [field for field, match_type in match_on.items()
+                      if match_type == "lpm"]
+        width = match_field_width(lpm_fields[0], header_layout)
+        if len(lpm_fields) == 1 and width and width % 8 == 0:
+            return LpmIndex(match_on, width)
+        logging.warn("Table with lpm fields %s searched linearly" %
+                     str(lpm_fields))
+        return LinearIndex(match_on)
+    return TupleSpaceIndex(match_on)
+
+################################################################
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG, filename=sys.argv[1])
+    logging.info("RUNNING MODULE: %s" % __file__)
+
+    from parsed_packet import ParsedPacket
+    from table_entry import TableEntryTernary
+
+    # Packets with 16, 32 and 128 bit fields, and a header that is valid
+    # in some of them
+    import random
+    from header import HeaderLayout
+    test_layout = HeaderLayout("test_hdr", {"type" : "header", "fields" :
+                                            [{"port" : 16}, {"addr" : 32},
+                                             {"wide" : 128}]})
+    tag_layout = HeaderLayout("test_tag", {"type" : "header", "fields" :
+                                           [{"vid" : 16}]})
+    test_widths = {"test_hdr.port" : 16, "test_hdr.addr" : 32,
+                   "test_hdr.wide" : 128}
+    random.seed(4)
+    test_values = {"test_hdr.port" : range(4),
+                   "test_hdr.addr" : [random.getrandbits(32) for
+                                      idx in range(8)],
+                   "test_hdr.wide" : [random.getrandbits(128) for
+                                      idx in range(8)]}
+    test_pkts = []
+    for idx in range(200):
+        test_pkt = ParsedPacket(bytearray(24), {})
+        if idx % 4:
+            test_pkt.parse_header("test_hdr", test_layout)
+            for field, values in test_values.items():
+                # Flip none, some or most of the low bits
+                flip = random.getrandbits(24) & \
+                    random.choice([0, 0, 0xff, 0xffffff])
+                value = random.choice(values) ^ flip
+                if test_widths[field] > 64 and idx % 2:
+                    value = bytearray.fromhex("%032x" % value)
+                test_pkt.set_field(field, value)
+        if idx % 3:
+            test_pkt.parse_header("test_tag", tag_layout)
+        test_pkts.append(test_pkt)
+
+    def random_entry(match_on):
+        """
+        @brief Return an entry with random values (and masks) for the
+        match types of match_on; each field is left out one time in ten
+        """
+        values = {}
+        masks = {}
+        for field, match_type in match_on.items():
+            if random.randint(0, 9) == 0:
+                continue
+            if match_type == "valid":
+                values[field] = random.randint(0, 1)
+                continue
+            width = test_widths[field]
+            value = random.choice(test_values[field])
+            all_ones = (1 << width) - 1
+            if match_type == "ternary":
+                masks[field] = random.choice([None, 0, all_ones << 8,
+                                              all_ones << width / 2])
+            elif match_type == "lpm":
+                length = random.randint(0, width)
+                masks[field] = all_ones ^ ((1 << width - length) - 1)
+            if masks.get(field, None) is not None:
+                masks[field] &= all_ones
+                value &= masks[field]
+            if width > 64 and random.randint(0, 1):
+                value = bytearray.fromhex("%032x" % value)
+            values[field] = value
+        return TableEntryTernary(values, masks, "a", {},
+                                 random.randint(0, 20))
+
+    def reference_lookup(entries, test_pkt):
+        """
+        @brief Return the first of a list of entries matching a packet
+        """
+        for entry in entries:
+            for field, value in entry.match_values.items():
+                handle = match_field_handle(field)
+                p_value = test_pkt.get(handle)
+                if handle.field is None: # Valid match
+                    if (p_value is not None) != bool(value):
+                        break
+                    continue
+                if p_value is None:
+                    break
+                p_value = match_value_int(p_value)
+                value = match_value_int(value)
+                mask = (entry.match_masks or {}).get(field, None)
+                if mask is not None:
+                    (p_value, value) = (p_value & mask, value & mask)
+                if p_value != value:
+                    break
+            else:
+                return entry
+        return None
+
+    def check_index(index, match_on, rank=None, count=100):
+        """
+        @brief Check lookups in an index against a linear search
+        @param index The empty index to check
+        @param match_on The match_on attribute for the random entries
+        @param rank A function giving the sort key of an entry if
+        entries are ranked; otherwise the first entry added wins
+        @param count The number of random entries to add
+
+        Twice, half the entries are removed from a copy of the index and
+        new ones added; lookups in the original must not change.
+        """
+        def add_random(index, entries, count):
+            for idx in range(count):
+                entry = random_entry(match_on)
+                try:
+                    index.add(entry)
+                except IriParamError: # Duplicate key or prefix
+                    continue
+                entries.append(entry)
+        def check(index, entries):
+            ordered = sorted(entries, key=rank or entries.index)
+            expected = [reference_lookup(ordered, test_pkt) for
+                        test_pkt in test_pkts]
+            index.prepare()
+            air_assert(index.lookup_batch(test_pkts) == expected and
+                       [index.lookup(pkt) for pkt in test_pkts] == expected,
+                       "%s lookups differ from a linear search" %
+                       type(index).__name__)
+
+        entries = []
+        add_random(index, entries, count)
+        for round in range(2):
+            check(index, entries)
+            changed = index.copy()
+            for entry in entries[::2]:
+                air_assert(changed.remove(entry), "Failed remove")
+            changed_entries = entries[1::2]
+            add_random(changed, changed_entries, count / 4)
+            check(index, entries)
+            (index, entries) = (changed, changed_entries)
+        check(index, entries)
+        air_assert(not index.remove(random_entry(match_on)),
+                   "Removed a missing entry")
+
+    exact_on = {"test_hdr.port" : "exact", "test_hdr.wide" : "exact",
+                "test_tag" : "valid"}
+    air_assert(isinstance(table_index_create(exact_on), ExactIndex),
+               "Expected exact index")
+    check_index(ExactIndex(exact_on), exact_on)
+
+    # Valid matches key on header validity
+    valid_on = {"test_hdr" : "valid", "test_tag" : "valid"}
+    air_assert(isinstance(table_index_create(valid_on), ValidIndex),
+               "Expected valid index")
+    check_index(ValidIndex(valid_on), valid_on)
+
+    # Longest prefix match on a 32 bit field under an exact field and on
+    # a 128 bit field; the longest prefix wins
+    for (lpm_field, width, lpm_on) in [
+            ("test_hdr.addr", 32, {"test_hdr.port" : "exact",
+                                   "test_hdr.addr" : "lpm"}),
+            ("test_hdr.wide", 128, {"test_hdr.wide" : "lpm"})]:
+        air_assert(isinstance(table_index_create(lpm_on,
+                                                 {"test_hdr" : test_layout}),
+                              LpmIndex), "Expected LPM index")
+        def longest_first(entry):
+            return -prefix_length(entry.match_masks.get(lpm_field, None),
+                                  width)
+        check_index(LpmIndex(lpm_on, width), lpm_on, rank=longest_first)
+
+    # Ternary matching; the entry of highest priority wins, and of
+    # entries with the same priority, the one added first
+    ternary_on = {"test_hdr.port" : "ternary", "test_hdr.addr" : "ternary",
+                  "test_hdr.wide" : "ternary"}
+    def highest_first(entry):
+        return -entry.priority
+
+    air_assert(isinstance(table_index_create(ternary_on), TupleSpaceIndex),
+               "Expected tuple space")
+    check_index(TupleSpaceIndex(ternary_on), ternary_on, rank=highest_first)
+
+    # Small rebuild thresholds to search both trees and newer entries
+    for background in [False, True]:
+        check_index(DecisionTreeIndex(ternary_on, rebuild_threshold=16,
+                                      background=background),
+                    ternary_on, rank=highest_first)
+
+    if numpy is None:
+        logging.info("numpy not installed; columnar index not tested")
+        try:
+            table_index_create(ternary_on, index_type="columnar")
+            air_assert(False, "Columnar index created without numpy")
+        except IriImplementationError:
+            pass
+    else:
+        check_index(ColumnarIndex(ternary_on), ternary_on,
+                    rank=highest_first)
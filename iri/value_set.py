@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+#
+# @file
+# @brief Runtime value sets for parser transitions
+#
+
+import sys
+import bisect
+import threading
+
+from air.air_common import *
+from iri_exception import *
+
+def member_mask(value, mask):
+    """
+    @brief Apply the mask of a masked member to a value
+    @param value An integer, or a tuple of integers (or None for a field
+    whose header is not valid) for a select on several fields
+    @param mask An integer, or a tuple with a mask (or None) per field
+    @returns The masked value, or None if the value and mask are not of
+    the same shape or a masked component is None
+    """
+    if not isinstance(mask, tuple):
+        if value is None or isinstance(value, tuple):
+            return None
+        return value & mask
+    if not isinstance(value, tuple) or len(value) != len(mask):
+        return None
+    masked = []
+    for component, component_mask in zip(value, mask):
+        if component_mask is not None:
+            if component is None:
+                return None
+            component &= component_mask
+        masked.append(component)
+    return tuple(masked)
+
+class ValueSetMembers(object):
+    """
+    @brief An immutable index of the members of a value set
+
+    @param exact Set of exact member values
+    @param ranges Iterable of inclusive (low, high) ranges
+    @param masked Iterable of (value, mask) members
+
+    Exact members are hashed. Ranges are merged into sorted disjoint
+    intervals searched with bisect. Masked members are grouped by mask,
+    each group a hashed set of value & mask, so a lookup costs one hash
+    probe per distinct mask.
+
+    A set used by a select on several fields has tuple values. Their
+    masks are tuples too, applied field by field (see member_mask).
+    Ranges are of integers and never contain a tuple.
+    """
+    __slots__ = ["exact", "starts", "ends", "masks"]
+
+    def __init__(self, exact=(), ranges=(), masked=()):
+        self.exact = frozenset(exact)
+
+        self.starts = []
+        self.ends = []
+        for (low, high) in sorted(ranges):
+            if self.ends and low <= self.ends[-1] + 1:
+                self.ends[-1] = max(self.ends[-1], high)
+            else:
+                self.starts.append(low)
+                self.ends.append(high)
+
+        by_mask = {}
+        for (value, mask) in masked:
+            by_mask.setdefault(mask, set()).add(member_mask(value, mask))
+        self.masks = tuple([(mask, frozenset(values)) for
+                            mask, values in sorted(by_mask.items())])
+
+    @property
+    def exact_only(self):
+        """
+        @brief True if all members are exact values
+        """
+        return not self.starts and not self.masks
+
+    def changed(self, value, present):
+        """
+        @brief Return a copy with an exact member added or removed
+        @param value The member
+        @param present True if the member was added, False if removed
+
+        The ranges and masks are shared rather than rebuilt.
+        """
+        members = ValueSetMembers.__new__(ValueSetMembers)
+        if present:
+            members.exact = self.exact | frozenset([value])
+        else:
+            members.exact = self.exact - frozenset([value])
+        members.starts = self.starts
+        members.ends = self.ends
+        members.masks = self.masks
+        return members
+
+    def contains(self, value):
+        """
+        @brief Return True if value is a member
+        """
+        if value in self.exact:
+            return True
+        if self.starts and not isinstance(value, tuple):
+            idx = bisect.bisect_right(self.starts, value) - 1
+            if idx >= 0 and value <= self.ends[idx]:
+                return True
+        for mask, values in self.masks:
+            masked = member_mask(value, mask)
+            if masked is not None and masked in values:
+                return True
+        return False
+
+class ValueSet(object):
+    """
+    @brief A set of values managed at run time
+
+    @param name The name of the value set
+    @param air_value_set_attrs The AIR attributes of the value set
+
+    Members are exact values, (value, mask) pairs or inclusive ranges.
+    Updates are serialized by a lock and published by replacing the
+    members index (a ValueSetMembers object) in a single assignment, so
+    packets may be parsed against the set concurrently without locking:
+    a lookup sees the members before or after an update, never a mix.
+
+    Objects that cache membership (such as compiled parse states)
+    register a listener with add_listener; it is called after each
+    update with the value set and the change: (value, True) when add
+    adds an exact member, (value, False) when remove removes one, so
+    the listener can update just that value, or None for any other
+    update.
+    """
+    def __init__(self, name, air_value_set_attrs=None):
+        self.name = name
+        self.air_value_set_attrs = air_value_set_attrs
+        self.lock = threading.Lock()
+        self.listeners = []
+
+        # Members as given by the control plane
+        self.exact = set()
+        self.ranges = set()
+        self.masked = set()
+
+        self.members = ValueSetMembers()
+
+    def __contains__(self, value):
+        return self.members.contains(value)
+
+    def __len__(self):
+        return len(self.exact) + len(self.ranges) + len(self.masked)
+
+    def add_listener(self, listener):
+        """
+        @brief Register a function called with this set and the change
+        after each update
+        """
+        self.listeners.append(listener)
+
+    def _publish(self, change=None):
+        """
+        @brief Replace the members index and notify listeners
+        @param change (value, present) if only the exact member value was
+        added (present True) or removed; None to rebuild the index
+
+        Must be called with the lock held.
+        """
+        if change is None:
+            self.members = ValueSetMembers(self.exact, self.ranges,
+                                           self.masked)
+        else:
+            self.members = self.members.changed(*change)
+        for listener in self.listeners:
+            listener(self, change)
+
+    def add(self, value, mask=None):
+        """
+        @brief Add a member
+        @param value The value to add
+        @param mask If not None, the member matches any value v with
+        v & mask == value & mask
+        """
+        if mask is not None:
+            self.add_list([(value, mask)])
+            return
+        with self.lock:
+            if value not in self.exact:
+                self.exact.add(value)
+                self._publish((value, True))
+
+    def add_range(self, low, high):
+        """
+        @brief Add an inclusive range of values
+        """
+        air_check(isinstance(low, (int, long)) and
+                  isinstance(high, (int, long)) and low <= high, IriParamError)
+        with self.lock:
+            self.ranges.add((low, high))
+            self._publish()
+
+    def add_list(self, members):
+        """
+        @brief Add many members with a single update
+        @param members A list of values or (value, mask) pairs; a tuple
+        value (for a select on several fields) is given as (value, None)
+        """
+        with self.lock:
+            for member in members:
+                if isinstance(member, tuple):
+                    (value, mask) = member
+                else:
+                    (value, mask) = (member, None)
+                if mask is None:
+                    self.exact.add(value)
+                else:
+                    masked_value = member_mask(value, mask)
+                    air_check(masked_value is not None, IriParamError)
+                    self.masked.add((masked_value, mask))
+            self._publish()
+
+    def remove(self, value, mask=None):
+        """
+        @brief Remove a member added with add
+        @returns True if the member was present
+        """
+        with self.lock:
+            if mask is None:
+                present = value in self.exact
+                self.exact.discard(value)
+                change = (value, False)
+            else:
+                member = (member_mask(value, mask), mask)
+                present = member in self.masked
+                self.masked.discard(member)
+                change = None
+            if present:
+                self._publish(change)
+        return present
+
+    def remove_range(self, low, high):
+        """
+        @brief Remove a range added with add_range
+        @returns True if the range was present
+        """
+        with self.lock:
+            present = (low, high) in self.ranges
+            if present:
+                self.ranges.discard((low, high))
+                self._publish()
+        return present
+
+    def clear(self):
+        """
+        @brief Remove all members
+        """
+        with self.lock:
+            self.exact = set()
+            self.ranges = set()
+            self.masked = set()
+            self._publish()
+
+################################################################
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG, filename=sys.argv[1])
+    logging.info("RUNNING MODULE: %s" % __file__)
+
+    vset = ValueSet("ports")
+    air_assert(4789 not in vset, "Empty set has members")
+    vset.add(4789)
+    vset.add_list([8472, 6081])
+    vset.add_range(10000, 10099)
+    vset.add_range(10050, 10199)
+    vset.add(0x8800, mask=0xff00)
+    for value in [4789, 8472, 6081, 10000, 10150, 10199, 0x88f7]:
+        air_assert(value in vset, "Expected %d in value set" % value)
+    for value in [0, 4790, 9999, 10200, 0x8900]:
+        air_assert(value not in vset, "Did not expect %d in set" % value)
+    air_assert(vset.members.starts == [10000] and
+               vset.members.ends == [10199], "Ranges not merged")
+
+    notified = []
+    vset.add_listener(lambda value_set, change: notified.append(change))
+    air_assert(vset.remove(4789), "Failed remove")
+    air_assert(not vset.remove(4789), "Second remove should fail")
+    air_assert(vset.remove_range(10050, 10199), "Failed range remove")
+    air_assert(10150 not in vset and 10050 in vset, "Bad range remove")
+    air_assert(vset.remove(0x88aa, mask=0xff00), "Failed masked remove")
+    air_assert(0x88f7 not in vset, "Masked member not removed")
+    air_assert(notified == [(4789, False), None, None],
+               "Listener not called with each change")
+    air_assert(vset.members.starts == [10000],
+               "Exact member change rebuilt the ranges")
+    vset.add(4789)
+    air_assert(4789 in vset and notified[-1] == (4789, True) and
+               vset.members.starts == [10000], "Bad exact member add")
+    air_assert(not vset.members.exact_only, "Set has a range")
+    vset.clear()
+    air_assert(len(vset) == 0 and vset.members.exact_only, "Failed clear")
+
+    # Members of a set used by a select on two fields are tuples; masks
+    # apply field by field and integer ranges contain no tuple
+    pairs = ValueSet("pairs")
+    pairs.add((4, 17))
+    pairs.add_list([((4, 6), None), ((6, 0x80), (None, 0x80))])
+    pairs.add_range(0, 100)
+    for value in [(4, 17), (4, 6), (6, 0x85), (6, 0xff), 50]:
+        air_assert(value in pairs, "Expected %s in pairs" % str(value))
+    for value in [(4, 18), (6, 0x7f), (4, 0x80), (None, 0x80), (6, None),
+                  (50, 50), (6,), 0x80]:
+        air_assert(value not in pairs, "Did not expect %s" % str(value))
+    air_assert(pairs.remove((6, 0xff), mask=(None, 0x80)) and
+               (6, 0x85) not in pairs, "Failed tuple masked remove")
+    try:
+        pairs.add((6, 1), mask=0xff)
+        air_assert(False, "Integer mask on a tuple accepted")
+    except IriParamError:
+        pass
+
+    # Lookups while another thread updates the set
+    vset.add_list(range(0, 2000, 2))
+    errors = []
+    def reader():
+        for idx in range(20000):
+            if 1000 not in vset or 1001 in vset:
+                errors.append(idx)
+    thread = threading.Thread(target=reader)
+    thread.start()
+    for value in range(3000, 3500):
+        vset.add(value)
+    thread.join()
+    air_assert(not errors, "Inconsistent lookups during update")
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+#
+# Time parts of the IRI packet path. These are measurements, not
+# tests; the unit tests (make test) do not run them.
+#
+# Usage: tools/benchmark.py [name ...] [--sizes N ...]
+#
+
+import argparse
+import os
+import sys
+import time
+import random
+import logging
+
+local_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(local_dir, ".."),
+                os.path.join(local_dir, "..", "iri")]
+
+from air.air_common import *
+from table_index import *
+from table_entry import TableEntryTernary
+from parsed_packet import ParsedPacket
+from header import HeaderLayout
+from field_handle import field_handle
+from instance import IriInstance
+from parser_codegen import parser_codegen
+from parse_cache import ParseCache
+
+################################################################
+#
+# Table indexes
+#
+################################################################
+
+def benchmark_index(index_class, sizes, lookups=2000):
+    """
+    @brief Log the cost of lookups against the number of entries
+    @param index_class The TableIndex subclass to measure
+    @param sizes List of numbers of entries
+    @param lookups Number of lookups timed for each size
+    """
+    layout = HeaderLayout("bench_hdr", {"type" : "header", "fields" :
+                                        [{"addr" : 32}, {"port" : 16}]})
+    byte_buf = bytearray(6)
+    match_on = {"bench_hdr.addr" : "exact", "bench_hdr.port" : "exact"}
+    for size in sizes:
+        index = index_class(match_on)
+        start = time.time()
+        for idx in range(size):
+            index.add(TableEntryTernary({"bench_hdr.addr" : idx,
+                                         "bench_hdr.port" : 80},
+                                        None, "bench_a", {}, 0))
+        add_time = time.time() - start
+        ppkt = ParsedPacket(byte_buf, {})
+        ppkt.parse_header("bench_hdr", layout)
+        ppkt.set_field("bench_hdr.port", 80)
+        # Look up the last entry added (the worst case for a linear scan)
+        ppkt.set_field("bench_hdr.addr", size - 1)
+        count = lookups
+        if index_class is LinearIndex:
+            count = max(1, min(lookups, 2000000 / size))
+        start = time.time()
+        for idx in range(count):
+            entry = index.lookup(ppkt)
+        lookup_time = time.time() - start
+        air_assert(entry is not None, "Benchmark entry not found")
+        logging.info("%s with %d entries: add %.2f usec, lookup %.2f usec" %
+                     (index_class.__name__, size, 1e6 * add_time / size,
+                      1e6 * lookup_time / count))
+
+def benchmark_lpm(sizes, lookups=2000):
+    """
+    @brief Log the cost of LPM lookups against the number of prefixes
+    @param sizes List of numbers of (random IPv4) prefixes
+    @param lookups Number of lookups timed for each size
+    """
+    random.seed(3)
+    for size in sizes:
+        trie = LpmTrie(32)
+        start = time.time()
+        added = 0
+        while added < size:
+            length = random.randint(8, 32)
+            value = random.getrandbits(32) & ~((1 << (32 - length)) - 1)
+            try:
+                trie.insert(value, length, (value, length))
+                added += 1
+            except IriParamError:
+                pass
+        add_time = time.time() - start
+        addresses = [random.getrandbits(32) for idx in range(lookups)]
+        start = time.time()
+        for address in addresses:
+            trie.lookup(address)
+        lookup_time = time.time() - start
+        logging.info("LpmTrie with %d prefixes: add %.2f usec, "
+                     "lookup %.2f usec" % (size, 1e6 * add_time / size,
+                                           1e6 * lookup_time / lookups))
+
+def benchmark_ternary(size, mask_count, lookups=2000,
+                      index_classes=(TupleSpaceIndex, LinearIndex)):
+    """
+    @brief Log the cost of ternary lookups for several indexes
+    @param size The number of (random) entries
+    @param mask_count The number of distinct masks the entries use
+    @param lookups Number of lookups timed for each index
+    @param index_classes The TableIndex subclasses to measure
+    """
+    layout = HeaderLayout("bench_hdr", {"type" : "header", "fields" :
+                                        [{"src" : 32}, {"dst" : 32},
+                                         {"port" : 16}]})
+    match_on = {"bench_hdr.src" : "ternary", "bench_hdr.dst" : "ternary",
+                "bench_hdr.port" : "ternary"}
+    random.seed(6)
+    masks = []
+    for idx in range(mask_count):
+        masks.append({"bench_hdr.src" : random.choice([0, 0xff000000,
+                                                      0xffff0000, 0xffffff00]),
+                      "bench_hdr.dst" : (0xffffffff << random.randint(0, 32)) &
+                      0xffffffff,
+                      "bench_hdr.port" : random.choice([0, 0xffff])})
+    entries = []
+    for idx in range(size):
+        entries.append(TableEntryTernary(
+                {"bench_hdr.src" : random.getrandbits(32),
+                 "bench_hdr.dst" : random.getrandbits(32),
+                 "bench_hdr.port" : random.getrandbits(16)},
+                random.choice(masks), "bench_a", {}, random.randint(0, 100)))
+    packets = []
+    for idx in range(100):
+        ppkt = ParsedPacket(bytearray(10), {})
+        ppkt.parse_header("bench_hdr", layout)
+        ppkt.set_field("bench_hdr.src", random.getrandbits(32))
+        ppkt.set_field("bench_hdr.dst", random.getrandbits(32))
+        ppkt.set_field("bench_hdr.port", random.getrandbits(16))
+        packets.append(ppkt)
+
+    for index_class in index_classes:
+        index = index_class(match_on)
+        start = time.time()
+        for entry in entries:
+            index.add(entry)
+        if index_class is DecisionTreeIndex:
+            index.rebuild()
+        add_time = time.time() - start
+        count = lookups
+        if index_class is LinearIndex:
+            count = max(1, min(lookups, 2000000 / size))
+        start = time.time()
+        for idx in range(count):
+            index.lookup(packets[idx % len(packets)])
+        lookup_time = time.time() - start
+        logging.info("%s with %d entries, %d masks: add %.2f usec, "
+                     "lookup %.2f usec" %
+                     (index_class.__name__, size, mask_count,
+                      1e6 * add_time / size, 1e6 * lookup_time / count))
+        if index_class is DecisionTreeIndex:
+            logging.info("DecisionTreeIndex stats: %s" % str(index.stats()))
+        if index_class is not ColumnarIndex:
+            continue
+        start = time.time()
+        index.lookup_batch(packets)
+        batch_time = time.time() - start
+        logging.info("%s batch of %d lookups: %.2f usec per packet" %
+                     (index_class.__name__, len(packets),
+                      1e6 * batch_time / len(packets)))
+
+def benchmark_tables(args):
+    """
+    @brief Time lookups in each kind of table index
+    """
+    sizes = args.sizes
+    benchmark_index(ExactIndex, sizes)
+    benchmark_index(LinearIndex, sizes[:2])
+    benchmark_lpm(sizes)
+    benchmark_ternary(max(sizes), 50)
+    benchmark_ternary(min(max(sizes), 2000), 1000,
+                      index_classes=(TupleSpaceIndex, DecisionTreeIndex))
+    if numpy is not None:
+        benchmark_ternary(max(sizes), 50,
+                          index_classes=(TupleSpaceIndex, ColumnarIndex))
+
+################################################################
+#
+# Field access
+#
+################################################################
+
+def get_by_split(parsed_packet, field_ref):
+    """
+    @brief Get a field as get_field did before handles: split the
+    reference and look up the header and field by name
+    """
+    try:
+        (hdr, fld) = field_ref.split(".")
+    except ValueError:
+        return field_ref in parsed_packet.header_map.keys() or None
+    if hdr in parsed_packet.header_map.keys():
+        return parsed_packet.header_map[hdr].get_field(fld)
+    if hdr in parsed_packet.metadata.keys():
+        return parsed_packet.metadata[hdr].get_field(fld)
+    return None
+
+def benchmark_fields(args, count=20000):
+    """
+    @brief Log the cost of a field get before handles (split and look
+    up by name), of get_field (string ref to cached handle) and of a
+    handle resolved in advance
+    """
+    layout = HeaderLayout("bench_hdr", {"type" : "header", "fields" :
+                                        [{"ttl" : 8}, {"proto" : 8}]})
+    ppkt = ParsedPacket(bytearray(range(2)), {})
+    ppkt.parse_header("bench_hdr", layout)
+    handle = field_handle("bench_hdr.ttl")
+    air_assert(get_by_split(ppkt, "bench_hdr.ttl") == ppkt.get(handle),
+               "Split lookup differs")
+    start = time.time()
+    for idx in range(count):
+        get_by_split(ppkt, "bench_hdr.ttl")
+    split_time = time.time() - start
+    start = time.time()
+    for idx in range(count):
+        ppkt.get_field("bench_hdr.ttl")
+    string_time = time.time() - start
+    start = time.time()
+    for idx in range(count):
+        ppkt.get(handle)
+    handle_time = time.time() - start
+    logging.info("Field get: split ref %.3f usec, string ref %.3f usec, "
+                 "handle %.3f usec" %
+                 (1e6 * split_time / count, 1e6 * string_time / count,
+                  1e6 * handle_time / count))
+
+################################################################
+#
+# Parsers
+#
+################################################################
+
+def benchmark_parsers(args, count=2000):
+    """
+    @brief Log the cost per packet of each parser of unit_test.yml,
+    interpreted, generated and as a parse cache hit, for a TCP over
+    IPv4 packet whose headers are decoded eagerly and lazily
+    """
+    def transmit_packet(out_port, packet):
+        pass
+
+    iri = IriInstance("instance", os.path.join(local_dir, "..",
+                                               "unit_test.yml"),
+                      transmit_packet)
+    byte_buf = bytearray(200)
+    byte_buf[12:14] = bytearray([0x08, 0x00])
+    byte_buf[14] = 0x45
+    byte_buf[23] = 6
+    for name, parser in iri.iri_parser.items():
+        parser.next_processor = None
+        parser_codegen(parser)
+        cache = ParseCache(parser)
+        for lazy in [False, True]:
+            for label, parse in [("interpreted", parser.interpret),
+                                 ("generated", parser.parse_states),
+                                 ("cached", cache.parse)]:
+                start = time.time()
+                for idx in range(count):
+                    parse(ParsedPacket(byte_buf, {}, lazy))
+                elapsed = time.time() - start
+                logging.info("Parser %s %s %s: %.1f usec per packet" %
+                             (name, ["eager", "lazy"][lazy], label,
+                              1e6 * elapsed / count))
+
+################################################################
+
+benchmarks = {
+    "fields" : benchmark_fields,
+    "parsers" : benchmark_parsers,
+    "tables" : benchmark_tables,
+}
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Time IRI components")
+    arg_parser.add_argument("names", metavar="name", nargs="*",
+                            help="Benchmarks to run (default all): %s" %
+                            ", ".join(sorted(benchmarks.keys())))
+    arg_parser.add_argument("--sizes", type=int, nargs="+",
+                            default=[10, 10000],
+                            help="Numbers of table entries to measure")
+    args = arg_parser.parse_args()
+    for name in args.names:
+        if name not in benchmarks:
+            arg_parser.error("unknown benchmark %s" % name)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    for name in args.names or sorted(benchmarks.keys()):
+        benchmarks[name](args)